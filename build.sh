@@ -7,6 +7,9 @@ cp deploy/* ./package
 # resources withhout __init__.py. Newer versions can't find them
 # when we do include it!
 touch ./package/metadata_specifications/metadata/__init__.py
+# pyarrow is large, so leave out its tests and C++ headers to keep the
+# unzipped package under the Lambda limit of 250 MB
+rm -rf ./package/pyarrow/tests ./package/pyarrow/include ./package/pyarrow/src
 cd package || exit
 zip -r ../deploy.zip .
 cd .. || exit
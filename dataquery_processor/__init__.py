@@ -2,7 +2,7 @@ from .pathutils import get_config_path, resource_path
 from .config import _config
 from .excel import ExcelHandler
 from .query_builder import QueryBuilder
-from .query_runner import OdbcQueryRunner
+from .query_runner import QueryRunner, OdbcQueryRunner, create_query_runner
 from .order_validator import OrderValidator
 from .storage_controller import StorageController
 from .order_processor import OrderProcessor
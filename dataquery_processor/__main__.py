@@ -3,7 +3,7 @@ import os
 from dataquery_processor import get_config_path
 from logging.config import fileConfig
 from dataquery_processor import QueueController
-from dataquery_processor import OrderProcessor
+from dataquery_processor.concurrency import process_messages
 
 """
 Setup logging
@@ -18,22 +18,26 @@ def main():
     """
     Main method and entry point for running a service locally.
     Loads configuration from file and initialises a QueueController instance.
-    Runs controller once and exits.
+    Processes the batch of orders, up to max_workers at a time, and exits.
+    Each message is deleted from the queue only if its own order completed.
     :return:
     """
 
     q = QueueController()
     if len(q.messages) == 0:
         logger.info("No new orders to process")
+    messages = []
     while len(q.messages) > 0:
         message = q.read_message()
         if message:
-            proc = OrderProcessor(message.order())
-            if proc.process():
-                logger.info("Job completed. Deleting message from queue")
-                q.delete_message(message)
-            else:
-                logger.error("Job was not completed successfully; leaving message on queue")
+            messages.append(message)
+    for message, error in process_messages(messages):
+        if error is None:
+            logger.info("Job completed. Deleting message from queue")
+            q.delete_message(message)
+        else:
+            logger.error("Job was not completed successfully; leaving message on queue")
+            logger.debug(error)
 
 
 if __name__ == "__main__":
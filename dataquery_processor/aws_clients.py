@@ -0,0 +1,51 @@
+import logging
+import threading
+import boto3
+from botocore.config import Config as ClientConfig
+from dataquery_processor import _config
+
+logger = logging.getLogger(__name__)
+
+"""
+Module-level registry of boto3 clients. Sessions and clients live as long as the
+process, so credentials are resolved once and TLS connections are reused across
+orders and across warm invocations of the Lambda handler.
+"""
+
+_sessions = {}
+_clients = {}
+_clients_lock = threading.Lock()
+
+
+def get_client(service_name, profile=None, region=None, config=_config):
+    """
+    Gets the process-wide client for a service, profile, region and connection pool size,
+    creating it on first use. boto3 clients are thread-safe, but sessions are not, so clients
+    are created under a lock.
+    :param service_name: the AWS service, e.g. 's3' or 'sqs'
+    :param profile: the AWS profile to use; None or blank for the default credentials, e.g. the Lambda role
+    :param region: the AWS region
+    :param config: the Config object to use
+    :return: a boto3 client
+    """
+    profile = profile or None
+    max_pool_connections = config.get_concurrency_configuration()['aws_pool_connections']
+    key = (service_name, profile, region, max_pool_connections)
+    with _clients_lock:
+        if key not in _clients:
+            if profile not in _sessions:
+                _sessions[profile] = boto3.Session(profile_name=profile) if profile is not None else boto3.Session()
+            logger.debug("Creating " + service_name + " client for region " + str(region))
+            _clients[key] = _sessions[profile].client(
+                service_name, region_name=region, config=ClientConfig(max_pool_connections=max_pool_connections))
+        return _clients[key]
+
+
+def clear_clients():
+    """
+    Removes all the clients and sessions, e.g. after credentials have changed
+    :return: None
+    """
+    with _clients_lock:
+        _clients.clear()
+        _sessions.clear()
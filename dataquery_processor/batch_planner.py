@@ -0,0 +1,131 @@
+import copy
+import csv
+import logging
+from dataquery_processor import _config, QueryBuilder, OrderValidator
+from dataquery_processor.query_builder import create_grouping_sets_query
+from dataquery_processor.query_runner import create_query_runner, fetch_batches
+from dataquery_processor.concurrency import database_slot
+from dataquery_processor.scratch import ScratchSpace
+
+logger = logging.getLogger(__name__)
+
+"""
+Module for combining the queries for orders in the same batch. Orders against the
+same datasource, years, onward use category and constraints that only differ in their
+selected fields are answered with one GROUPING SETS query, so the fact table is scanned
+once for the whole group.
+"""
+
+
+class BatchPlanner(object):
+    """
+    Plans and runs combined queries for a batch of orders
+    """
+
+    def __init__(self, orders, config=_config):
+        """
+        :param orders: the list of order manifests in the batch; None entries are ignored
+        :param config: the Config object to use
+        """
+        self.orders = orders
+        self.config = config
+        self.scratch = None
+
+    def plan(self):
+        """
+        Groups compatible orders. Orders that fail validation are left out, so that they
+        fail on their own when processed rather than breaking the combined query.
+        :return: a list of groups of two or more (order index, QueryBuilder) tuples
+        """
+        groups = {}
+        for index, order in enumerate(self.orders):
+            if order is None:
+                continue
+            try:
+                # The validator and query builder update the manifest, so plan using a copy
+                planned_order = copy.deepcopy(order)
+                OrderValidator(planned_order).validate_order()
+                query_builder = QueryBuilder(planned_order, config=self.config)
+            except Exception as e:
+                logger.debug(e)
+                continue
+            groups.setdefault(query_builder.get_compatibility_key(), []).append((index, query_builder))
+        return [group for group in groups.values() if len(group) > 1]
+
+    def prefetch(self):
+        """
+        Runs a combined query for each group of compatible orders and saves the results for
+        each order to its own CSV file. If a combined query fails, its orders are left to
+        run their own queries.
+        :return: a dict of order index to a dict with the CSV file name, the number of the
+        batch query in this batch of orders, its SQL, and the references of the orders it answered
+        """
+        results = {}
+        for batch, group in enumerate(self.plan(), start=1):
+            if self.scratch is None:
+                self.scratch = ScratchSpace('batch', config=self.config)
+            indexes = [index for index, query_builder in group]
+            query_builders = [query_builder for index, query_builder in group]
+            file_names = [self.scratch.get_path('data-' + str(index) + '.csv') for index in indexes]
+            try:
+                query = run_grouping_sets_query(query_builders, file_names, config=self.config)
+            except Exception as e:
+                logger.warning("Could not run a combined query; the orders will be run separately")
+                logger.debug(e)
+                continue
+            logger.info("Answered " + str(len(group)) + " orders with a single query")
+            order_references = [self.orders[index].get('orderRef') for index in indexes]
+            for index, file_name in zip(indexes, file_names):
+                results[index] = {"file": file_name, "batch": batch, "sql": query[0], "orders": order_references}
+        return results
+
+    def cleanup(self):
+        """
+        Removes any result files that were not used
+        :return: None
+        """
+        if self.scratch is not None:
+            self.scratch.cleanup()
+
+
+def run_grouping_sets_query(query_builders, file_names, config=_config):
+    """
+    Runs a GROUPING SETS query for a group of compatible orders and splits the rows
+    into a CSV file for each order, with the same columns as the order's own query
+    :param query_builders: a QueryBuilder for each order
+    :param file_names: the CSV file to save for each order
+    :param config: the Config object to use
+    :return: the query that was run, from create_grouping_sets_query
+    """
+    query = create_grouping_sets_query(query_builders)
+    columns = query[3]
+    measure_indexes = list(range(len(columns), len(columns) + len(query_builders[0].measures)))
+    grouping_id_index = len(columns) + len(measure_indexes)
+    files = []
+    targets = {}
+    try:
+        for query_builder, file_name, grouping_id in zip(query_builders, file_names, query[4]):
+            csvfile = open(file_name, 'w', newline='')
+            files.append(csvfile)
+            writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+            writer.writerow(query_builder.fieldnames + query_builder.measures)  # column headers
+            indexes = [columns.index(fieldname) for fieldname in query_builder.fieldnames] + measure_indexes
+            targets.setdefault(grouping_id, []).append((writer, indexes))
+
+        fetch_configuration = config.get_fetch_configuration()
+        with database_slot(config):
+            runner = create_query_runner(config=config)
+            try:
+                runner.cursor.arraysize = fetch_configuration['batch_size']
+                cursor = runner.run_query_and_return_results(query)
+                for rows in fetch_batches(cursor, fetch_configuration['batch_size'], fetch_configuration['memory_limit']):
+                    for row in rows:
+                        grouping_id = row[grouping_id_index] if len(columns) > 0 else None
+                        for writer, indexes in targets.get(grouping_id, []):
+                            writer.writerow([row[index] for index in indexes])
+            finally:
+                runner.close()
+    finally:
+        for csvfile in files:
+            csvfile.close()
+    return query
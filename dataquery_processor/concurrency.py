@@ -0,0 +1,92 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from dataquery_processor import _config
+
+logger = logging.getLogger(__name__)
+
+"""
+Module for running several orders at once. Database work and uploads are
+limited by separate process-wide semaphores, so the number of orders in
+flight can be larger than the number of concurrent queries.
+"""
+
+_semaphores = {}
+_semaphores_lock = threading.Lock()
+
+
+def _get_semaphore(name, size):
+    with _semaphores_lock:
+        if name not in _semaphores:
+            _semaphores[name] = threading.BoundedSemaphore(size)
+        return _semaphores[name]
+
+
+def database_slot(config=_config):
+    """
+    Gets the semaphore that limits the number of queries running at once.
+    Use as a context manager around database work.
+    :param config: the Config object to use
+    :return: a BoundedSemaphore
+    """
+    return _get_semaphore('database', config.get_concurrency_configuration()['database'])
+
+
+def upload_slot(config=_config):
+    """
+    Gets the semaphore that limits the number of uploads running at once.
+    Use as a context manager around uploads.
+    :param config: the Config object to use
+    :return: a BoundedSemaphore
+    """
+    return _get_semaphore('upload', config.get_concurrency_configuration()['upload'])
+
+
+def process_messages(messages, config=_config):
+    """
+    Processes the order in each message using a pool of worker threads. Each
+    order succeeds or fails independently of the others. If coalescing is enabled,
+    compatible orders are first answered together with a single query.
+    :param messages: a list of queue Message objects
+    :param config: the Config object to use
+    :return: a list of (message, exception) tuples in the same order as the
+    messages; the exception is None if the order completed successfully
+    """
+    # Imported here as OrderProcessor itself uses the semaphores in this module
+    from dataquery_processor.order_processor import OrderProcessor
+    from dataquery_processor.batch_planner import BatchPlanner
+    from dataquery_processor.query_builder import get_shape_cache
+
+    orders = []
+    for message in messages:
+        try:
+            orders.append(message.order())
+        except Exception as e:
+            logger.debug(e)
+            orders.append(None)
+
+    planner = None
+    prefetched_results = {}
+    if config.get_concurrency_configuration()['coalesce_orders'] and len(messages) > 1:
+        planner = BatchPlanner(orders, config=config)
+        prefetched_results = planner.prefetch()
+
+    def process(index):
+        try:
+            OrderProcessor(messages[index].order(), config=config,
+                           prefetched_results=prefetched_results.get(index)).process()
+            return None
+        except Exception as e:
+            return e
+
+    try:
+        workers = max(1, min(config.get_concurrency_configuration()['workers'], len(messages)))
+        if workers == 1:
+            return [(message, process(index)) for index, message in enumerate(messages)]
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            return list(zip(messages, executor.map(process, range(len(messages)))))
+    finally:
+        if planner is not None:
+            planner.cleanup()
+        logger.info("Query shape cache: {entries} entries, {hits} hits, {misses} misses, {shapes} distinct shapes"
+                    .format(**get_shape_cache(config).statistics()))
@@ -9,6 +9,49 @@ FILE_OUTPUT = 'file'
 S3_OUTPUT = 's3'
 DEFAULT_OUTPUT_TYPE = FILE_OUTPUT
 
+ODBC_RUNNER = 'odbc'
+SQLITE_RUNNER = 'sqlite'
+DEFAULT_RUNNER_TYPE = ODBC_RUNNER
+
+ROLLUP_SECTION_PREFIX = 'rollup.'
+
+DEFAULT_WORKERS = 1
+DEFAULT_DATABASE_CONCURRENCY = 2
+DEFAULT_UPLOAD_CONCURRENCY = 4
+DEFAULT_ARTIFACT_CONCURRENCY = 3
+DEFAULT_AWS_POOL_CONNECTIONS = 50
+
+DEFAULT_SCRATCH_ROOT = '/tmp'
+DEFAULT_EPHEMERAL_STORAGE_MB = 512
+
+DEFAULT_POOL_MAX_IDLE = 5
+DEFAULT_POOL_IDLE_TIMEOUT = 300
+
+DEFAULT_FETCH_BATCH_SIZE = 5000
+DEFAULT_FETCH_MEMORY_LIMIT_MB = 64
+
+DEFAULT_MULTIPART_THRESHOLD_MB = 8
+DEFAULT_MULTIPART_CHUNKSIZE_MB = 8
+DEFAULT_TRANSFER_CONCURRENCY = 10
+
+DEFAULT_PARTITION_CONCURRENCY = 4
+
+DEFAULT_CACHE_LOCATION = 'cache'
+DEFAULT_CACHE_TTL = 86400
+DEFAULT_CACHE_MAX_SIZE_MB = 1024
+DEFAULT_SHAPE_CACHE_SIZE = 256
+DEFAULT_TEMP_TABLE_THRESHOLD = 1000
+
+DEFAULT_PARQUET_CODEC = 'snappy'
+DEFAULT_PARQUET_ROW_GROUP_SIZE = 100000
+
+
+def split_lines(value):
+    """
+    Splits a multi-line config value into a list, one item per line
+    """
+    return [line.strip() for line in value.splitlines() if line.strip() != '']
+
 
 class Config:
     """
@@ -24,6 +67,25 @@ class Config:
         if self.config.has_option('default', "order_batch_size"):
             self.order_batch_size = self.config.getint("default", "order_batch_size")
 
+        self.concurrency_configuration = {"workers": DEFAULT_WORKERS,
+                                          "database": DEFAULT_DATABASE_CONCURRENCY,
+                                          "upload": DEFAULT_UPLOAD_CONCURRENCY,
+                                          "artifacts": DEFAULT_ARTIFACT_CONCURRENCY,
+                                          "aws_pool_connections": DEFAULT_AWS_POOL_CONNECTIONS,
+                                          "coalesce_orders": False}
+        if self.config.has_option('default', "max_workers"):
+            self.concurrency_configuration["workers"] = self.config.getint("default", "max_workers")
+        if self.config.has_option('default', "database_concurrency"):
+            self.concurrency_configuration["database"] = self.config.getint("default", "database_concurrency")
+        if self.config.has_option('default', "upload_concurrency"):
+            self.concurrency_configuration["upload"] = self.config.getint("default", "upload_concurrency")
+        if self.config.has_option('default', "artifact_concurrency"):
+            self.concurrency_configuration["artifacts"] = self.config.getint("default", "artifact_concurrency")
+        if self.config.has_option('default', "aws_pool_connections"):
+            self.concurrency_configuration["aws_pool_connections"] = self.config.getint("default", "aws_pool_connections")
+        if self.config.has_option('default', "coalesce_orders"):
+            self.concurrency_configuration["coalesce_orders"] = self.config.getboolean("default", "coalesce_orders")
+
         self.queue_configuration = {"profile": self.config.get('sqs', "profile"),
                                     "queue": self.config.get('sqs', "queue"),
                                     "region": self.config.get('sqs', "region")}
@@ -33,6 +95,99 @@ class Config:
                                       "bucket": self.config.get('s3', "bucket"),
                                       "region": self.config.get('s3', "region")}
         self.storage_configuration["bucket"] = os.environ.get("PROCESSED_ORDERS_BUCKET", self.storage_configuration["bucket"])
+        self.storage_configuration["subfolder"] = ''
+        if self.config.has_option('s3', "subfolder"):
+            self.storage_configuration["subfolder"] = self.config.get('s3', "subfolder").strip("'\"")
+        self.storage_configuration["multipart_threshold"] = DEFAULT_MULTIPART_THRESHOLD_MB * 1024 * 1024
+        self.storage_configuration["multipart_chunksize"] = DEFAULT_MULTIPART_CHUNKSIZE_MB * 1024 * 1024
+        self.storage_configuration["max_concurrency"] = DEFAULT_TRANSFER_CONCURRENCY
+        if self.config.has_option('s3', "multipart_threshold_mb"):
+            self.storage_configuration["multipart_threshold"] = self.config.getint('s3', "multipart_threshold_mb") * 1024 * 1024
+        if self.config.has_option('s3', "multipart_chunksize_mb"):
+            self.storage_configuration["multipart_chunksize"] = self.config.getint('s3', "multipart_chunksize_mb") * 1024 * 1024
+        if self.config.has_option('s3', "max_concurrency"):
+            self.storage_configuration["max_concurrency"] = self.config.getint('s3', "max_concurrency")
+        self.storage_configuration["stream_results"] = False
+        self.storage_configuration["gzip_results"] = False
+        if self.config.has_option('s3', "stream_results"):
+            self.storage_configuration["stream_results"] = self.config.getboolean('s3', "stream_results")
+        if self.config.has_option('s3', "gzip_results"):
+            self.storage_configuration["gzip_results"] = self.config.getboolean('s3', "gzip_results")
+
+        self.scratch_configuration = {"root": DEFAULT_SCRATCH_ROOT,
+                                      "limit": DEFAULT_EPHEMERAL_STORAGE_MB * 1024 * 1024}
+        if self.config.has_option('scratch', "root"):
+            self.scratch_configuration["root"] = self.config.get('scratch', "root")
+        if self.config.has_option('scratch', "ephemeral_storage_mb"):
+            self.scratch_configuration["limit"] = self.config.getint('scratch', "ephemeral_storage_mb") * 1024 * 1024
+
+        self.pool_configuration = {"max_idle": DEFAULT_POOL_MAX_IDLE,
+                                   "idle_timeout": DEFAULT_POOL_IDLE_TIMEOUT,
+                                   "health_check": True}
+        if self.config.has_option('ODBC', "pool_max_idle"):
+            self.pool_configuration["max_idle"] = self.config.getint('ODBC', "pool_max_idle")
+        if self.config.has_option('ODBC', "pool_idle_timeout"):
+            self.pool_configuration["idle_timeout"] = self.config.getint('ODBC', "pool_idle_timeout")
+        if self.config.has_option('ODBC', "pool_health_check"):
+            self.pool_configuration["health_check"] = self.config.getboolean('ODBC', "pool_health_check")
+
+        self.fetch_configuration = {"batch_size": DEFAULT_FETCH_BATCH_SIZE,
+                                    "memory_limit": DEFAULT_FETCH_MEMORY_LIMIT_MB * 1024 * 1024,
+                                    "server_statistics": False}
+        if self.config.has_option('ODBC', "fetch_batch_size"):
+            self.fetch_configuration["batch_size"] = self.config.getint('ODBC', "fetch_batch_size")
+        if self.config.has_option('ODBC', "fetch_memory_limit_mb"):
+            self.fetch_configuration["memory_limit"] = self.config.getint('ODBC', "fetch_memory_limit_mb") * 1024 * 1024
+        if self.config.has_option('ODBC', "server_statistics"):
+            self.fetch_configuration["server_statistics"] = self.config.getboolean('ODBC', "server_statistics")
+
+        self.partition_configuration = {"enabled": False,
+                                        "concurrency": DEFAULT_PARTITION_CONCURRENCY}
+        if self.config.has_option('ODBC', "partition_by_year"):
+            self.partition_configuration["enabled"] = self.config.getboolean('ODBC', "partition_by_year")
+        if self.config.has_option('ODBC', "partition_concurrency"):
+            self.partition_configuration["concurrency"] = self.config.getint('ODBC', "partition_concurrency")
+
+        self.cache_configuration = {"enabled": False,
+                                    "location": DEFAULT_CACHE_LOCATION,
+                                    "ttl": DEFAULT_CACHE_TTL,
+                                    "max_size": DEFAULT_CACHE_MAX_SIZE_MB * 1024 * 1024}
+        if self.config.has_option('cache', "enabled"):
+            self.cache_configuration["enabled"] = self.config.getboolean('cache', "enabled")
+        if self.config.has_option('cache', "location"):
+            self.cache_configuration["location"] = self.config.get('cache', "location")
+        if self.config.has_option('cache', "ttl"):
+            self.cache_configuration["ttl"] = self.config.getint('cache', "ttl")
+        if self.config.has_option('cache', "max_size_mb"):
+            self.cache_configuration["max_size"] = self.config.getint('cache', "max_size_mb") * 1024 * 1024
+        self.cache_configuration["location"] = os.environ.get("RESULT_CACHE_LOCATION", self.cache_configuration["location"])
+
+        self.query_configuration = {"shape_cache_size": DEFAULT_SHAPE_CACHE_SIZE,
+                                    "placeholder_buckets": [],
+                                    "temp_table_threshold": DEFAULT_TEMP_TABLE_THRESHOLD,
+                                    "server_totals": True,
+                                    "subtotals": False}
+        if self.config.has_option('query', "shape_cache_size"):
+            self.query_configuration["shape_cache_size"] = self.config.getint('query', "shape_cache_size")
+        if self.config.has_option('query', "placeholder_buckets"):
+            self.query_configuration["placeholder_buckets"] = sorted(
+                int(bucket) for bucket in self.config.get('query', "placeholder_buckets").split(',') if bucket.strip() != '')
+        if self.config.has_option('query', "temp_table_threshold"):
+            self.query_configuration["temp_table_threshold"] = self.config.getint('query', "temp_table_threshold")
+        if self.config.has_option('query', "server_totals"):
+            self.query_configuration["server_totals"] = self.config.getboolean('query', "server_totals")
+        if self.config.has_option('query', "subtotals"):
+            self.query_configuration["subtotals"] = self.config.getboolean('query', "subtotals")
+
+        self.parquet_configuration = {"enabled": False,
+                                      "codec": DEFAULT_PARQUET_CODEC,
+                                      "row_group_size": DEFAULT_PARQUET_ROW_GROUP_SIZE}
+        if self.config.has_option('parquet', "enabled"):
+            self.parquet_configuration["enabled"] = self.config.getboolean('parquet', "enabled")
+        if self.config.has_option('parquet', "codec"):
+            self.parquet_configuration["codec"] = self.config.get('parquet', "codec")
+        if self.config.has_option('parquet', "row_group_size"):
+            self.parquet_configuration["row_group_size"] = self.config.getint('parquet', "row_group_size")
 
     def get_table_mapping(self, mapping):
         if self.config.has_option('table_mappings', mapping):
@@ -52,6 +207,51 @@ class Config:
     def get_storage_configuration(self):
         return self.storage_configuration
 
+    def get_concurrency_configuration(self):
+        return self.concurrency_configuration
+
+    def get_scratch_configuration(self):
+        return self.scratch_configuration
+
+    def get_pool_configuration(self):
+        return self.pool_configuration
+
+    def get_fetch_configuration(self):
+        return self.fetch_configuration
+
+    def get_partition_configuration(self):
+        return self.partition_configuration
+
+    def get_cache_configuration(self):
+        return self.cache_configuration
+
+    def get_query_configuration(self):
+        return self.query_configuration
+
+    def get_parquet_configuration(self):
+        return self.parquet_configuration
+
+    def get_rollups(self):
+        """
+        Gets the pre-aggregated rollup tables declared in [rollup.<table name>] sections
+        :return: a list of dicts with the rollup table name, the base table it is built from,
+        the columns it is grouped by, the measures it sums, and its approximate number of rows
+        if known (None otherwise)
+        """
+        rollups = []
+        for section in self.config.sections():
+            if not section.startswith(ROLLUP_SECTION_PREFIX):
+                continue
+            rollup = {"name": section[len(ROLLUP_SECTION_PREFIX):],
+                      "base_table": self.config.get(section, "base_table"),
+                      "columns": split_lines(self.config.get(section, "columns")),
+                      "measures": split_lines(self.config.get(section, "measures")),
+                      "rows": None}
+            if self.config.has_option(section, "rows"):
+                rollup["rows"] = self.config.getint(section, "rows")
+            rollups.append(rollup)
+        return rollups
+
     def get_mapped_metadata_path(self, datasource_name):
         if self.config.has_option("datasource_mappings", datasource_name):
             return self.config.get("datasource_mappings", datasource_name)
@@ -68,6 +268,36 @@ class Config:
         else:
             return DEFAULT_OUTPUT_TYPE
 
+    def get_streaming_excel(self):
+        if self.config.has_option("output", "streaming_excel"):
+            return self.config.getboolean("output", "streaming_excel")
+        else:
+            return True
+
+    def get_pivot_cache_records(self):
+        if self.config.has_option("output", "pivot_cache_records"):
+            return self.config.getboolean("output", "pivot_cache_records")
+        else:
+            return True
+
+    def get_runner_type(self):
+        if self.config.has_option("runner", "type"):
+            return self.config.get("runner", "type")
+        else:
+            return DEFAULT_RUNNER_TYPE
+
+    def get_sqlite_configuration(self):
+        """
+        Gets the settings for the SQLite query runner
+        :return: a dict with the database path, and optionally the table, setup script
+        and CSV data file used to load the table if it doesn't exist yet
+        """
+        sqlite_configuration = {"database": ":memory:", "table": None, "setup_script": None, "data_file": None}
+        for option in sqlite_configuration.keys():
+            if self.config.has_option("sqlite", option):
+                sqlite_configuration[option] = self.config.get("sqlite", option)
+        return sqlite_configuration
+
     def get_output_manifests_to_s3(self):
         if self.config.has_option("output", "output_manifest_to_s3"):
             return self.config.getboolean("output", "output_manifest_to_s3")
@@ -76,3 +306,4 @@ class Config:
 
 
 _config = Config()
+
@@ -0,0 +1,143 @@
+import logging
+import threading
+import time
+try:
+    import pyodbc  # Note this is included in a Lambda layer so is omitted from requirements.txt
+except ImportError:
+    pyodbc = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Module-level pool of ODBC connections. The pools live as long as the process,
+so they are reused across orders in __main__.main and across warm invocations
+of the Lambda handler.
+"""
+
+HEALTH_CHECK_QUERY = "SELECT 1"
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+class ConnectionPool(object):
+    """
+    A thread-safe pool of ODBC connections for a single connection string.
+    Up to 'max_idle' idle connections are kept open between uses; connections
+    idle for longer than 'idle_timeout' seconds are closed rather than reused.
+    The pool doesn't limit the number of connections open at once, which is
+    set by the database_slot semaphore around database work.
+    """
+
+    def __init__(self, conn, max_idle=5, idle_timeout=300, health_check=True):
+        """
+        Create an empty pool; connections are opened on demand
+        :param conn: the ODBC connection string
+        :param max_idle: the maximum number of idle connections to keep open
+        :param idle_timeout: seconds an idle connection is kept before being closed
+        :param health_check: whether to test idle connections before handing them out
+        """
+        self.conn = conn
+        self.max_idle = max_idle
+        self.idle_timeout = idle_timeout
+        self.health_check = health_check
+        self.idle = []
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Get a connection from the pool, opening a new one if there are no
+        healthy idle connections. Raises a pyODBC Error if connection fails.
+        :return: a pyodbc connection
+        """
+        self.evict_idle()
+        while True:
+            with self.lock:
+                if len(self.idle) == 0:
+                    break
+                connection, last_used = self.idle.pop()
+            if self.__is_healthy__(connection):
+                return connection
+            logger.info("Discarding unhealthy pooled database connection")
+            self.__close__(connection)
+        logger.debug("Opening new database connection")
+        return pyodbc.connect(self.conn)
+
+    def release(self, connection, discard=False):
+        """
+        Return a connection to the pool. The connection is closed instead if it is
+        broken, the caller asks for it to be discarded, or the pool is already full.
+        :param connection: the connection to return
+        :param discard: True to close the connection rather than keep it
+        :return: None
+        """
+        if not discard:
+            try:
+                # Make sure no transaction state leaks into the next order
+                connection.rollback()
+            except pyodbc.Error:
+                discard = True
+        if not discard:
+            with self.lock:
+                if len(self.idle) < self.max_idle:
+                    self.idle.append((connection, time.monotonic()))
+                    return
+        self.__close__(connection)
+
+    def evict_idle(self):
+        """
+        Closes any connections that have been idle for longer than the idle timeout
+        :return: None
+        """
+        now = time.monotonic()
+        with self.lock:
+            expired = [c for c, last_used in self.idle if now - last_used > self.idle_timeout]
+            self.idle = [(c, last_used) for c, last_used in self.idle if now - last_used <= self.idle_timeout]
+        for connection in expired:
+            logger.debug("Closing idle database connection")
+            self.__close__(connection)
+
+    def close_all(self):
+        """
+        Closes all idle connections in the pool
+        :return: None
+        """
+        with self.lock:
+            connections = [c for c, last_used in self.idle]
+            self.idle = []
+        for connection in connections:
+            self.__close__(connection)
+
+    def __is_healthy__(self, connection):
+        if not self.health_check:
+            return True
+        try:
+            cursor = connection.cursor()
+            cursor.execute(HEALTH_CHECK_QUERY).fetchall()
+            cursor.close()
+            return True
+        except pyodbc.Error:
+            return False
+
+    def __close__(self, connection):
+        try:
+            connection.close()
+        except pyodbc.Error as e:
+            logger.debug(e)
+
+
+def get_connection_pool(config):
+    """
+    Gets the process-wide connection pool for the connection string in the
+    configuration, creating it on first use
+    :param config: the Config object to use
+    :return: a ConnectionPool
+    """
+    with _pools_lock:
+        if config.conn not in _pools:
+            pool_configuration = config.get_pool_configuration()
+            _pools[config.conn] = ConnectionPool(config.conn,
+                                                 max_idle=pool_configuration['max_idle'],
+                                                 idle_timeout=pool_configuration['idle_timeout'],
+                                                 health_check=pool_configuration['health_check'])
+        return _pools[config.conn]
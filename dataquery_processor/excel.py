@@ -1,15 +1,35 @@
+import io
 import logging
+import pickle
+import posixpath
+import re
+import shutil
+import tempfile
+import threading
+import zipfile
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
 
 from openpyxl import load_workbook
-from dataquery_processor import get_config_path
+from openpyxl.utils import get_column_letter, range_boundaries
+from openpyxl.pivot.cache import CacheField, SharedItems
+from openpyxl.pivot.fields import Index, Missing, Number, Text
+from openpyxl.pivot.record import RecordList
+from openpyxl.pivot.table import PivotField, DataField, RowColField, RowColItem, Location
+from dataquery_processor import get_config_path, _config
+from dataquery_processor.query_runner import fetch_batches
+from dataquery_processor.query_builder import get_manifest_measures
 import csv
 import os
 from datetime import date
+from decimal import Decimal
+
+logger = logging.getLogger(__name__)
 
 
 def rotate_list(list_1, n):
     """
-    Rotates a list n positions. Used to push measure to the front of the data
+    Rotates a list n positions. Used to push measures to the front of the data
     :param list_1: the list to rotate
     :param n: number of positions to rotate
     :return: rotated list
@@ -17,18 +37,372 @@ def rotate_list(list_1, n):
     return (list_1[-n:] + list_1[:-n])
 
 
+def format_total(total):
+    """
+    Formats a total for display, without a decimal point if it is a whole number
+    :param total: the total
+    :return: the formatted total
+    """
+    if isinstance(total, float) and total.is_integer():
+        return str(int(total))
+    return str(total)
+
+
+SPREADSHEET_NAMESPACE = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+RELATIONSHIP_NAMESPACE = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+PACKAGE_RELATIONSHIP_NAMESPACE = 'http://schemas.openxmlformats.org/package/2006/relationships'
+PIVOT_CACHE_DEFINITION_RELATIONSHIP = RELATIONSHIP_NAMESPACE + '/pivotCacheDefinition'
+PIVOT_CACHE_RECORDS_RELATIONSHIP = RELATIONSHIP_NAMESPACE + '/pivotCacheRecords'
+ILLEGAL_XML_CHARACTERS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f]')
+COPY_BUFFER_SIZE = 1024 * 1024
+# The most rows an Excel worksheet can hold, including the header
+MAX_WORKSHEET_ROWS = 1048576
+
+
+def format_cell(reference, value, attributes=''):
+    """
+    Formats a worksheet cell as XML, using an inline string for text
+    :param reference: the cell reference, e.g. B6
+    :param value: the cell value; None or an empty string for an empty cell
+    :param attributes: any other attributes for the cell, e.g. its style
+    :return: the cell XML
+    """
+    if value is None or value == '':
+        return '<c r="' + reference + '"' + attributes + ' />'
+    if isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+        return '<c r="' + reference + '"' + attributes + '><v>' + str(value) + '</v></c>'
+    text = escape(ILLEGAL_XML_CHARACTERS.sub('', str(value)))
+    return '<c r="' + reference + '"' + attributes + ' t="inlineStr"><is><t xml:space="preserve">' + text + \
+        '</t></is></c>'
+
+
+class MeasureSharedItems(SharedItems):
+    """
+    Shared items for a numeric cache field whose values are held in the cache records
+    rather than listed, so there is no item count
+    """
+
+    __attrs__ = tuple(attribute for attribute in SharedItems.__attrs__ if attribute != 'count')
+    __elements__ = SharedItems.__elements__
+    __nested__ = SharedItems.__nested__
+
+
+class PivotCacheWriter(object):
+    """
+    Writes the records for a pivot cache one row at a time, collecting the shared items for
+    each field as it goes, so that the pivot can be opened without Excel refreshing it from
+    the Data sheet. Values of the measures are held in the records; values of the other
+    fields are listed once in the cache definition and the records refer to them by index.
+    """
+
+    def __init__(self, file, headers, measure_count):
+        """
+        :param file: a file object opened for writing text
+        :param headers: the Data sheet headers, with the measures first
+        :param measure_count: the number of measures
+        """
+        self.file = file
+        self.headers = headers
+        self.measure_count = measure_count
+        self.records = 0
+        self.items = [{} for _ in headers[measure_count:]]
+        self.minimums = [None] * measure_count
+        self.maximums = [None] * measure_count
+        self.blanks = [False] * measure_count
+        self.file.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        '<pivotCacheRecords xmlns="' + SPREADSHEET_NAMESPACE + '" xmlns:r="' +
+                        RELATIONSHIP_NAMESPACE + '">')
+
+    def write_row(self, row):
+        """
+        :param row: a row of the Data sheet, with the measures first
+        """
+        self.records += 1
+        values = []
+        for index in range(self.measure_count):
+            value = row[index]
+            if value is None or value == '':
+                self.blanks[index] = True
+                values.append('<m/>')
+                continue
+            if self.minimums[index] is None or value < self.minimums[index]:
+                self.minimums[index] = value
+            if self.maximums[index] is None or value > self.maximums[index]:
+                self.maximums[index] = value
+            values.append('<n v="' + str(value) + '"/>')
+        for items, value in zip(self.items, row[self.measure_count:]):
+            if value == '':
+                value = None
+            position = items.get(value)
+            if position is None:
+                position = items[value] = len(items)
+            values.append('<x v="' + str(position) + '"/>')
+        self.file.write('<r>' + ''.join(values) + '</r>')
+
+    def close(self):
+        self.file.write('</pivotCacheRecords>')
+
+    def get_cache_fields(self):
+        """
+        Gets the cache fields for the cache definition, with their shared items
+        :return: a list of CacheField
+        """
+        cache_fields = []
+        for index, header in enumerate(self.headers[:self.measure_count]):
+            numbers = self.minimums[index] is not None
+            cache_fields.append(CacheField(name=header, sharedItems=MeasureSharedItems(
+                containsSemiMixedTypes=self.blanks[index], containsString=False, containsNumber=numbers,
+                containsBlank=self.blanks[index] or None,
+                minValue=self.minimums[index] if numbers else None,
+                maxValue=self.maximums[index] if numbers else None)))
+        for header, items in zip(self.headers[self.measure_count:], self.items):
+            shared_items = []
+            strings = False
+            numbers = []
+            for value in items:
+                if value is None:
+                    shared_items.append(Missing())
+                elif isinstance(value, (int, float, Decimal)) and not isinstance(value, bool):
+                    shared_items.append(Number(v=value))
+                    numbers.append(value)
+                else:
+                    shared_items.append(Text(v=ILLEGAL_XML_CHARACTERS.sub('', str(value))))
+                    strings = True
+            blank = None in items
+            cache_fields.append(CacheField(name=header, sharedItems=SharedItems(
+                _fields=shared_items, containsSemiMixedTypes=strings or blank, containsString=strings,
+                containsNumber=len(numbers) > 0 or None, containsMixedTypes=(strings and len(numbers) > 0) or None,
+                containsBlank=blank or None, minValue=min(numbers) if numbers else None,
+                maxValue=max(numbers) if numbers else None)))
+        return cache_fields
+
+
+class DataSheetWriter(object):
+    """
+    Writes worksheet XML for a Data sheet one row at a time, using inline strings,
+    so memory use doesn't depend on the number of rows
+    """
+
+    def __init__(self, file):
+        """
+        :param file: a file object opened for writing text
+        """
+        self.file = file
+        self.rows = 0
+        self.file.write('<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+                        '<worksheet xmlns="' + SPREADSHEET_NAMESPACE + '"><sheetData>')
+
+    def write_row(self, row):
+        self.rows += 1
+        row_number = str(self.rows)
+        cells = [format_cell(get_column_letter(index + 1) + row_number, value)
+                 for index, value in enumerate(row) if value is not None]
+        self.file.write('<row r="' + row_number + '">' + ''.join(cells) + '</row>')
+
+    def close(self):
+        self.file.write('</sheetData></worksheet>')
+
+
+def get_worksheet_path(xlsx_file, sheet_name):
+    """
+    Finds the part in an xlsx package that holds a worksheet
+    :param xlsx_file: an open ZipFile for the workbook
+    :param sheet_name: the worksheet name
+    :return: the path of the worksheet XML within the package
+    """
+    workbook = ElementTree.fromstring(xlsx_file.read('xl/workbook.xml'))
+    relationship_id = None
+    for sheet in workbook.iter('{' + SPREADSHEET_NAMESPACE + '}sheet'):
+        if sheet.get('name') == sheet_name:
+            relationship_id = sheet.get('{' + RELATIONSHIP_NAMESPACE + '}id')
+    relationships = ElementTree.fromstring(xlsx_file.read('xl/_rels/workbook.xml.rels'))
+    for relationship in relationships.iter('{' + PACKAGE_RELATIONSHIP_NAMESPACE + '}Relationship'):
+        if relationship.get('Id') == relationship_id:
+            target = relationship.get('Target')
+            return target[1:] if target.startswith('/') else 'xl/' + target
+    raise ValueError("There is no worksheet named " + sheet_name)
+
+
+def get_related_part(xlsx_file, part, relationship_type):
+    """
+    Finds the first part in an xlsx package that another part has a relationship to
+    :param xlsx_file: an open ZipFile for the workbook
+    :param part: the path of the part within the package
+    :param relationship_type: the relationship type
+    :return: the path of the related part within the package
+    """
+    folder, name = posixpath.split(part)
+    relationships = ElementTree.fromstring(xlsx_file.read(posixpath.join(folder, '_rels', name + '.rels')))
+    for relationship in relationships.iter('{' + PACKAGE_RELATIONSHIP_NAMESPACE + '}Relationship'):
+        if relationship.get('Type') == relationship_type:
+            target = relationship.get('Target')
+            return target[1:] if target.startswith('/') else posixpath.normpath(posixpath.join(folder, target))
+    raise ValueError("There is no " + relationship_type + " part for " + part)
+
+
+def get_pivot_cache_records_path(xlsx_file):
+    """
+    Finds the part in an xlsx package that holds the records of the workbook's pivot cache
+    :param xlsx_file: an open ZipFile for the workbook
+    :return: the path of the records XML within the package
+    """
+    definition = get_related_part(xlsx_file, 'xl/workbook.xml', PIVOT_CACHE_DEFINITION_RELATIONSHIP)
+    return get_related_part(xlsx_file, definition, PIVOT_CACHE_RECORDS_RELATIONSHIP)
+
+
+def replace_parts(filename, parts):
+    """
+    Replaces parts of a saved workbook, e.g. the XML for a worksheet, copying the package part
+    by part so that neither the workbook nor the new parts are held in memory
+    :param filename: the xlsx file
+    :param parts: a dict of the path of each part to replace within the package, and the file
+    containing its new content
+    :return: None
+    """
+    handle, temp_filename = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)), suffix='.xlsx')
+    os.close(handle)
+    try:
+        with zipfile.ZipFile(filename) as source, \
+                zipfile.ZipFile(temp_filename, 'w', compression=zipfile.ZIP_DEFLATED) as target:
+            for item in source.infolist():
+                with target.open(item.filename, 'w', force_zip64=True) as target_part:
+                    if item.filename in parts:
+                        with open(parts[item.filename], 'rb') as source_part:
+                            shutil.copyfileobj(source_part, target_part, COPY_BUFFER_SIZE)
+                    else:
+                        with source.open(item) as source_part:
+                            shutil.copyfileobj(source_part, target_part, COPY_BUFFER_SIZE)
+        os.replace(temp_filename, filename)
+    finally:
+        if os.path.exists(temp_filename):
+            os.remove(temp_filename)
+
+
+_templates = {}
+_templates_lock = threading.Lock()
+
+
+def get_blank_template(template):
+    """
+    Gets a template workbook with an empty Data sheet, parsed once per process. openpyxl
+    workbooks can't be deep copied, so the parsed workbook is kept pickled and each order
+    unpickles its own copy, which is several times faster than parsing the template again.
+    :param template: the path to the template
+    :return: the pickled workbook
+    """
+    with _templates_lock:
+        if template not in _templates:
+            workbook = load_workbook(template)
+            sheet_name = 'Data'
+            idx = workbook.sheetnames.index(sheet_name)
+            ws = workbook[sheet_name]
+            workbook.remove(ws)
+            workbook.create_sheet(sheet_name, idx)
+            _templates[template] = pickle.dumps(workbook)
+        return _templates[template]
+
+
+_notes_templates = {}
+CELL_STYLE_PATTERN = re.compile(r' s="\d+"')
+
+
+def get_notes_template(template):
+    """
+    Gets the parts of a workbook with only the Notes sheet, built from the template once per process
+    :param template: the path to the template
+    :return: a tuple of the notes worksheet path and a list of (part name, content) tuples
+    """
+    with _templates_lock:
+        if template not in _notes_templates:
+            workbook = load_workbook(template)
+            workbook.remove(workbook['Data'])
+            workbook.remove(workbook['Pivot'])
+            buffer = io.BytesIO()
+            workbook.save(buffer)
+            with zipfile.ZipFile(buffer) as package:
+                parts = [(name, package.read(name)) for name in package.namelist()]
+                _notes_templates[template] = (get_worksheet_path(package, 'Notes'), parts)
+        return _notes_templates[template]
+
+
+def set_cell(sheet, reference, value):
+    """
+    Sets the value of a cell in worksheet XML, keeping its style
+    :param sheet: the worksheet XML
+    :param reference: the cell reference, e.g. B6
+    :param value: the new value
+    :return: the updated worksheet XML
+    :raises ValueError: if the worksheet has no such cell
+    """
+    match = re.search(r'<c r="' + reference + r'"[^>]*?(?:/>|>.*?</c>)', sheet)
+    if match is None:
+        raise ValueError("There is no cell " + reference + " in the worksheet")
+    style = CELL_STYLE_PATTERN.search(match.group(0)[:match.group(0).index('>')])
+    cell = format_cell(reference, value, style.group(0) if style is not None else '')
+    return sheet[:match.start()] + cell + sheet[match.end():]
+
+
+def write_notes_workbook(template, filename, cells):
+    """
+    Writes a workbook with only the Notes sheet by patching cells into the XML of a precompiled
+    copy of the template, rather than loading and saving the template with openpyxl
+    :param template: the path to the template
+    :param filename: the xlsx file to write
+    :param cells: a list of (cell reference, value) tuples
+    :return: None
+    :raises ValueError: if any of the cells isn't in the template's Notes sheet
+    """
+    notes_path, parts = get_notes_template(template)
+    sheet = dict(parts)[notes_path].decode('utf-8')
+    for reference, value in cells:
+        sheet = set_cell(sheet, reference, value)
+    with zipfile.ZipFile(filename, 'w', compression=zipfile.ZIP_DEFLATED) as package:
+        for name, content in parts:
+            package.writestr(name, sheet.encode('utf-8') if name == notes_path else content)
+
+
+class DataSheetSink(object):
+    """
+    Writes the rows of a query to the Data sheet of an ExcelHandler as they are fetched,
+    with the measures moved to the front, and adds up the totals
+    """
+
+    def __init__(self, excel_handler, data_sheet_file):
+        self.excel_handler = excel_handler
+        self.file = open(data_sheet_file, 'w', encoding='utf-8')
+        self.writer = DataSheetWriter(self.file)
+
+    def write_header(self, headers):
+        self.excel_handler.__set_headers__(headers)
+        self.writer.write_row(self.excel_handler.headers)
+
+    def write_rows(self, rows):
+        for row in rows:
+            data_row = self.excel_handler.__add_row__(list(row))
+            if data_row is not None:
+                self.writer.write_row(data_row)
+
+    def close(self):
+        if not self.file.closed:
+            self.writer.close()
+            self.file.close()
+
+
 class ExcelHandler(object):
     """
     Class for creating Excel outputs
     """
 
-    def __init__(self, output_file=None, csv_file=None, manifest=None):
+    def __init__(self, output_file=None, csv_file=None, manifest=None, config=_config, totals=None):
         """
         Set up the handler
 
         :param output_file: the output path for the Excel pivot
         :param csv_file: the CSV data file to use as the basis for the Excel output
         :param manifest: the request manifest that includes column metadata
+        :param config: the Config object to use
+        :param totals: the total for each measure if already calculated by the query;
+        otherwise they are added up while populating the Data sheet
         """
         self.csv_file = csv_file
         self.filepath = output_file
@@ -37,7 +411,17 @@ class ExcelHandler(object):
         self.rows = None
         self.cols = None
         self.manifest = manifest
-        self.total = 0
+        self.config = config
+        self.streaming = config.get_streaming_excel()
+        self.measures = get_manifest_measures(manifest, config=config) if manifest is not None else []
+        self.headers = None
+        self.pivot_cache = None
+        self.server_totals = totals is not None
+        if self.server_totals:
+            self.totals = [total if total is not None else 0 for total in totals]
+        else:
+            self.totals = [0] * max(1, len(self.measures))
+        self.total = self.totals[0]
         self.__create_blank_workbook_from_template__()
 
     def create_notes_only(self, filename=None):
@@ -46,36 +430,153 @@ class ExcelHandler(object):
         :param filename: the path/filename to save the notes file
         :return:
         """
-        self.__update_notes__(format='CSV')
-        self.workbook.remove(self.workbook.get_sheet_by_name('Data'))
-        self.workbook.remove(self.workbook.get_sheet_by_name('Pivot'))
-        if filename is not None:
-            self.workbook.save(filename=filename)
-        else:
-            self.workbook.save(filename=self.filepath)
+        if filename is None:
+            filename = self.filepath
+        try:
+            write_notes_workbook(self.template, filename, self.__get_notes__(format=self.__get_csv_format__()))
+        except ValueError as e:
+            # e.g. more fields than the template has rows for; fall back to openpyxl, which adds cells as needed.
+            # A copy of the template is used so that the pivot workbook can be built at the same time.
+            logger.debug(e)
+            workbook = pickle.loads(get_blank_template(self.template))
+            self.__update_notes__(format=self.__get_csv_format__(), workbook=workbook)
+            workbook.remove(workbook['Data'])
+            workbook.remove(workbook['Pivot'])
+            workbook.save(filename=filename)
 
     def create_workbook(self):
         """
         Creates a workbook from a CSV file, including pivot table and notes
-        :return:
+        :return: True if the workbook was created, or False if the data has more rows than
+        an Excel worksheet can hold, in which case the data is only delivered as CSV
         """
         if self.csv_file is not None:
+            if self.streaming:
+                return self.__create_streaming_workbook__()
             self.__populate_worksheet_from_csv_file__()
+            return self.__save_workbook__()
+        return False
+
+    def fits_in_worksheet(self):
+        """
+        Checks whether the data fits in the Data sheet, once the rows have been written
+        :return: False if there are more rows than an Excel worksheet can hold
+        """
+        return self.rows is None or self.rows <= MAX_WORKSHEET_ROWS
+
+    def create_data_sheet_sink(self):
+        """
+        Creates a sink that writes the Data sheet as rows are fetched from a query,
+        for use with QueryRunner.run_query_and_save_results. Once the query has been
+        run, call create_workbook_from_data_sheet to create the workbook.
+        :return: a DataSheetSink
+        """
+        return DataSheetSink(self, self.__get_data_sheet_file__())
+
+    def create_workbook_from_data_sheet(self):
+        """
+        Creates the workbook from a Data sheet already written by a DataSheetSink, including
+        pivot table and notes. The Data sheet XML is spliced into the saved template, so memory
+        use stays flat however many rows there are.
+        :return: True if the workbook was created, or False if the data has more rows than
+        an Excel worksheet can hold
+        """
+        data_sheet_file = self.__get_data_sheet_file__()
+        try:
+            return self.__save_workbook__(data_sheet_file=data_sheet_file)
+        finally:
+            if os.path.exists(data_sheet_file):
+                os.remove(data_sheet_file)
+
+    def set_totals(self, totals):
+        """
+        Sets the total for each measure, e.g. when calculated by the query
+        :param totals: a list with the total for each measure
+        :return: None
+        """
+        self.server_totals = True
+        self.totals = [total if total is not None else 0 for total in totals]
+        self.total = self.totals[0]
+
+    def use_query_totals(self):
+        """
+        Stops the rows being added up for the totals, as the query calculates them and they
+        will be set with set_totals once it has run
+        :return: None
+        """
+        self.server_totals = True
+
+    def __get_data_sheet_file__(self):
+        return self.filepath + '.data.xml'
+
+    def __get_pivot_cache_file__(self):
+        return self.filepath + '.records.xml'
+
+    def __get_csv_format__(self):
+        if self.fits_in_worksheet():
+            return 'CSV'
+        return 'CSV only - the {:,} rows of data are more than an Excel worksheet can hold'.format(self.rows - 1)
+
+    def __save_workbook__(self, data_sheet_file=None):
+        """
+        Saves the workbook with its pivot table and notes, splicing in the Data sheet and pivot
+        cache records if they were written as XML. Nothing is saved if there are too many rows.
+        :param data_sheet_file: the Data sheet XML written by a DataSheetSink, if any
+        :return: True if the workbook was saved
+        """
+        try:
+            if not self.fits_in_worksheet():
+                logger.warning("There are " + str(self.rows - 1) + " rows, too many for an Excel worksheet, " +
+                               "so the data will only be delivered as CSV")
+                return False
             self.__update_pivot_table__()
             self.__update_notes__()
             self.workbook.save(filename=self.filepath)
+            parts = {}
+            with zipfile.ZipFile(self.filepath) as package:
+                if data_sheet_file is not None:
+                    parts[get_worksheet_path(package, 'Data')] = data_sheet_file
+                if self.pivot_cache is not None:
+                    parts[get_pivot_cache_records_path(package)] = self.__get_pivot_cache_file__()
+            if len(parts) > 0:
+                replace_parts(self.filepath, parts)
+            return True
+        finally:
+            self.__close_pivot_cache__()
+
+    def __close_pivot_cache__(self):
+        if self.pivot_cache is not None:
+            if not self.pivot_cache.file.closed:
+                self.pivot_cache.close()
+                self.pivot_cache.file.close()
+        pivot_cache_file = self.__get_pivot_cache_file__() if self.filepath is not None else None
+        if pivot_cache_file is not None and os.path.exists(pivot_cache_file):
+            os.remove(pivot_cache_file)
+
+    def __create_streaming_workbook__(self):
+        """
+        Creates a workbook with the Data sheet written straight from the CSV file as XML
+        :return: True if the workbook was created, or False if the data has more rows than
+        an Excel worksheet can hold, in which case there is no workbook and the data is CSV only
+        """
+        if not os.path.exists(self.csv_file):
+            raise ValueError("There is no CSV file to export")
+        sink = self.create_data_sheet_sink()
+        try:
+            with open(self.csv_file, encoding='utf-8') as f:
+                reader = csv.reader(f, quoting=csv.QUOTE_NONNUMERIC)
+                sink.write_header(reader.__next__())
+                sink.write_rows(reader)
+        finally:
+            sink.close()
+        return self.create_workbook_from_data_sheet()
 
     def __create_blank_workbook_from_template__(self):
         """
-        Creates a fresh workbook from a template
+        Creates a fresh workbook from a template, using the copy parsed earlier in this process if there is one
         :return: None
         """
-        self.workbook = load_workbook(self.template)
-        sheet_name = 'Data'
-        idx = self.workbook.sheetnames.index(sheet_name)
-        ws = self.workbook.get_sheet_by_name(sheet_name)
-        self.workbook.remove(ws)
-        self.workbook.create_sheet(sheet_name, idx)
+        self.workbook = pickle.loads(get_blank_template(self.template))
 
     def __populate_worksheet_from_csv_file__(self):
         """
@@ -84,20 +585,18 @@ class ExcelHandler(object):
         """
         if not os.path.exists(self.csv_file):
             raise ValueError("There is no CSV file to export")
-        ws = self.workbook.get_sheet_by_name('Data')
+        ws = self.workbook['Data']
         with open(self.csv_file, encoding='utf-8') as f:
             reader = csv.reader(f, quoting=csv.QUOTE_NONNUMERIC)
             # Header
-            ws.append(rotate_list(reader.__next__(), 1))
+            headers = reader.__next__()
+            self.__set_headers__(headers)
+            ws.append(self.headers)
             for row in reader:
                 if isinstance(row, list):
-                    ws.append(rotate_list(row, 1))
-                    try:
-                        self.total += int(row[len(row)-1])
-                    except ValueError:
-                        logging.warning("There is a row with no measure")
-        self.rows = reader.line_num
-        self.cols = len(row)
+                    data_row = self.__add_row__(row)
+                    if data_row is not None:
+                        ws.append(data_row)
 
     def __populate_worksheet_from_odbc_cursor__(self, cursor=None, headers=None):
         """
@@ -106,51 +605,180 @@ class ExcelHandler(object):
         :param headers: a list of headers
         :return: None
         """
-        self.rows = 0
-        self.cols = len(headers)
-        ws = self.workbook.get_sheet_by_name('Data')
+        ws = self.workbook['Data']
         # Add header
-        ws.append(rotate_list(headers, 1))
-        for row in cursor.fetchall():
-            row_list = [elem for elem in row]
-            ws.append(rotate_list(row_list, 1))
-            self.rows += 1
-            self.total += int(row[len(row) - 1])
-        self.__update_pivot_table__()
-        self.__update_notes__()
-        self.workbook.save(filename=self.filepath)
+        self.__set_headers__(headers)
+        ws.append(self.headers)
+        fetch_configuration = self.config.get_fetch_configuration()
+        for rows in fetch_batches(cursor, fetch_configuration['batch_size'], fetch_configuration['memory_limit']):
+            for row in rows:
+                data_row = self.__add_row__([elem for elem in row])
+                if data_row is not None:
+                    ws.append(data_row)
+        return self.__save_workbook__()
+
+    def __set_headers__(self, headers):
+        """
+        Sets the column headers for the Data sheet, with the measures moved to the front
+        :param headers: the headers from the query, with the measures last
+        :return: None
+        """
+        self.headers = rotate_list(list(headers), len(self.totals))
+        self.rows = 1
+        self.cols = len(headers)
+        if self.config.get_pivot_cache_records() and self.filepath is not None:
+            self.pivot_cache = PivotCacheWriter(open(self.__get_pivot_cache_file__(), 'w', encoding='utf-8'),
+                                                self.headers, len(self.totals))
+
+    def __add_row__(self, row):
+        """
+        Adds a row to the totals and pivot cache records, and counts it
+        :param row: a row from the query, with the measures last
+        :return: the row for the Data sheet, with the measures first, or None if the Data sheet is full
+        """
+        self.rows += 1
+        self.__add_to_totals__(row)
+        if self.rows > MAX_WORKSHEET_ROWS:
+            return None
+        data_row = rotate_list(row, len(self.totals))
+        if self.pivot_cache is not None:
+            self.pivot_cache.write_row(data_row)
+        return data_row
+
+    def __add_to_totals__(self, row):
+        """
+        Adds the measures at the end of a row to the totals, unless they were calculated by the query
+        :param row: a row from the query, with the measures last
+        :return: None
+        """
+        if self.server_totals:
+            return
+        for index in range(len(self.totals)):
+            value = row[len(row) - len(self.totals) + index]
+            if isinstance(value, Decimal):
+                self.totals[index] += float(value)
+            elif isinstance(value, (int, float)):
+                self.totals[index] += value
+            else:
+                logging.warning("There is a row with no measure")
+        self.total = self.totals[0]
 
     def __update_pivot_table__(self):
         ws = self.workbook["Pivot"]
         pivot = ws._pivots[0]
         # Update the pivot table range
         pivot.cache.cacheSource.worksheetSource.ref = self.__range__()
-        # Set to refresh
+        # Set to refresh, unless the cache records are saved with the workbook
         pivot.cache.refreshOnLoad = True
+        if self.headers is not None:
+            self.__update_pivot_fields__(pivot)
+            if self.pivot_cache is not None:
+                self.__update_pivot_cache__(pivot)
+                self.__update_pivot_layout__(ws, pivot)
+
+    def __update_pivot_fields__(self, pivot):
+        """
+        Replaces the fields in the template pivot table with the columns of the Data sheet,
+        with a Sum data field for each measure. The cache records are cleared, for Excel to
+        rebuild when the workbook is opened unless they were written while populating the Data sheet.
+        :param pivot: the pivot table
+        :return: None
+        """
+        measure_count = len(self.totals)
+        pivot.cache.cacheFields = [CacheField(name=header, sharedItems=SharedItems()) for header in self.headers]
+        pivot.cache.records = None
+        pivot.cache.id = None
+        pivot.cache.recordCount = None
+        pivot.cache.saveData = False
+        pivot.pivotFields = [PivotField(dataField=index < measure_count, compact=False, outline=False, showAll=False)
+                             for index in range(len(self.headers))]
+        pivot.dataFields = [DataField(name="Sum of " + header, fld=index, baseField=0, baseItem=0)
+                            for index, header in enumerate(self.headers[:measure_count])]
+        if measure_count > 1:
+            # Show the measures side by side using the Values pseudo-field
+            pivot.colFields = [RowColField(x=-2)]
+
+    def __update_pivot_cache__(self, pivot):
+        """
+        Sets the cache fields and shared items from the records written while populating the
+        Data sheet, so the pivot doesn't need refreshing when the workbook is opened. The records
+        themselves are spliced into the saved workbook in place of an empty record list.
+        :param pivot: the pivot table
+        :return: None
+        """
+        self.pivot_cache.close()
+        self.pivot_cache.file.close()
+        pivot.cache.cacheFields = self.pivot_cache.get_cache_fields()
+        pivot.cache.records = RecordList()
+        pivot.cache.recordCount = self.pivot_cache.records
+        pivot.cache.saveData = True
+        pivot.cache.refreshOnLoad = False
 
-    def __update_notes__(self, format='Excel pivot table'):
-        ws = self.workbook["Notes"]
-        ws['B6'] = self.manifest['orderRef']
-        ws['B7'] = self.manifest['customerRef']
-        ws['B9'] = 'Jisc Tailored Datasets App v1.0'
-        ws['B11'] = date.today().isoformat()
-        ws['B14'] = self.manifest['datasource']
-        ws['B15'] = self.total
-        ws['B16'] = self.manifest['onwardUseCategory']
-        ws['B17'] = format
+    def __update_pivot_layout__(self, ws, pivot):
+        """
+        Lays out the pivot table as Excel would show it: the sum of each measure, side by side,
+        with no row or column fields. The cells of the template layout are cleared first.
+        :param ws: the Pivot worksheet
+        :param pivot: the pivot table
+        :return: None
+        """
+        min_col, min_row, max_col, max_row = range_boundaries(pivot.location.ref)
+        for row in ws.iter_rows(min_row=min_row, max_row=max_row, min_col=min_col, max_col=max_col):
+            for cell in row:
+                cell.value = None
+        for index, data_field in enumerate(pivot.dataFields):
+            ws.cell(row=min_row, column=min_col + index, value=data_field.name)
+            ws.cell(row=min_row + 1, column=min_col + index, value=self.totals[index])
+        last_column = get_column_letter(min_col + len(pivot.dataFields) - 1)
+        pivot.location = Location(ref=get_column_letter(min_col) + str(min_row) + ':' + last_column + str(min_row + 1),
+                                  firstHeaderRow=1, firstDataRow=1, firstDataCol=0)
+        pivot.rowFields = []
+        pivot.rowItems = [RowColItem()]
+        if len(pivot.dataFields) > 1:
+            pivot.colItems = [RowColItem(i=index, x=[Index(v=index)]) for index in range(len(pivot.dataFields))]
+        else:
+            pivot.colItems = [RowColItem()]
+
+    def __update_notes__(self, format='Excel pivot table', workbook=None):
+        ws = (workbook if workbook is not None else self.workbook)["Notes"]
+        for reference, value in self.__get_notes__(format):
+            ws[reference] = value
+
+    def __get_notes__(self, format='Excel pivot table'):
+        """
+        Gets the cells to fill in on the Notes sheet
+        :param format: the format of the data the notes accompany
+        :return: a list of (cell reference, value) tuples
+        """
+        if len(self.totals) > 1:
+            total = '; '.join(measure + ': ' + format_total(total)
+                              for measure, total in zip(self.measures, self.totals))
+        else:
+            total = self.total
+        cells = [
+            ('B6', self.manifest['orderRef']),
+            ('B7', self.manifest['customerRef']),
+            ('B9', 'Jisc Tailored Datasets App v1.0'),
+            ('B11', date.today().isoformat()),
+            ('B14', self.manifest['datasource']),
+            ('B15', total),
+            ('B16', self.manifest['onwardUseCategory']),
+            ('B17', format)
+        ]
 
         # Field names and definitions
         row = 32
         for item in self.manifest['items']:
             if 'allowedValues' not in item.keys() or len(item['allowedValues']) == 0:
-                ws['A' + str(row)] = item['fieldName']
+                cells.append(('A' + str(row), item['fieldName']))
                 if 'description' in item.keys():
-                    ws['B' + str(row)] = item['description']
+                    cells.append(('B' + str(row), item['description']))
                 row += 1
+        return cells
 
     def __range__(self):
         """
         Determine the cell range based on the dataset size
         :return: a cell range e.g "A1:C26"
         """
-        return 'A1' + ':' + chr(ord('@') + self.cols) + str(self.rows)
\ No newline at end of file
+        return 'A1' + ':' + get_column_letter(self.cols) + str(self.rows)
\ No newline at end of file
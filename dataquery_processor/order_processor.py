@@ -1,9 +1,27 @@
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+import json
 import logging
-from dataquery_processor import QueryBuilder, OdbcQueryRunner, OrderValidator, StorageController, ExcelHandler
+import shutil
+import time
+from dataquery_processor import QueryBuilder, OrderValidator, StorageController, ExcelHandler
 from dataquery_processor import _config
+from dataquery_processor.result_cache import ResultCache
+from dataquery_processor.concurrency import database_slot
+from dataquery_processor.parquet import ParquetSink, require_pyarrow, write_parquet_from_csv
+from dataquery_processor.scratch import ScratchSpace
+from dataquery_processor.query_runner import create_query_runner, run_partitioned_query_and_save_results, \
+    supports_grouping_sets
 logger = logging.getLogger(__name__)
 
+BATCH_QUERY_NOTE = ("-- The results for this order came from batch query {batch}, a GROUPING SETS query\n"
+                    "-- that answered orders {orders} together. This order's own query was not run.\n")
+
+# Where results come from when the order's own query with totals isn't run
+SUBTOTALS_UNAVAILABLE_SOURCES = {"cache": "the result cache",
+                                 "batch": "a batch of coalesced orders",
+                                 "database": "queries partitioned by year"}
+
 
 class OrderProcessor(object):
     """
@@ -11,15 +29,28 @@ class OrderProcessor(object):
     validates and processes the order in the manifest.
     """
 
-    def __init__(self, order, config=_config):
+    def __init__(self, order, config=_config, prefetched_results=None):
+        """
+        :param order: the order manifest
+        :param config: the Config object to use
+        :param prefetched_results: results already obtained for this order by a combined query
+        for a batch, as a dict from BatchPlanner.prefetch; if given, the order's own query is not run
+        """
         self.config = config
         self.order = order
+        self.prefetched_results = prefetched_results
         self.in_progress = True
         self.completed = False
         self.notices = None
         self.output_path = None
         self.resource_path = None
         self.storage_controller = None
+        self.scratch = None
+        self.server_totals = None
+        self.totals = None
+        self.results_source = None
+        self.uploaded_data_file = None
+        self.parquet_written = False
 
     def process(self):
         """
@@ -29,6 +60,12 @@ class OrderProcessor(object):
         """
         logger.info('processing order ' + self.order['orderRef'])
 
+        #
+        # Temporary files for this order are kept in its own scratch folder, which is
+        # removed whether the order completes or is rolled back.
+        #
+        self.scratch = ScratchSpace(self.order['orderRef'], config=self.config)
+
         #
         # Obtain a storage controller for storing the results - this could be for a local
         # file system, mounted file system, MongoDB document store, or Amazon S3 storage, for example.
@@ -36,6 +73,7 @@ class OrderProcessor(object):
         try:
             self.__initialise_storage_controller__()
         except Exception as e:
+            self.scratch.cleanup()
             self.completed = False
             self.in_progress = False
             logger.error("Could not initialise storage")
@@ -57,6 +95,8 @@ class OrderProcessor(object):
             logger.error("An error occurred during processing; the results have been rolled back.")
             logger.debug(e)
             raise e
+        finally:
+            self.scratch.cleanup()
 
     def __initialise_storage_controller__(self):
         """
@@ -72,7 +112,8 @@ class OrderProcessor(object):
             order_reference = 'NoOrderReference'
         if 'customerRef' in self.order and self.order['customerRef'] is not None and self.order['customerRef'].strip() != "":
             customer_ref = self.order['customerRef']
-        self.storage_controller = StorageController(client=client_id, order_reference=order_reference, customer_reference=customer_ref)
+        self.storage_controller = StorageController(client=client_id, order_reference=order_reference,
+                                                    customer_reference=customer_ref)
 
     def __validate_order__(self):
         """
@@ -92,8 +133,16 @@ class OrderProcessor(object):
         :return: None
         """
         logger.info('generating query for order ' + self.order['orderRef'])
-        self.query = QueryBuilder(self.order, config=self.config).create_query()
-        self.storage_controller.store_object_as_text("query.sql", self.query[0])
+        self.query_builder = QueryBuilder(self.order, config=self.config)
+        totals = self.config.get_query_configuration()['server_totals'] and supports_grouping_sets(self.config)
+        self.query = self.query_builder.create_query(totals=totals)
+        sql = self.query[0]
+        if self.prefetched_results is not None:
+            # Store the combined query that was actually run for the order, rather than its own
+            orders = ', '.join(str(order) for order in self.prefetched_results['orders'])
+            sql = BATCH_QUERY_NOTE.format(batch=self.prefetched_results['batch'], orders=orders) + \
+                self.prefetched_results['sql']
+        self.storage_controller.store_object_as_text("query.sql", sql)
 
     def __execute_query__(self):
         """
@@ -103,27 +152,169 @@ class OrderProcessor(object):
         logger.info('executing query for order ' + self.order['orderRef'])
         logger.debug("SQL = " + self.query[0])
         logger.debug("Parameters = " + ','.join(self.query[1]))
-        runner = OdbcQueryRunner(config=self.config)
+        if self.config.get_parquet_configuration()['enabled']:
+            require_pyarrow()
 
-        # Create a temp CSV file
-        runner.run_query_and_save_results(query=self.query, file_name="/tmp/data.csv")
+        data_file = self.scratch.get_path("data.csv")
+        pivot_file = self.scratch.get_path("pivot.xlsx")
+        notes_file = self.scratch.get_path("notes.xlsx")
+        parquet_file = self.scratch.get_path("data.parquet")
 
-        # Build Excel versions
-        excel_handler = ExcelHandler(manifest=self.order, output_file='/tmp/pivot.xlsx', csv_file="/tmp/data.csv")
-        excel_handler.create_workbook()
-        self.storage_controller.store_file(filename='pivot.xlsx', file_to_store='/tmp/pivot.xlsx')
-        excel_handler.create_notes_only('/tmp/notes.xlsx')
-        self.storage_controller.store_file(filename='notes.xlsx', file_to_store='/tmp/notes.xlsx')
+        # The Data sheet of the pivot is written as the query results are fetched, if the query is run here
+        excel_handler = ExcelHandler(manifest=self.order, output_file=pivot_file, csv_file=data_file,
+                                     config=self.config)
 
-        # Store the CSV
-        self.storage_controller.store_file(filename='data.csv', file_to_store='/tmp/data.csv')
+        # Create a temp CSV file, from the result cache if this query has been run recently
+        result_cache = ResultCache(config=self.config)
+        cache_key = result_cache.make_key(self.query_builder, self.query)
+        data_sheet_written = False
+        if self.prefetched_results is not None:
+            shutil.move(self.prefetched_results['file'], data_file)
+            result_cache.put(cache_key, data_file)
+            query_stats = {"source": "batch", "batchQuery": self.prefetched_results['batch'],
+                           "batchOrders": self.prefetched_results['orders']}
+        elif result_cache.get(cache_key, data_file):
+            query_stats = {"source": "cache"}
+        else:
+            statistics, data_sheet_written = self.__run_query__(data_file, excel_handler=excel_handler,
+                                                                parquet_file=parquet_file)
+            if self.uploaded_data_file is None:
+                result_cache.put(cache_key, data_file)
+            query_stats = dict(source="database", **statistics.as_dict())
+        self.results_source = query_stats['source']
+        self.scratch.report('after query')
+
+        # Build Excel versions
+        # Totals come from the query if it calculated them, otherwise they are added up while writing the workbook
+        if self.server_totals is not None:
+            excel_handler.set_totals(self.server_totals['total'])
+        query_stats['artifacts'] = self.__create_artifacts__(excel_handler, data_sheet_written, data_file,
+                                                             pivot_file, notes_file, parquet_file)
+        self.totals = dict(zip(excel_handler.measures, excel_handler.totals))
+        self.scratch.report('after creating workbook')
+        self.__write_query_stats__(query_stats)
 
         # Save the filename
-        self.output_filename = self.storage_controller.get_resource_path("data.csv")
+        self.output_filename = self.storage_controller.get_resource_path(self.uploaded_data_file or "data.csv")
 
         # Add completion stamp
         self.job_completed = datetime.now()
 
+    def __create_artifacts__(self, excel_handler, data_sheet_written, data_file, pivot_file, notes_file,
+                             parquet_file=None):
+        """
+        Builds the pivot and notes workbooks and stores them along with the CSV, unless it was
+        uploaded while the query ran, using a pool of threads so that each is stored as soon as it
+        is ready. The notes need the totals and row count, and the CSV can't be stored until nothing
+        else needs to read it, so unless the Data sheet was written while the query ran these wait
+        for the pivot to be built. If Parquet output is enabled, data.parquet is stored too; if it
+        wasn't written while the query ran, the CSV is converted before it is stored.
+        :param excel_handler: the ExcelHandler for the pivot
+        :param data_sheet_written: whether the Data sheet was written while the query ran
+        :param data_file: the CSV file of results
+        :param pivot_file: the path for the pivot workbook
+        :param notes_file: the path for the notes workbook
+        :param parquet_file: the path for the Parquet file
+        :return: a dict of the seconds taken to build and store each artifact
+        """
+        timings = {}
+
+        def timed(artifact, step, function, *args):
+            started = time.monotonic()
+            result = function(*args)
+            timings.setdefault(artifact, {})[step + 'Seconds'] = round(time.monotonic() - started, 3)
+            return result
+
+        def build_pivot():
+            # If there are too many rows for a worksheet there is no pivot, and the notes say the data is CSV only
+            if data_sheet_written:
+                return timed('pivot.xlsx', 'build', excel_handler.create_workbook_from_data_sheet)
+            return timed('pivot.xlsx', 'build', excel_handler.create_workbook)
+
+        def create_notes():
+            timed('notes.xlsx', 'build', excel_handler.create_notes_only, notes_file)
+            store('notes.xlsx', notes_file)
+
+        def build_parquet():
+            if not self.parquet_written:
+                timed('data.parquet', 'build', write_parquet_from_csv, data_file, parquet_file,
+                      len(self.query_builder.measures), self.config)
+
+        def store(artifact, file):
+            timed(artifact, 'store', self.storage_controller.store_file, artifact, file)
+
+        with ThreadPoolExecutor(max_workers=self.config.get_concurrency_configuration()['artifacts']) as executor:
+            pivot_built = executor.submit(build_pivot)
+            if not data_sheet_written:
+                pivot_built.result()
+            futures = [executor.submit(create_notes)]
+            if self.config.get_parquet_configuration()['enabled']:
+                # Storing the CSV may move it, so it has to be converted first
+                executor.submit(build_parquet).result()
+                futures.append(executor.submit(store, 'data.parquet', parquet_file))
+            if self.uploaded_data_file is None:
+                futures.append(executor.submit(store, 'data.csv', data_file))
+            if pivot_built.result():
+                futures.append(executor.submit(store, 'pivot.xlsx', pivot_file))
+            for future in futures:
+                future.result()
+        return timings
+
+    def __run_query__(self, data_file, excel_handler=None, parquet_file=None):
+        """
+        Runs the query against the database and saves the results. Orders for more than one
+        year are split into a query per year if partitioning is enabled. Otherwise, the Data
+        sheet of the Excel pivot and the Parquet file are written at the same time if enabled.
+        :param data_file: the CSV file to save the results to
+        :param excel_handler: the ExcelHandler for the pivot
+        :param parquet_file: the Parquet file to save the results to if Parquet output is enabled
+        :return: FetchStatistics for the query, and whether the Data sheet was written. If the CSV
+        was uploaded while the query ran, self.uploaded_data_file is set to its file name, and if
+        the Parquet file was written, self.parquet_written is set.
+        """
+        if self.config.get_partition_configuration()['enabled'] and len(self.query_builder.get_year_starts()) > 1:
+            statistics = run_partitioned_query_and_save_results(self.query_builder.create_partitioned_queries(),
+                                                                data_file, config=self.config,
+                                                                measures=len(self.query_builder.measures))
+            return statistics, False
+        # The totals are calculated by the query, so the workbook doesn't need to add up every row
+        if excel_handler is not None and len(self.query) > 3:
+            excel_handler.use_query_totals()
+        sinks = []
+        data_sheet_written = False
+        with database_slot(self.config):
+            runner = create_query_runner(config=self.config)
+            try:
+                if parquet_file is not None and self.config.get_parquet_configuration()['enabled']:
+                    sinks.append(ParquetSink(parquet_file, len(self.query_builder.measures), config=self.config))
+                if excel_handler is not None and excel_handler.streaming:
+                    sinks.append(excel_handler.create_data_sheet_sink())
+                    data_sheet_written = True
+                    # Nothing else needs to read the CSV from disk, so it can go straight to storage if supported
+                    upload_sink = self.storage_controller.create_upload_sink('data.csv')
+                    if upload_sink is not None:
+                        sinks.insert(0, upload_sink)
+                        self.uploaded_data_file = upload_sink.filename
+                        data_file = None
+                runner.run_query_and_save_results(query=self.query, file_name=data_file, sinks=sinks)
+            finally:
+                runner.close()
+        self.server_totals = runner.totals
+        self.parquet_written = any(isinstance(sink, ParquetSink) for sink in sinks)
+        return runner.statistics, data_sheet_written
+
+    def __write_query_stats__(self, query_stats):
+        """
+        Stores the statistics for the order's query alongside query.sql, and logs them
+        as structured fields
+        :param query_stats: a dict of statistics
+        :return: None
+        """
+        query_stats = dict(orderRef=self.order['orderRef'], table=self.query_builder.table.get_table_name(),
+                           **query_stats)
+        logger.info("Query statistics " + json.dumps(query_stats), extra={"query_stats": query_stats})
+        self.storage_controller.store_object_as_json("query_stats.json", query_stats)
+
     def __write_receipt_manifest__(self):
         """
         Writes the manifest with a completion timestamp and output file name
@@ -134,7 +325,17 @@ class OrderProcessor(object):
 
         manifest = self.order
         manifest['outputFile'] = self.output_filename
+        if self.config.get_parquet_configuration()['enabled']:
+            manifest['parquetFile'] = self.storage_controller.get_resource_path('data.parquet')
         manifest['jobCompleted'] = self.job_completed
+        manifest['totals'] = self.totals
+        if self.server_totals is not None and len(self.server_totals['subtotals']) > 0:
+            manifest['subtotals'] = self.server_totals['subtotals']
+        elif self.server_totals is None and len(self.query) > 3 and self.query[3]['subtotals']:
+            # Only the grand totals can be added up from the CSV of results
+            manifest['subtotals'] = None
+            manifest['subtotalsUnavailable'] = "Subtotals aren't calculated for results from " + \
+                SUBTOTALS_UNAVAILABLE_SOURCES.get(self.results_source, self.results_source)
         self.storage_controller.store_object_as_json(filename="manifest.json", json_object=self.order)
 
         # Upload to S3 if we aren't using S3 storage already
@@ -144,9 +345,6 @@ class OrderProcessor(object):
             order_reference = self.order['orderRef']
             if 'customerRef' in self.order and self.order['customerRef'] is not None and self.order['customerRef'].strip() != "":
                 customer_ref = self.order['customerRef']
-            s3_storage_controller = StorageController(output_type='s3', client=client_id, order_reference=order_reference, customer_reference=customer_ref)
+            s3_storage_controller = StorageController(output_type='s3', client=client_id, order_reference=order_reference,
+                                                      customer_reference=customer_ref)
             s3_storage_controller.store_object_as_json('manifest.json', json_object=self.order)
-
-
-
-
@@ -0,0 +1,139 @@
+import csv
+import logging
+from dataquery_processor import _config
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+logger = logging.getLogger(__name__)
+
+"""
+Module for delivering query results as Parquet. Rows are buffered and written a row group
+at a time, so memory use is bounded by the row group size rather than the size of the results.
+"""
+
+
+def require_pyarrow():
+    """
+    Checks that Parquet files can be written, so that an order fails before its query is run
+    rather than after. Raises ValueError if pyarrow can't be imported.
+    :return: None
+    """
+    if pyarrow is None:
+        raise ValueError("Parquet output is enabled in the [parquet] section of config.ini, but pyarrow "
+                         "can't be imported; install it from requirements.txt or disable Parquet output")
+
+
+def format_field(value):
+    """
+    Formats the value of a field column as a string, so that the column has the same type in
+    every row group whether the rows came from the database or were read back from the CSV,
+    where whole numbers are read as floats
+    :param value: the value
+    :return: the value as a string, or None
+    """
+    if value is None:
+        return None
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value)
+
+
+def format_measure(value):
+    """
+    Formats the value of a measure column, which may be a Decimal from the database
+    :param value: the value
+    :return: the value as a float, or None
+    """
+    if value is None or value == '':
+        return None
+    return float(value)
+
+
+class ParquetSink(object):
+    """
+    Writes the rows of a query to a Parquet file as they are fetched. The measures are the
+    last columns of each row and are stored as doubles; the other columns are stored as strings
+    using dictionary encoding, as each has only a few distinct values.
+    """
+
+    def __init__(self, file_name, measure_count, config=_config):
+        require_pyarrow()
+        parquet_configuration = config.get_parquet_configuration()
+        self.file_name = file_name
+        self.measure_count = measure_count
+        self.codec = parquet_configuration['codec']
+        self.row_group_size = parquet_configuration['row_group_size']
+        self.schema = None
+        self.writer = None
+        self.columns = None
+        self.buffered = 0
+        self.rows = 0
+
+    def write_header(self, headers):
+        field_count = len(headers) - self.measure_count
+        self.schema = pyarrow.schema([pyarrow.field(header, pyarrow.string() if index < field_count
+                                                    else pyarrow.float64())
+                                      for index, header in enumerate(headers)])
+        self.writer = pyarrow.parquet.ParquetWriter(self.file_name, self.schema, compression=self.codec,
+                                                    use_dictionary=list(headers[:field_count]))
+        self.columns = [[] for _ in headers]
+
+    def write_rows(self, rows):
+        field_count = len(self.columns) - self.measure_count
+        for row in rows:
+            for index, value in enumerate(row):
+                self.columns[index].append(format_field(value) if index < field_count else format_measure(value))
+            self.buffered += 1
+            if self.buffered >= self.row_group_size:
+                self.__write_row_group__()
+
+    def close(self):
+        if self.writer is None:
+            return
+        if self.buffered > 0:
+            self.__write_row_group__()
+        self.writer.close()
+        self.writer = None
+        logger.debug("Wrote {0} rows to {1}".format(self.rows, self.file_name))
+
+    def __write_row_group__(self):
+        """
+        Writes the buffered rows to the file as a row group
+        :return: None
+        """
+        self.writer.write_table(pyarrow.Table.from_arrays(self.columns, schema=self.schema),
+                                row_group_size=self.buffered)
+        self.rows += self.buffered
+        self.columns = [[] for _ in self.columns]
+        self.buffered = 0
+
+
+def write_parquet_from_csv(csv_file, file_name, measure_count, config=_config):
+    """
+    Writes a CSV file of results as Parquet, e.g. for results that came from the result cache
+    rather than being fetched from the database
+    :param csv_file: the CSV file of results
+    :param file_name: the Parquet file to write
+    :param measure_count: the number of measures, which are the last columns of the CSV
+    :param config: the Config object to use
+    :return: None
+    """
+    sink = ParquetSink(file_name, measure_count, config=config)
+    batch_size = config.get_fetch_configuration()['batch_size']
+    with open(csv_file, encoding='utf-8', newline='') as f:
+        reader = csv.reader(f, quoting=csv.QUOTE_NONNUMERIC)
+        try:
+            sink.write_header(next(reader))
+            batch = []
+            for row in reader:
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    sink.write_rows(batch)
+                    batch = []
+            sink.write_rows(batch)
+        finally:
+            sink.close()
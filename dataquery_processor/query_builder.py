@@ -1,9 +1,136 @@
 import logging
+import threading
+import weakref
+from collections import OrderedDict
 
 from pypika import Table, Criterion, MSSQLQuery as Query, functions as fn, Parameter
+from pypika.terms import Term
 from dataquery_processor import _config
 logger = logging.getLogger(__name__)
 
+GROUPING_ID_COLUMN = '__grouping_id'
+YEAR_START_COLUMN = 'Academic year start'
+ONWARD_USE_CATEGORY_COLUMN = 'Onward use category '
+TEMP_TABLE_PREFIX = '#dq_values_'
+TEMP_TABLE_COLUMN = 'value'
+# SQL Server allows at most 2100 parameters in a statement; stay a little below it
+MAX_PARAMETERS = 2000
+
+
+class GroupingSets(Term):
+    """
+    A GROUPING SETS clause for GROUP BY, which pypika doesn't provide
+    """
+
+    def __init__(self, *sets):
+        super().__init__()
+        self.sets = sets
+
+    def get_sql(self, **kwargs):
+        return 'GROUPING SETS(' + ','.join(
+            '(' + ','.join(field.get_sql(**kwargs) for field in fields) + ')' for fields in self.sets) + ')'
+
+
+def get_manifest_measures(manifest, config=_config):
+    """
+    Gets the measure columns for a manifest, which has either a list of measures
+    or a single measure. Measures that map to the same column are only included once.
+    :param manifest: the order manifest
+    :param config: the Config object to use
+    :return: a list of mapped measure column names
+    """
+    if 'measures' in manifest and manifest['measures'] is not None and len(manifest['measures']) > 0:
+        measures = manifest['measures']
+    else:
+        measures = [manifest['measure']]
+    return list(dict.fromkeys(config.get_measure_mapping(measure) for measure in measures))
+
+
+def get_placeholder_count(values, buckets):
+    """
+    Gets the number of placeholders to use for an IN list, rounded up to a bucket size if any are set
+    :param values: the number of values in the list
+    :param buckets: a sorted list of bucket sizes, or an empty list to use one placeholder per value
+    :return: the number of placeholders
+    """
+    for bucket in buckets:
+        if bucket >= values:
+            return bucket
+    if len(buckets) > 0:
+        return -(-values // buckets[-1]) * buckets[-1]
+    return values
+
+
+class QueryShapeCache(object):
+    """
+    Bounded LRU cache of rendered SQL, keyed by query shape, with hit and miss counters
+    """
+
+    def __init__(self, size):
+        self.size = size
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.shapes = set()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        """
+        :param key: the query shape
+        :return: the SQL for the shape, or None if it isn't cached
+        """
+        with self.lock:
+            sql = self.entries.get(key)
+            if sql is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return sql
+
+    def put(self, key, sql):
+        with self.lock:
+            self.shapes.add(key)
+            if self.size <= 0:
+                return
+            self.entries[key] = sql
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.hits = 0
+            self.misses = 0
+            self.shapes.clear()
+
+    def statistics(self):
+        """
+        :return: a dict of the number of cached entries, hits, misses, and distinct
+        query shapes rendered since the cache was created or cleared
+        """
+        with self.lock:
+            return {"entries": len(self.entries), "hits": self.hits, "misses": self.misses,
+                    "shapes": len(self.shapes)}
+
+
+_shape_caches = weakref.WeakKeyDictionary()
+_shape_caches_lock = threading.Lock()
+
+
+def get_shape_cache(config=_config):
+    """
+    Gets the QueryShapeCache shared by all query builders in the process that use a Config,
+    creating it on first use with the shape_cache_size from that Config
+    :param config: the Config object to use
+    :return: the QueryShapeCache for the Config
+    """
+    with _shape_caches_lock:
+        if config not in _shape_caches:
+            _shape_caches[config] = QueryShapeCache(config.get_query_configuration()['shape_cache_size'])
+        return _shape_caches[config]
+
 
 class QueryBuilder(object):
     """
@@ -17,9 +144,15 @@ class QueryBuilder(object):
         self.constraints = []
         self.parameters = []
         self.onward_use_category = manifest['onwardUseCategory']
+        self.placeholder_buckets = config.get_query_configuration()['placeholder_buckets']
+        self.temp_table_threshold = config.get_query_configuration()['temp_table_threshold']
+        self.subtotals = config.get_query_configuration()['subtotals']
         self.map_fields_and_constraints(manifest['items'])
-        self.measure = self.map_measure(manifest['measure'])
-        self.table = Table(self.map_table(manifest['datasource']), schema='dbo')
+        self.temp_table_constraints, self.pad_placeholders = self.plan_constraints()
+        self.measures = get_manifest_measures(manifest, config=config)
+        self.measure = self.measures[0]
+        self.base_table = self.map_table(manifest['datasource'])
+        self.table = Table(self.route_table(self.base_table), schema='dbo')
         logger.debug("Query builder using table " + str(self.table))
 
     def map_fields_and_constraints(self, items):
@@ -45,45 +178,247 @@ class QueryBuilder(object):
     def map_column(self, column):
         return self.config.get_column_mapping(column)
 
-    def create_query(self):
+    def get_required_columns(self):
+        """
+        Gets the columns a table must have to answer the query, other than the measures
+        :return: a list of column names
+        """
+        columns = self.fieldnames + [constraint['fieldName'] for constraint in self.constraints]
+        columns.append(YEAR_START_COLUMN)
+        columns.append(ONWARD_USE_CATEGORY_COLUMN + self.onward_use_category)
+        return columns
+
+    def route_table(self, base_table):
         """
-        Constructs the query by combining the selections and constraints.
-        :return: an array containing the query prepared statement, and the parameters
+        Chooses the table to query: the smallest rollup of the base table declared in
+        config.ini that has all the required columns and measures, or the base table
+        if there is none
+        :param base_table: the mapped table for the datasource
+        :return: the table name
+        """
+        required_columns = set(self.get_required_columns())
+        candidates = [rollup for rollup in self.config.get_rollups()
+                      if rollup['base_table'] == base_table
+                      and set(self.measures).issubset(rollup['measures'])
+                      and required_columns.issubset(rollup['columns'])]
+        if len(candidates) == 0:
+            return base_table
+        rollup = min(candidates, key=lambda r: (r['rows'] is None, r['rows'] or 0, len(r['columns'])))
+        logger.debug("Routing query on " + base_table + " to rollup " + rollup['name'])
+        return rollup['name']
+
+    def get_compatibility_key(self):
+        """
+        Gets a key that is the same for orders that differ only in their selected fields,
+        and so can be answered from a single GROUPING SETS query
+        :return: a tuple of the table, measures, years, onward use category and constraints
+        """
+        constraints = tuple((constraint['fieldName'], tuple(sorted(constraint['allowedValues'])))
+                            for constraint in self.constraints)
+        return (self.table.get_table_name(), tuple(self.measures), tuple(self.get_year_starts()),
+                self.onward_use_category, constraints)
+
+    def get_normalised_parameters(self):
+        """
+        Gets the parameters for each constraint with the allowed values sorted,
+        so that equivalent orders can be recognised e.g. for caching results
+        :return: a list containing a sorted list of values for each constraint
+        """
+        return [sorted(constraint['allowedValues']) for constraint in self.constraints]
+
+    def get_shape_key(self, year_starts, totals=False):
+        """
+        Gets a key for everything that determines the SQL text for a query, other than the parameter values
+        :param year_starts: the year starts to query
+        :param totals: whether the query also calculates totals
+        :return: a tuple of the table, measures, fields, constraint columns and number of values,
+        onward use category, years and totals
+        """
+        constraints = tuple((constraint['fieldName'], self.uses_temp_table(index),
+                             self.get_placeholder_count(index)) for index, constraint in enumerate(self.constraints))
+        return (self.table.get_table_name(), tuple(self.measures), tuple(self.fieldnames), constraints,
+                self.onward_use_category, tuple(year_starts), self.get_totals_layout(totals) is not None,
+                self.subtotals)
+
+    def create_query(self, year_starts=None, totals=False):
+        """
+        Constructs the query by combining the selections and constraints. The SQL is
+        only rendered for the first query of each shape; after that it comes from the shape cache.
+        :param year_starts: the year starts to query, if not all the years in the manifest
+        :param totals: whether to also calculate the grand total, and subtotals for each field
+        if enabled in config.ini, in the same query
+        :return: an array containing the query prepared statement, the parameters, a dict of
+        temporary table names to the values to load into them before running the query, and
+        if totals are calculated, the layout of the totals rows (see get_totals_layout)
+        """
+        if year_starts is None:
+            year_starts = self.get_year_starts()
+        key = self.get_shape_key(year_starts, totals=totals)
+        shape_cache = get_shape_cache(self.config)
+        sql = shape_cache.get(key)
+        if sql is None:
+            sql = self.render_query(year_starts, totals=totals)
+            shape_cache.put(key, sql)
+        else:
+            self.parameters = self.bind_parameters()
+
+        query = [sql, self.parameters, self.get_temp_tables()]
+        totals_layout = self.get_totals_layout(totals)
+        if totals_layout is not None:
+            query.append(totals_layout)
+        return query
+
+    def render_query(self, year_starts, totals=False):
+        """
+        Builds the query with pypika and renders it
+        :param year_starts: the year starts to query
+        :param totals: whether to also calculate totals using GROUPING SETS
+        :return: the SQL for the query
         """
         select_fields = self.fieldnames.copy()
-        select_fields.append(fn.Sum(self.table[self.measure], self.measure))
+        for measure in self.measures:
+            select_fields.append(fn.Sum(self.table[measure], measure))
         q = Query().\
             from_(self.table).\
-            select(*select_fields).\
-            groupby(*self.fieldnames)
+            select(*select_fields)
+
+        if self.get_totals_layout(totals) is not None:
+            fields = [self.table[fieldname] for fieldname in self.fieldnames]
+            grouping_sets = [fields]
+            if self.subtotals and len(fields) > 1:
+                grouping_sets.extend([field] for field in fields)
+            grouping_sets.append([])
+            q = q.select(fn.Function('GROUPING_ID', *fields, alias=GROUPING_ID_COLUMN)).\
+                groupby(GroupingSets(*grouping_sets))
+        else:
+            q = q.groupby(*self.fieldnames)
+
+        q = self.create_constraints(q, year_starts=year_starts)
+
+        return q.get_sql()
+
+    def get_totals_layout(self, totals=True):
+        """
+        Gets the layout of the totals rows in a query with totals. These rows follow the
+        fields and measures with a GROUPING_ID column, which is 0 for the detail rows,
+        has all bits set for the grand total, and all bits but one set for a subtotal.
+        :param totals: whether the query calculates totals
+        :return: a dict with the fields, the measures, and whether there are subtotals;
+        or None if there are no totals, including when there are no fields to total over
+        """
+        if not totals or len(self.fieldnames) == 0:
+            return None
+        return {"fields": list(self.fieldnames), "measures": list(self.measures),
+                "subtotals": self.subtotals and len(self.fieldnames) > 1}
+
+    def plan_constraints(self):
+        """
+        Chooses the constraints to load into temporary tables: those with more values than
+        the temp table threshold, and then the largest of the rest until the IN lists need
+        no more than MAX_PARAMETERS placeholders. If padding the IN lists to the placeholder
+        buckets would take them over the limit but the values alone would not, the lists
+        aren't padded instead.
+        :return: the set of indexes of constraints that use a temporary table, and whether
+        the IN lists are padded to the placeholder buckets
+        """
+        counts = [len(constraint['allowedValues']) for constraint in self.constraints]
+        temp_table_constraints = {index for index, count in enumerate(counts) if 0 < self.temp_table_threshold < count}
+        in_lists = [index for index in range(len(counts)) if index not in temp_table_constraints]
+        while True:
+            if sum(get_placeholder_count(counts[index], self.placeholder_buckets) for index in in_lists) <= MAX_PARAMETERS:
+                return temp_table_constraints, True
+            if sum(counts[index] for index in in_lists) <= MAX_PARAMETERS:
+                logger.debug("Not padding IN lists, as there would be more than " + str(MAX_PARAMETERS) + " parameters")
+                return temp_table_constraints, False
+            largest = max(in_lists, key=lambda index: counts[index])
+            in_lists.remove(largest)
+            temp_table_constraints.add(largest)
+
+    def uses_temp_table(self, index):
+        """
+        :param index: the index of the constraint
+        :return: True if the constraint uses a temporary table rather than an IN list
+        """
+        return index in self.temp_table_constraints
 
-        q = self.create_constraints(q)
+    def get_temp_tables(self):
+        """
+        Gets the temporary tables needed by the query, for constraints with too many values for an IN list
+        :return: a dict of temporary table names to lists of distinct values
+        """
+        temp_tables = {}
+        for index, constraint in enumerate(self.constraints):
+            if self.uses_temp_table(index):
+                temp_tables[TEMP_TABLE_PREFIX + str(index)] = sorted(set(constraint['allowedValues']))
+        return temp_tables
 
-        return [q.get_sql(), self.parameters]
+    def get_placeholder_count(self, index):
+        """
+        :param index: the index of the constraint
+        :return: the number of placeholders in the IN list for the constraint
+        """
+        if self.uses_temp_table(index):
+            return 0
+        values = len(self.constraints[index]['allowedValues'])
+        if not self.pad_placeholders:
+            return values
+        return get_placeholder_count(values, self.placeholder_buckets)
 
-    def create_constraints(self, q):
+    def bind_parameters(self):
+        """
+        Gets the parameters for the placeholders in the query, in order. Where an IN list
+        is padded to a bucket size, the last value is repeated.
+        :return: a list of parameter values
+        """
+        parameters = []
+        for index, constraint in enumerate(self.constraints):
+            if self.uses_temp_table(index):
+                continue
+            values = constraint['allowedValues']
+            parameters.extend(values)
+            parameters.extend([values[-1]] * (self.get_placeholder_count(index) - len(values)))
+        return parameters
+
+    def create_partitioned_queries(self):
+        """
+        Constructs a separate query for each year in the manifest. As the measure is
+        summed, adding up the results of each query for the same fields gives the
+        same result as the single query from create_query.
+        :return: a list of (year start, query) tuples
+        """
+        return [(year_start, self.create_query(year_starts=[year_start])) for year_start in self.get_year_starts()]
+
+    def create_constraints(self, q, year_starts=None):
         """
         Builds a set of constraints from the query; this consists of both
         defined constraints, and the implicit constraint on years. Uses the
-        'in' method for determining constraint syntax
+        'in' method for determining constraint syntax, with a subquery on a
+        temporary table for constraints with a large number of values
         :param q: the Query object
+        :param year_starts: the year starts to query, if not all the years in the manifest
         :return: the Query object with constraints
         """
+        self.parameters = self.bind_parameters()
         clauses = []
-        for constraint in self.constraints:
+        for index, constraint in enumerate(self.constraints):
             column = constraint['fieldName']
-            self.parameters.extend(constraint['allowedValues'])
+            if self.uses_temp_table(index):
+                temp_table = Table(TEMP_TABLE_PREFIX + str(index))
+                clauses.append(self.table[column].isin(Query().from_(temp_table).select(temp_table[TEMP_TABLE_COLUMN])))
+                continue
             placeholders = []
-            for i in range(len(constraint['allowedValues'])):
+            for i in range(self.get_placeholder_count(index)):
                 placeholders.append(Parameter('?'))
             clauses.append(self.table[column].isin(placeholders))
 
-        clauses.append(self.table['Onward use category '+self.onward_use_category] == 1)
+        clauses.append(self.table[ONWARD_USE_CATEGORY_COLUMN + self.onward_use_category] == 1)
 
         #
         # For years, querying on year start is much faster
         #
-        clauses.append(self.table['Academic year start'].isin(self.get_year_starts()))
+        if year_starts is None:
+            year_starts = self.get_year_starts()
+        clauses.append(self.table[YEAR_START_COLUMN].isin(year_starts))
         q = q.where(Criterion.all(clauses))
         return q
 
@@ -97,3 +432,52 @@ class QueryBuilder(object):
             year_start = int(year.split('/')[0])
             year_starts.append(year_start)
         return year_starts
+
+
+def create_grouping_sets_query(query_builders):
+    """
+    Constructs a single query for several compatible orders (see QueryBuilder.get_compatibility_key)
+    using a grouping set for each order's fields. The rows for each order can be identified
+    from the GROUPING_ID column, which is selected after the fields and the measures.
+    :param query_builders: a QueryBuilder for each order
+    :return: an array containing the query prepared statement, the parameters, the temporary
+    tables as for QueryBuilder.create_query, the list of columns selected before the measures,
+    and the GROUPING_ID value for each query builder
+    (None if no order selects any fields, in which case there is no GROUPING_ID column)
+    """
+    first = query_builders[0]
+    columns = []
+    for query_builder in query_builders:
+        for fieldname in query_builder.fieldnames:
+            if fieldname not in columns:
+                columns.append(fieldname)
+
+    grouping_sets = []
+    grouping_ids = []
+    for query_builder in query_builders:
+        fields = [fieldname for fieldname in columns if fieldname in query_builder.fieldnames]
+        if fields not in grouping_sets:
+            grouping_sets.append(fields)
+        # GROUPING_ID has a bit for each column, first column most significant, set when it isn't grouped
+        grouping_id = 0
+        for fieldname in columns:
+            grouping_id = grouping_id * 2 + (0 if fieldname in query_builder.fieldnames else 1)
+        grouping_ids.append(grouping_id)
+
+    if len(columns) == 0:
+        # None of the orders select any fields, so they all want the same single total
+        return first.create_query()[:3] + [columns, [None] * len(query_builders)]
+
+    select_fields = [first.table[fieldname] for fieldname in columns]
+    for measure in first.measures:
+        select_fields.append(fn.Sum(first.table[measure], measure))
+    select_fields.append(fn.Function('GROUPING_ID', *[first.table[fieldname] for fieldname in columns],
+                                     alias=GROUPING_ID_COLUMN))
+    q = Query().\
+        from_(first.table).\
+        select(*select_fields).\
+        groupby(GroupingSets(*[[first.table[fieldname] for fieldname in fields] for fields in grouping_sets]))
+
+    q = first.create_constraints(q)
+
+    return [q.get_sql(), first.parameters, first.get_temp_tables(), columns, grouping_ids]
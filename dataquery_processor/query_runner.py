@@ -1,56 +1,573 @@
 import logging
 import csv
-import pyodbc  # Note this is included in a Lambda layer so is omitted from requirements.txt
+import re
+import sys
+import threading
+import time
+from decimal import Decimal
+from concurrent.futures import ThreadPoolExecutor
+try:
+    import pyodbc  # Note this is included in a Lambda layer so is omitted from requirements.txt
+except ImportError:
+    pyodbc = None
 from dataquery_processor import _config
+from dataquery_processor.config import SQLITE_RUNNER
+from dataquery_processor.connection_pool import get_connection_pool
+from dataquery_processor.concurrency import database_slot
+from dataquery_processor.query_builder import TEMP_TABLE_COLUMN
 
 logger = logging.getLogger(__name__)
 
+CPU_TIME_PATTERN = re.compile(r'CPU time = (\d+) ms,\s*elapsed time = (\d+) ms')
+SERVER_STATISTICS_ON = 'SET STATISTICS TIME, IO ON;\n'
+SERVER_STATISTICS_OFF = 'SET STATISTICS TIME, IO OFF'
+READS_PATTERNS = {"logicalReads": re.compile(r'logical reads (\d+)'),
+                  "physicalReads": re.compile(r'physical reads (\d+)')}
 
-class OdbcQueryRunner(object):
+
+class FetchStatistics(object):
+    """
+    Counters and timings for a query, and for a streamed fetch of its results from a cursor
+    """
+
+    def __init__(self):
+        self.rows = 0
+        self.bytes_written = 0
+        self.started = time.monotonic()
+        self.executed = None
+        self.first_row = None
+        self.finished = None
+        self.server = None
+        self.partitions = []
+
+    def execute_finished(self):
+        self.executed = time.monotonic()
+
+    def row_received(self):
+        if self.first_row is None:
+            self.first_row = time.monotonic()
+
+    def finish(self):
+        self.finished = time.monotonic()
+
+    def elapsed(self):
+        """
+        :return: seconds since the fetch started, or the total time if it has finished
+        """
+        end = self.finished if self.finished is not None else time.monotonic()
+        return end - self.started
+
+    def rows_per_second(self):
+        elapsed = self.elapsed()
+        if elapsed <= 0:
+            return 0.0
+        return self.rows / elapsed
+
+    def as_dict(self):
+        statistics = {"rows": self.rows,
+                      "bytesWritten": self.bytes_written,
+                      "seconds": round(self.elapsed(), 3),
+                      "rowsPerSecond": round(self.rows_per_second(), 1)}
+        if self.executed is not None:
+            statistics["executeSeconds"] = round(self.executed - self.started, 3)
+        if self.first_row is not None:
+            statistics["firstRowSeconds"] = round(self.first_row - self.started, 3)
+        if self.executed is not None and self.finished is not None:
+            statistics["fetchSeconds"] = round(self.finished - self.executed, 3)
+        if self.server is not None:
+            statistics["server"] = self.server
+        if len(self.partitions) > 0:
+            statistics["partitions"] = self.partitions
+        return statistics
+
+
+def parse_server_statistics(messages):
+    """
+    Totals the CPU time, elapsed time and reads from SET STATISTICS TIME and IO messages
+    :param messages: the message texts returned by the server
+    :return: a dict of the totals, and the messages themselves
+    """
+    server = {"cpuMilliseconds": 0, "elapsedMilliseconds": 0, "logicalReads": 0, "physicalReads": 0,
+              "messages": messages}
+    for message in messages:
+        if 'SQL Server Execution Times' in message:
+            match = CPU_TIME_PATTERN.search(message)
+            if match is not None:
+                server["cpuMilliseconds"] += int(match.group(1))
+                server["elapsedMilliseconds"] += int(match.group(2))
+        for key, pattern in READS_PATTERNS.items():
+            match = pattern.search(message)
+            if match is not None:
+                server[key] += int(match.group(1))
+    return server
+
+
+def split_totals_rows(rows, totals, layout):
+    """
+    Separates the totals rows from the detail rows of a query with totals, adding them to a
+    dict of totals. Decimal totals are converted to float so they can be saved as JSON.
+    :param rows: a batch of rows, ending with the GROUPING_ID column
+    :param totals: a dict of totals from create_totals, updated in place
+    :param layout: the totals layout from QueryBuilder.get_totals_layout
+    :return: the detail rows, without the GROUPING_ID column
+    """
+    field_count = len(layout['fields'])
+    all_fields = (1 << field_count) - 1
+    detail_rows = []
+    for row in rows:
+        grouping_id = row[-1]
+        if grouping_id == 0:
+            detail_rows.append(row[:-1])
+            continue
+        values = [float(value) if isinstance(value, Decimal) else value for value in row[field_count:-1]]
+        if grouping_id == all_fields:
+            totals['total'] = values
+            continue
+        for index, field in enumerate(layout['fields']):
+            if grouping_id == all_fields ^ (1 << (field_count - 1 - index)):
+                totals['subtotals'].setdefault(field, []).append([row[index]] + values)
+    return detail_rows
+
+
+def create_totals(layout):
+    """
+    :param layout: the totals layout from QueryBuilder.get_totals_layout
+    :return: an empty dict of totals, with the measures, the grand total for each
+    measure, and a list of [value, measures...] subtotals for each field
+    """
+    return {"measures": layout['measures'], "total": [None] * len(layout['measures']), "subtotals": {}}
+
+
+def supports_grouping_sets(config=_config):
+    """
+    :param config: the Config object to use
+    :return: True if the configured query runner supports GROUPING SETS
+    """
+    return config.get_runner_type() != SQLITE_RUNNER
+
+
+def estimate_row_size(row):
+    """
+    Estimates the memory used by a fetched row
+    :param row: a row from a cursor
+    :return: approximate size in bytes
+    """
+    return sys.getsizeof(row) + sum(sys.getsizeof(value) for value in row)
+
+
+def fetch_batches(cursor, batch_size, memory_limit=None):
+    """
+    Generator that fetches rows from a cursor using fetchmany. If a memory limit
+    is given, the batch size is reduced so that a batch of the largest rows seen
+    so far stays under the limit.
+    :param cursor: a cursor with an executed query
+    :param batch_size: the maximum number of rows to fetch at a time
+    :param memory_limit: the maximum approximate size of a batch in bytes
+    :return: yields lists of rows
+    """
+    size = batch_size
+    largest_row = 0
+    while True:
+        rows = cursor.fetchmany(size)
+        if not rows:
+            return
+        if memory_limit is not None:
+            largest_row = max(largest_row, estimate_row_size(rows[0]), estimate_row_size(rows[-1]))
+            size = max(1, min(batch_size, memory_limit // largest_row))
+        yield rows
+
+
+class QueryRunner(object):
+    """
+    Base class for running queries and outputting the results. Subclasses
+    connect to a particular kind of database and set self.cursor.
+    """
+
+    TEMP_TABLE_DDL = 'CREATE TABLE "{0}" ("' + TEMP_TABLE_COLUMN + '" VARCHAR(255) PRIMARY KEY)'
+
+    def __init__(self, config=_config):
+        self.config = config
+        self.conn = None
+        self.cursor = None
+        self.statistics = None
+        self.totals = None
+        self.temp_tables = []
+        self.__connect__()
+
+    def __connect__(self):
+        raise NotImplementedError
+
+    def close(self):
+        """
+        Releases the connection. The runner cannot be used afterwards.
+        :return: None
+        """
+        raise NotImplementedError
+
+    def translate(self, sql):
+        """
+        Translates a query from the MSSQL dialect generated by QueryBuilder
+        into the dialect of the database, where they differ
+        :param sql: the SQL statement
+        :return: the translated SQL statement
+        """
+        return sql
+
+    def run_query_and_return_results(self, query):
+        """
+        Runs the query and returns a cursor for the result set that can
+        be iterated over to obtain the data. Any temporary tables the query
+        uses are created and loaded first.
+        :param query: a query tuple containing a prepared statement, parameter list,
+        and optionally a dict of temporary tables
+        :return: a cursor for the result set
+        """
+        if len(query) > 2 and query[2]:
+            self.__create_temp_tables__(query[2])
+        return self.cursor.execute(self.translate(query[0]), query[1])
+
+    def __create_temp_tables__(self, temp_tables):
+        """
+        Creates and loads the temporary tables for a query, replacing any from a previous query
+        :param temp_tables: a dict of table names to lists of values
+        :return: None
+        """
+        self.__drop_temp_tables__()
+        for name, values in temp_tables.items():
+            self.cursor.execute(self.TEMP_TABLE_DDL.format(name))
+            self.temp_tables.append(name)
+            self.__load_temp_table__(name, values)
+        logger.debug("Loaded temporary tables " + ", ".join(
+            "{0} ({1} values)".format(name, len(values)) for name, values in temp_tables.items()))
+
+    def __load_temp_table__(self, name, values):
+        self.cursor.executemany('INSERT INTO "{0}" VALUES (?)'.format(name), [(value,) for value in values])
+
+    def __drop_temp_tables__(self):
+        """
+        Drops the temporary tables created for the last query, so they don't
+        persist on a pooled connection
+        :return: None
+        """
+        for name in self.temp_tables:
+            self.cursor.execute('DROP TABLE "{0}"'.format(name))
+        self.temp_tables = []
+
+    def execute(self, sql, parameters=None):
+        """
+        Runs a statement that doesn't return results, e.g. to build a table, and commits it
+        :param sql: the SQL statement
+        :param parameters: the parameters for the statement, if any
+        :return: None
+        """
+        self.cursor.execute(self.translate(sql), parameters or [])
+        self.conn.commit()
+
+    def get_headers(self):
+        """
+        Returns the column headers from a cursor. Must be run after run_query_and_return_results.
+        :return:
+        """
+        return [x[0] for x in self.cursor.description]
+
+    def __collect_server_statistics__(self, cursor):
+        """
+        Gets any statistics reported by the server for the last query.
+        Must be run after all the results have been fetched.
+        :param cursor: the cursor the query was run on
+        :return: a dict of server statistics, or None if they aren't available
+        """
+        return None
+
+    def run_query_and_save_results(self, query=None, file_name=None, sinks=None):
+        """
+        Runs the query and streams the results to a file in batches, so memory use
+        is bounded by the configured fetch batch size and memory limit rather than
+        by the size of the result set. Each batch is also passed to any other sinks,
+        so all the outputs are written from a single pass over the cursor. Counters
+        and timings for the query are kept in self.statistics. If the query calculates
+        totals, they are kept in self.totals rather than saved to the file.
+        :param query: a tuple containing the query and the parameters to run it with
+        :param file_name: the file to save, or None if the results only go to the sinks
+        :param sinks: other objects to write the results to, with write_header(headers),
+        write_rows(rows) and close() methods, e.g. from ExcelHandler.create_data_sheet_sink.
+        If a sink also has an abort() method, it is called instead if the query fails.
+        :return: None
+        """
+        logger.debug("Running query using " + type(self).__name__)
+        fetch_configuration = self.config.get_fetch_configuration()
+        totals_layout = query[3] if len(query) > 3 else None
+        self.totals = create_totals(totals_layout) if totals_layout is not None else None
+        self.statistics = FetchStatistics()
+        self.cursor.arraysize = fetch_configuration['batch_size']
+        sinks = ([CsvSink(file_name)] if file_name is not None else []) + (sinks or [])
+        # The first sink writes the CSV, whether to a file or elsewhere
+        csv_sink = sinks[0]
+        try:
+            cursor = self.run_query_and_return_results(query)
+            self.statistics.execute_finished()
+            headers = self.get_headers()
+            if totals_layout is not None:
+                headers = headers[:-1]
+            for sink in sinks:
+                sink.write_header(headers)
+            for rows in fetch_batches(cursor, fetch_configuration['batch_size'], fetch_configuration['memory_limit']):
+                self.statistics.row_received()
+                if totals_layout is not None:
+                    rows = split_totals_rows(rows, self.totals, totals_layout)
+                for sink in sinks:
+                    sink.write_rows(rows)
+                self.statistics.rows += len(rows)
+                self.statistics.bytes_written = csv_sink.bytes_written()
+        except Exception as e:
+            for sink in sinks:
+                if hasattr(sink, 'abort'):
+                    sink.abort()
+            raise e
+        finally:
+            for sink in sinks:
+                sink.close()
+        self.statistics.finish()
+        self.statistics.server = self.__collect_server_statistics__(cursor)
+        logger.info("Fetched {rows} rows ({bytesWritten} bytes) in {seconds}s at {rowsPerSecond} rows/s"
+                    .format(**self.statistics.as_dict()))
+
+
+class CsvSink(object):
+    """
+    Writes the results of a query to a CSV file
+    """
+
+    def __init__(self, file_name):
+        self.file = open(file_name, 'w', newline='')
+        self.writer = csv.writer(self.file, quoting=csv.QUOTE_NONNUMERIC)
+
+    def write_header(self, headers):
+        self.writer.writerow(headers)  # column headers
+
+    def write_rows(self, rows):
+        self.writer.writerows(rows)
+
+    def bytes_written(self):
+        return self.file.tell()
+
+    def close(self):
+        self.file.close()
+
+
+class OdbcQueryRunner(QueryRunner):
     """
     Creates a database connection and outputs the results.
     """
 
+    TEMP_TABLE_DDL = 'CREATE TABLE "{0}" ("' + TEMP_TABLE_COLUMN + '" VARCHAR(255) COLLATE DATABASE_DEFAULT PRIMARY KEY)'
+
     def __init__(self, config=_config):
         """
         Create a query runner using the connection details
-        from config.ini. Raises a pyODBC Error if connection fails.
+        from config.ini. Connections are taken from a pool shared by
+        all runners in the process. Raises a pyODBC Error if connection fails.
         """
-        self.config = config
+        if pyodbc is None:
+            raise ValueError("pyodbc is not installed; use a different query runner type")
+        self.pool = get_connection_pool(config)
+        self.server_statistics = config.get_fetch_configuration()['server_statistics']
+        # Whether SET STATISTICS has been turned on for the connection and not yet turned off
+        self.statistics_on = False
+        super().__init__(config=config)
+
+    def __connect__(self):
         try:
-            conn = pyodbc.connect(self.config.conn)
+            self.conn = self.pool.acquire()
         except pyodbc.OperationalError as e:
             logger.error("Error connecting to database")
             raise e
-        self.cursor = conn.cursor()
+        self.cursor = self.conn.cursor()
+
+    def __reconnect__(self):
+        """
+        Discards the current connection and obtains a fresh one from the pool
+        :return: None
+        """
+        self.pool.release(self.conn, discard=True)
+        self.conn = None
+        self.temp_tables = []
+        self.__connect__()
+
+    def close(self):
+        """
+        Returns the connection to the pool. The runner cannot be used afterwards. If server
+        statistics were turned on but not off again, e.g. as the query failed, the connection
+        is closed instead, so that later queries on it don't send statistics messages.
+        :return: None
+        """
+        if self.conn is not None:
+            discard = self.statistics_on
+            try:
+                self.__drop_temp_tables__()
+                self.cursor.close()
+            except pyodbc.Error as e:
+                # Don't return a connection that may still have temporary tables to the pool
+                logger.debug(e)
+                discard = True
+            self.pool.release(self.conn, discard=discard)
+            self.conn = None
+            self.cursor = None
 
     def run_query_and_return_results(self, query):
         """
         Runs the query and returns a cursor for the result set that can
-        be iterated over to obtain the data
+        be iterated over to obtain the data. If the connection has gone away
+        the query is retried once on a new connection. If server statistics are
+        enabled, SET STATISTICS TIME and IO are turned on for the query.
         :param query: a query tuple containing a prepared statement and parameter list
         :return: a pyodbc cursor for the result set
         """
-        return self.cursor.execute(query[0], query[1])
+        if self.server_statistics:
+            query = [SERVER_STATISTICS_ON + query[0]] + list(query[1:])
+            self.statistics_on = True
+        try:
+            return super().run_query_and_return_results(query)
+        except pyodbc.OperationalError as e:
+            logger.warning("Database connection failed; reconnecting")
+            logger.debug(e)
+            self.__reconnect__()
+            return super().run_query_and_return_results(query)
 
-    def get_headers(self):
+    def __load_temp_table__(self, name, values):
         """
-        Returns the column headers from a cursor. Must be run after run_query_and_return_results.
-        :return:
+        Bulk loads a temporary table, sending the values in as few round trips as possible
         """
-        return [x[0] for x in self.cursor.description]
+        self.cursor.fast_executemany = True
+        try:
+            super().__load_temp_table__(name, values)
+        finally:
+            self.cursor.fast_executemany = False
 
-    def run_query_and_save_results(self, query=None, file_name=None):
+    def __collect_server_statistics__(self, cursor):
         """
-        Runs the query and outputs the results to a file
-        :param query: a tuple containing the query and the parameters to run it with
-        :param file_name: the file to save
-        :return: None
+        Gets the SET STATISTICS TIME and IO messages for the last query. The final
+        execution times are only sent after the result set, so any remaining result
+        sets are skipped to receive them.
+        :param cursor: the cursor the query was run on
+        :return: a dict of server statistics, or None if they aren't enabled
         """
-        logger.debug("Running query using ODBC")
-        rows = self.run_query_and_return_results(query)
-        with open(file_name, 'w', newline='') as csvfile:
-            writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
-            writer.writerow(self.get_headers())  # column headers
-            for row in rows:
-                writer.writerow(row)
+        if not self.server_statistics:
+            return None
+        messages = []
+        try:
+            messages.extend(message[1] for message in cursor.messages)
+            while cursor.nextset():
+                messages.extend(message[1] for message in cursor.messages)
+            cursor.execute(SERVER_STATISTICS_OFF)
+            self.statistics_on = False
+        except (pyodbc.Error, AttributeError) as e:
+            logger.warning("Unable to collect server statistics")
+            logger.debug(e)
+        return parse_server_statistics(messages)
+
+
+def create_query_runner(config=_config):
+    """
+    Creates a query runner of the type set in config.ini
+    :param config: the Config object to use
+    :return: a QueryRunner
+    """
+    if config.get_runner_type() == SQLITE_RUNNER:
+        # Imported here as the SQLite runner module depends on this one
+        from dataquery_processor.sqlite_runner import SqliteQueryRunner
+        return SqliteQueryRunner(config=config)
+    return OdbcQueryRunner(config=config)
+
+
+def merge_partition_rows(merged, rows, measures=1):
+    """
+    Adds the rows from one partition to the merged results. Each row is a set of
+    group by values followed by the summed measures; rows with the same group by
+    values are combined by adding their measures.
+    :param merged: a dict of group by values to a list of measures, updated in place
+    :param rows: the rows from the partition
+    :param measures: the number of measure columns at the end of each row
+    :return: None
+    """
+    for row in rows:
+        key = tuple(row[:-measures])
+        values = list(row[-measures:])
+        if key not in merged:
+            merged[key] = values
+            continue
+        totals = merged[key]
+        for index, value in enumerate(values):
+            if totals[index] is None:
+                totals[index] = value
+            elif value is not None:
+                totals[index] += value
+
+
+def get_merged_row_sort_key(key):
+    """
+    Gets a sort key for the group by values of a merged row, with None sorted last
+    :param key: a tuple of group by values
+    :return: a tuple that can be compared with the sort key of any other row
+    """
+    return tuple((value is None, '' if value is None else value) for value in key)
+
+
+def run_partitioned_query_and_save_results(queries, file_name, config=_config, measures=1):
+    """
+    Runs a set of partition queries concurrently, each on its own connection, merging
+    each batch of aggregated results as it is fetched, then saves them to a file sorted
+    by their group by values, so the file is the same whichever partition finishes first.
+    The time taken by each partition is logged so that skew between partitions can be seen.
+    :param queries: a list of (partition name, query) tuples, e.g. from QueryBuilder.create_partitioned_queries
+    :param file_name: the file to save
+    :param config: the Config object to use
+    :param measures: the number of measure columns at the end of each row
+    :return: FetchStatistics for the merged result
+    """
+    fetch_configuration = config.get_fetch_configuration()
+    statistics = FetchStatistics()
+    merged = {}
+    merged_lock = threading.Lock()
+
+    def run_partition(partition, query):
+        started = time.monotonic()
+        with database_slot(config):
+            runner = create_query_runner(config=config)
+            try:
+                partition_statistics = FetchStatistics()
+                runner.cursor.arraysize = fetch_configuration['batch_size']
+                cursor = runner.run_query_and_return_results(query)
+                partition_statistics.execute_finished()
+                headers = runner.get_headers()
+                for batch in fetch_batches(cursor, fetch_configuration['batch_size'], fetch_configuration['memory_limit']):
+                    partition_statistics.row_received()
+                    partition_statistics.rows += len(batch)
+                    with merged_lock:
+                        merge_partition_rows(merged, batch, measures=measures)
+                partition_statistics.finish()
+                partition_statistics.server = runner.__collect_server_statistics__(cursor)
+            finally:
+                runner.close()
+        logger.info("Partition {0} returned {1} rows in {2:.3f}s".format(partition, partition_statistics.rows,
+                                                                          time.monotonic() - started))
+        return headers, dict(partition=partition, **partition_statistics.as_dict())
+
+    headers = None
+    workers = max(1, min(config.get_partition_configuration()['concurrency'], len(queries)))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        futures = [executor.submit(run_partition, partition, query) for partition, query in queries]
+        for future in futures:
+            headers, partition_statistics = future.result()
+            statistics.partitions.append(partition_statistics)
+
+    with open(file_name, 'w', newline='') as csvfile:
+        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(headers)  # column headers
+        writer.writerows(key + tuple(merged[key]) for key in sorted(merged, key=get_merged_row_sort_key))
+        statistics.rows = len(merged)
+        statistics.bytes_written = csvfile.tell()
+    statistics.finish()
+    logger.info("Merged {rows} rows ({bytesWritten} bytes) from {partitions} partitions in {seconds}s"
+                .format(**dict(statistics.as_dict(), partitions=len(queries))))
+    return statistics
@@ -1,7 +1,7 @@
-import boto3
 import json
 import logging
 from dataquery_processor import _config
+from dataquery_processor.aws_clients import get_client
 logger = logging.getLogger(__name__)
 
 
@@ -49,23 +49,22 @@ class QueueController(object):
     Wrapper class for an SQS queue
     """
 
-    def __init__(self):
+    def __init__(self, load_messages=True):
         """
         Create the instance using configuration supplied in config.ini
+        :param load_messages: whether to load messages from the queue straight away; not
+        needed e.g. to delete messages delivered by a Lambda event
         """
         self.messages = []
         config = _config.get_queue_configuration()
-        if 'profile' in config and config['profile'] != '':
-            session = boto3.Session(profile_name=config['profile'])
-        else:
-            session = boto3.Session()
-        self.sqsClient = session.client('sqs', region_name=config['region'])
+        self.sqsClient = get_client('sqs', profile=config['profile'], region=config['region'])
         self.queue = config['queue']
 
         #
         # Load messages as soon as initialised
         #
-        self.load_messages()
+        if load_messages:
+            self.load_messages()
 
     def load_messages(self):
         """
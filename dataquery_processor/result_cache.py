@@ -0,0 +1,252 @@
+import gzip
+import hashlib
+import json
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+from botocore.exceptions import ClientError
+from datetime import datetime, timezone
+from dataquery_processor import _config
+from dataquery_processor.aws_clients import get_client
+from dataquery_processor.storage_controller import create_transfer_config
+
+logger = logging.getLogger(__name__)
+
+"""
+Cache of query results, so that repeat orders for the same data can skip the
+database. Results are stored as gzipped CSV files under a local folder or an
+S3 prefix, grouped by the table they were queried from so that all results for
+a datasource can be invalidated when it is refreshed.
+"""
+
+CACHE_FILE_EXTENSION = '.csv.gz'
+
+
+class ResultCache(object):
+    """
+    Factory and wrapper for the configured cache backend
+    """
+
+    def __init__(self, config=_config):
+        self.config = config
+        cache_configuration = config.get_cache_configuration()
+        self.enabled = cache_configuration['enabled']
+        self.ttl = cache_configuration['ttl']
+        self.max_size = cache_configuration['max_size']
+        location = cache_configuration['location']
+        if not self.enabled:
+            self.backend = None
+        elif location.startswith('s3://'):
+            bucket, _, prefix = location[len('s3://'):].partition('/')
+            self.backend = S3CacheBackend(bucket, prefix, config=config)
+        else:
+            self.backend = LocalCacheBackend(location)
+
+    def make_key(self, query_builder, query):
+        """
+        Creates a cache key from the query text and its parameters. The allowed values
+        for each constraint are sorted, so orders that only list them in a different
+        order share an entry.
+        :param query_builder: the QueryBuilder used to create the query
+        :param query: the query tuple created by the query builder
+        :return: a key of the form table/hash, using the base table even if the query
+        was routed to a rollup so that invalidating the base table removes it
+        """
+        normalised = [self.config.conn, query[0], query_builder.get_normalised_parameters()]
+        digest = hashlib.sha256(json.dumps(normalised, default=str).encode('utf-8')).hexdigest()
+        return query_builder.base_table + '/' + digest
+
+    def get(self, key, file_name):
+        """
+        Copies a cached result to a file
+        :param key: the cache key
+        :param file_name: the CSV file to write
+        :return: True if the result was in the cache, otherwise False
+        """
+        if not self.enabled:
+            return False
+        try:
+            hit = self.backend.get(key + CACHE_FILE_EXTENSION, file_name, self.ttl)
+        except Exception as e:
+            logger.warning("Could not read from the result cache")
+            logger.debug(e)
+            return False
+        logger.info("Result cache " + ("hit" if hit else "miss") + " for " + key)
+        return hit
+
+    def put(self, key, file_name):
+        """
+        Stores a result CSV file in the cache, evicting old entries if the
+        cache is over its size limit. Failures are logged but not raised.
+        :param key: the cache key
+        :param file_name: the CSV file to store
+        :return: None
+        """
+        if not self.enabled:
+            return
+        try:
+            self.backend.put(key + CACHE_FILE_EXTENSION, file_name)
+            self.backend.evict(self.ttl, self.max_size)
+        except Exception as e:
+            logger.warning("Could not write to the result cache")
+            logger.debug(e)
+
+    def invalidate(self, table):
+        """
+        Removes all cached results for a table
+        :param table: the table name
+        :return: None
+        """
+        logger.info("Invalidating cached results for " + table)
+        if self.enabled:
+            self.backend.invalidate(table + '/')
+
+
+class LocalCacheBackend(object):
+    """
+    Stores cached results in a local folder. Access times are updated on
+    each hit and used to evict the least recently used entries.
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+    def get(self, name, file_name, ttl):
+        path = self.path + os.sep + name
+        if not os.path.exists(path):
+            return False
+        stat = os.stat(path)
+        if time.time() - stat.st_mtime > ttl:
+            os.remove(path)
+            return False
+        with gzip.open(path, 'rb') as source, open(file_name, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        os.utime(path, (time.time(), stat.st_mtime))
+        return True
+
+    def put(self, name, file_name):
+        path = self.path + os.sep + name
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temporary file first so readers never see a partial entry
+        handle, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with open(file_name, 'rb') as source, os.fdopen(handle, 'wb') as temp_file, \
+                gzip.GzipFile(fileobj=temp_file, mode='wb') as target:
+            shutil.copyfileobj(source, target)
+        os.replace(temp_path, path)
+
+    def evict(self, ttl, max_size):
+        entries = []
+        now = time.time()
+        for folder, _, files in os.walk(self.path):
+            for name in files:
+                if not name.endswith(CACHE_FILE_EXTENSION):
+                    continue
+                path = os.path.join(folder, name)
+                stat = os.stat(path)
+                if now - stat.st_mtime > ttl:
+                    os.remove(path)
+                else:
+                    entries.append((stat.st_atime, stat.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= max_size:
+                break
+            logger.debug("Evicting cached result " + path)
+            os.remove(path)
+            total -= size
+
+    def invalidate(self, prefix):
+        path = self.path + os.sep + prefix
+        if os.path.exists(path):
+            shutil.rmtree(path)
+
+
+class S3CacheBackend(object):
+    """
+    Stores cached results under an S3 prefix. The creation time is kept in the
+    object metadata for the TTL check; hits copy the object onto itself so that
+    LastModified records the last access for least recently used eviction.
+    """
+
+    def __init__(self, bucket, prefix, config=_config):
+        storage_configuration = config.get_storage_configuration()
+        self.s3client = get_client('s3', profile=storage_configuration['profile'],
+                                   region=storage_configuration['region'], config=config)
+        self.transfer_config = create_transfer_config(config)
+        self.bucket = bucket
+        self.prefix = prefix if prefix == '' or prefix.endswith('/') else prefix + '/'
+
+    def get(self, name, file_name, ttl):
+        key = self.prefix + name
+        try:
+            head = self.s3client.head_object(Bucket=self.bucket, Key=key)
+        except ClientError:
+            return False
+        created = float(head['Metadata'].get('created', head['LastModified'].timestamp()))
+        if time.time() - created > ttl:
+            self.s3client.delete_object(Bucket=self.bucket, Key=key)
+            return False
+        body = self.s3client.get_object(Bucket=self.bucket, Key=key)['Body']
+        with gzip.GzipFile(fileobj=body, mode='rb') as source, open(file_name, 'wb') as target:
+            shutil.copyfileobj(source, target)
+        self.s3client.copy_object(Bucket=self.bucket, Key=key, CopySource={'Bucket': self.bucket, 'Key': key},
+                                  Metadata=head['Metadata'], MetadataDirective='REPLACE')
+        return True
+
+    def put(self, name, file_name):
+        with tempfile.TemporaryFile() as temp_file:
+            with open(file_name, 'rb') as source, gzip.GzipFile(fileobj=temp_file, mode='wb') as target:
+                shutil.copyfileobj(source, target)
+            temp_file.seek(0)
+            self.s3client.upload_fileobj(temp_file, self.bucket, self.prefix + name,
+                                         ExtraArgs={'Metadata': {'created': str(time.time())}},
+                                         Config=self.transfer_config)
+
+    def evict(self, ttl, max_size):
+        entries = []
+        now = datetime.now(timezone.utc)
+        for item in self.__list__(self.prefix):
+            # LastModified is never earlier than the creation time, so this only removes expired entries
+            if (now - item['LastModified']).total_seconds() > ttl:
+                self.s3client.delete_object(Bucket=self.bucket, Key=item['Key'])
+            else:
+                entries.append((item['LastModified'], item['Size'], item['Key']))
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in sorted(entries):
+            if total <= max_size:
+                break
+            logger.debug("Evicting cached result " + key)
+            self.s3client.delete_object(Bucket=self.bucket, Key=key)
+            total -= size
+
+    def invalidate(self, prefix):
+        for item in self.__list__(self.prefix + prefix):
+            self.s3client.delete_object(Bucket=self.bucket, Key=item['Key'])
+
+    def __list__(self, prefix):
+        paginator = self.s3client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix):
+            for item in page.get('Contents', []):
+                yield item
+
+
+def invalidate_datasource(datasource, config=_config):
+    """
+    Removes all cached results for a datasource; call this when the
+    underlying table has been refreshed.
+    :param datasource: the datasource name, as used in order manifests
+    :param config: the Config object to use
+    :return: None
+    """
+    table = config.get_table_mapping(datasource)
+    if table is None:
+        raise ValueError("The datasource does not map to a table")
+    ResultCache(config=config).invalidate(table)
+
+
+if __name__ == "__main__":
+    for datasource_name in sys.argv[1:]:
+        invalidate_datasource(datasource_name)
@@ -0,0 +1,71 @@
+import logging
+import sys
+import time
+from pypika import Table, MSSQLQuery as Query, functions as fn
+from dataquery_processor import _config
+from dataquery_processor.query_runner import create_query_runner
+
+logger = logging.getLogger(__name__)
+
+"""
+Builds the pre-aggregated rollup tables declared in config.ini from their base tables.
+QueryBuilder routes orders to these tables when they have all the columns an order needs.
+"""
+
+
+def create_rollup_query(rollup):
+    """
+    Constructs a SELECT INTO statement that builds the rollup table from its base table,
+    summing each measure over the rollup's columns
+    :param rollup: a rollup from Config.get_rollups
+    :return: the SQL statement
+    """
+    base_table = Table(rollup['base_table'], schema='dbo')
+    select_fields = [base_table[column] for column in rollup['columns']]
+    for measure in rollup['measures']:
+        select_fields.append(fn.Sum(base_table[measure], measure))
+    q = Query().\
+        from_(base_table).\
+        select(*select_fields).\
+        groupby(*[base_table[column] for column in rollup['columns']]).\
+        into(Table(rollup['name'], schema='dbo'))
+    return q.get_sql()
+
+
+def refresh_rollup(rollup, config=_config):
+    """
+    Drops and rebuilds a rollup table
+    :param rollup: a rollup from Config.get_rollups
+    :param config: the Config object to use
+    :return: None
+    """
+    started = time.monotonic()
+    runner = create_query_runner(config=config)
+    try:
+        runner.execute('DROP TABLE IF EXISTS ' + Table(rollup['name'], schema='dbo').get_sql(quote_char='"'))
+        runner.execute(create_rollup_query(rollup))
+    finally:
+        runner.close()
+    logger.info("Refreshed rollup {0} from {1} in {2:.3f}s".format(rollup['name'], rollup['base_table'],
+                                                                    time.monotonic() - started))
+
+
+def refresh_rollups(names=None, config=_config):
+    """
+    Drops and rebuilds rollup tables
+    :param names: the rollup tables to refresh, or None for all of them
+    :param config: the Config object to use
+    :return: None
+    """
+    rollups = config.get_rollups()
+    if names:
+        unknown = set(names) - set(rollup['name'] for rollup in rollups)
+        if len(unknown) > 0:
+            raise ValueError("No rollup is declared for " + ", ".join(sorted(unknown)))
+        rollups = [rollup for rollup in rollups if rollup['name'] in names]
+    for rollup in rollups:
+        refresh_rollup(rollup, config=config)
+
+
+if __name__ == "__main__":
+    refresh_rollups(sys.argv[1:])
@@ -0,0 +1,100 @@
+import logging
+import os
+import shutil
+import tempfile
+import threading
+from dataquery_processor import _config
+from dataquery_processor.pathutils import sanitise_filename
+
+logger = logging.getLogger(__name__)
+
+"""
+Module for managing temporary files. Each order gets its own scratch folder,
+so orders running at the same time in one process or container cannot
+overwrite each other's files.
+"""
+
+_active = set()
+_active_lock = threading.Lock()
+
+
+class ScratchSpace(object):
+    """
+    A private temporary folder for one order
+    """
+
+    def __init__(self, name='order', config=_config):
+        """
+        Creates the folder under the configured scratch root
+        :param name: a name to identify the folder, e.g. the order reference
+        :param config: the Config object to use
+        """
+        scratch_configuration = config.get_scratch_configuration()
+        self.root = scratch_configuration['root']
+        self.limit = scratch_configuration['limit']
+        try:
+            prefix = sanitise_filename(str(name)) + '-'
+        except ValueError:
+            prefix = 'order-'
+        os.makedirs(self.root, exist_ok=True)
+        self.path = tempfile.mkdtemp(prefix=prefix, dir=self.root)
+        with _active_lock:
+            _active.add(self)
+
+    def get_path(self, filename):
+        """
+        Gets the path of a file in the scratch folder
+        :param filename: the file name
+        :return: the full path
+        """
+        return self.path + os.sep + filename
+
+    def usage(self):
+        """
+        :return: the number of bytes used by files in the scratch folder
+        """
+        total = 0
+        for folder, _, files in os.walk(self.path):
+            for name in files:
+                try:
+                    total += os.path.getsize(os.path.join(folder, name))
+                except OSError:
+                    # The file was removed while we were counting
+                    pass
+        return total
+
+    def report(self, stage=''):
+        """
+        Logs the disk used by this order and by all active orders against the
+        ephemeral storage limit, with a warning when the total is near the limit
+        :param stage: a description of the processing stage, for the log
+        :return: the total bytes used by all active scratch folders
+        """
+        used = self.usage()
+        total = total_usage()
+        message = "Scratch usage {0}: {1:.1f} MB for this order, {2:.1f} of {3:.0f} MB in total".format(
+            stage, used / 1048576, total / 1048576, self.limit / 1048576)
+        if total > self.limit * 0.8:
+            logger.warning(message)
+        else:
+            logger.info(message)
+        return total
+
+    def cleanup(self):
+        """
+        Deletes the scratch folder and everything in it
+        :return: None
+        """
+        with _active_lock:
+            _active.discard(self)
+        if os.path.exists(self.path):
+            shutil.rmtree(self.path, ignore_errors=True)
+
+
+def total_usage():
+    """
+    :return: the bytes used by all active scratch folders in the process
+    """
+    with _active_lock:
+        spaces = list(_active)
+    return sum(space.usage() for space in spaces)
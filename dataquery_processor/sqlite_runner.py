@@ -0,0 +1,105 @@
+import csv
+import logging
+import os
+import re
+import sqlite3
+from dataquery_processor import _config
+from dataquery_processor.query_runner import QueryRunner
+
+logger = logging.getLogger(__name__)
+
+"""
+Query runner for a local SQLite database, so that orders can be run end to end
+without SQL Server or pyodbc, e.g. on a development machine or in CI benchmarks.
+"""
+
+SCHEMA = 'dbo'
+
+TOP_PATTERN = re.compile(r'^SELECT TOP \(?(\d+)\)? ', re.IGNORECASE)
+SELECT_INTO_PATTERN = re.compile(r'^SELECT (.*?) INTO ("[^"]+"\."[^"]+"|"[^"]+") FROM ', re.IGNORECASE | re.DOTALL)
+
+
+class SqliteQueryRunner(QueryRunner):
+    """
+    Runs queries against a SQLite database file attached as the dbo schema, so the
+    schema-qualified table names generated by QueryBuilder work unchanged.
+    """
+
+    def __init__(self, config=_config):
+        self.sqlite_configuration = config.get_sqlite_configuration()
+        super().__init__(config=config)
+
+    def __connect__(self):
+        database = self.sqlite_configuration['database']
+        if database != ':memory:' and os.path.dirname(database) != '':
+            os.makedirs(os.path.dirname(database), exist_ok=True)
+        self.conn = sqlite3.connect(':memory:')
+        self.conn.execute('ATTACH DATABASE ? AS ' + SCHEMA, (database,))
+        self.cursor = self.conn.cursor()
+        table = self.sqlite_configuration['table']
+        data_file = self.sqlite_configuration['data_file']
+        if table is not None and data_file is not None and not self.table_exists(table):
+            if os.path.exists(data_file):
+                self.load_table(table, data_file, self.sqlite_configuration['setup_script'])
+            else:
+                logger.warning("Table " + table + " does not exist and data file " + data_file + " was not found")
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+            self.cursor = None
+            self.temp_tables = []
+
+    def translate(self, sql):
+        """
+        Translates MSSQL syntax that SQLite doesn't support. GROUPING SETS and
+        GROUPING_ID have no SQLite equivalent, so coalesced batches fall back to
+        running each order's own query.
+        :param sql: the SQL statement
+        :return: the translated SQL statement
+        """
+        match = TOP_PATTERN.match(sql)
+        if match is not None:
+            sql = 'SELECT ' + sql[match.end():] + ' LIMIT ' + match.group(1)
+        match = SELECT_INTO_PATTERN.match(sql)
+        if match is not None:
+            sql = 'CREATE TABLE ' + match.group(2) + ' AS SELECT ' + match.group(1) + ' FROM ' + sql[match.end():]
+        return sql
+
+    def table_exists(self, table):
+        """
+        :param table: the table name
+        :return: True if the table exists in the dbo schema
+        """
+        self.cursor.execute('SELECT name FROM ' + SCHEMA + '.sqlite_master WHERE type = ? AND name = ?', ('table', table))
+        return self.cursor.fetchone() is not None
+
+    def load_table(self, table, data_file, setup_script=None):
+        """
+        Loads a table from a CSV file, first running a setup script to create the table
+        if one is given. Columns in the table but not in the file get their defaults.
+        :param table: the table name
+        :param data_file: the CSV file with a header row
+        :param setup_script: an SQL script that creates the table, e.g. test/build.sql
+        :return: the number of rows loaded
+        """
+        logger.info("Loading table " + table + " from " + data_file)
+        if setup_script is not None:
+            with open(setup_script, encoding='utf-8') as f:
+                self.conn.executescript(f.read())
+        with open(data_file, encoding='utf-8', newline='') as f:
+            reader = csv.reader(f)
+            headers = next(reader)
+            if setup_script is None:
+                self.conn.execute('CREATE TABLE ' + SCHEMA + '.' + quote(table) + ' (' +
+                                  ','.join(quote(header) for header in headers) + ')')
+            statement = 'INSERT INTO ' + SCHEMA + '.' + quote(table) + ' (' + ','.join(quote(header) for header in headers) + \
+                        ') VALUES (' + ','.join('?' for header in headers) + ')'
+            self.conn.executemany(statement, reader)
+        self.conn.commit()
+        return self.conn.execute('SELECT COUNT(*) FROM ' + SCHEMA + '.' + quote(table)).fetchone()[0]
+
+
+def quote(identifier):
+    return '"' + identifier.replace('"', '""') + '"'
@@ -1,15 +1,25 @@
+import io
 import shutil
-import boto3
 import logging
 import os
 import json
 import csv
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from boto3.s3.transfer import TransferConfig
 from datetime import datetime
 from dataquery_processor import _config
 from dataquery_processor.pathutils import sanitise_filename
+from dataquery_processor.concurrency import upload_slot
+from dataquery_processor.aws_clients import get_client
 
 logger = logging.getLogger(__name__)
 
+# S3 requires every part of a multipart upload except the last to be at least 5 MB
+MIN_PART_SIZE = 5 * 1024 * 1024
+# zlib window bits for gzip output
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
 """
 Module for handling storage abstraction
 """
@@ -59,6 +69,9 @@ class StorageController(object):
     def store_file(self, filename, file_to_store):
         self.controller.store_file(filename, file_to_store)
 
+    def create_upload_sink(self, filename):
+        return self.controller.create_upload_sink(filename)
+
     def rollback(self):
         self.controller.rollback()
 
@@ -70,14 +83,15 @@ class StorageController(object):
 
 
 class S3StorageController(object):
+    """
+    Stores outputs in S3. Objects such as the manifest and SQL are serialised in memory and
+    uploaded with put_object; files are uploaded using the configured TransferConfig.
+    """
 
     def __init__(self, client=None, order_reference='', customer_reference=''):
         self.config = _config.get_storage_configuration()
-        if 'profile' in self.config and self.config['profile'] != '':
-            session = boto3.Session(profile_name=self.config['profile'])
-        else:
-            session = boto3.Session()
-        self.s3client = session.client('s3', region_name=self.config['region'])
+        self.s3client = get_client('s3', profile=self.config['profile'], region=self.config['region'])
+        self.transfer_config = create_transfer_config()
         self.bucket = self.config['bucket']
         self.subfolder = self.config['subfolder']
         self.client = client
@@ -86,39 +100,58 @@ class S3StorageController(object):
         self.resource_path = create_resource_path(self.order_reference, customer_reference=self.customer_reference)
         self.output_path = create_output_path(self.client, self.resource_path)
 
-    def store_object(self, resource_name, path):
-        resource_name = self.client + os.sep + resource_name
-        try:
-            self.s3client.upload_file(path, self.bucket,self.subfolder, resource_name)
-
-        except Exception as e:
-            logger.error("Error saving object in S3")
-            raise e
+    def store_object(self, filename, object_to_store):
+        self.__put_object__(self.get_resource_path(filename=filename), object_to_store.encode('utf-8'))
 
     def store_object_as_text(self, filename, object_to_store):
-        resource_name = self.get_resource_path(filename=filename)
-        temp_file_path = '/tmp' + os.sep + filename
-        store_text_file(temp_file_path, object_to_store)
-        self.store_object(resource_name, temp_file_path)
+        self.store_object(filename, object_to_store)
 
     def store_object_as_json(self, filename, json_object):
-        resource_name = self.get_resource_path(filename=filename)
-        temp_file_path = '/tmp' + os.sep + filename
-        store_json_file(temp_file_path, json_object)
-        self.store_object(resource_name, temp_file_path)
+        self.store_object(filename, format_json(json_object))
 
     def store_object_as_csv(self, filename, object_to_store, headers=None):
-        resource_name = self.get_resource_path(filename=filename)
-        temp_file_path = '/tmp' + os.sep + filename
-        store_csv_file(temp_file_path, object_to_store, headers)
-        self.store_object(resource_name, temp_file_path)
+        buffer = io.StringIO(newline='')
+        write_csv(buffer, object_to_store, headers)
+        self.store_object(filename, buffer.getvalue())
 
     def rollback(self):
         pass
 
     def store_file(self, filename, file_to_store):
-        resource_name = self.get_resource_path(filename)
-        self.store_object(resource_name, file_to_store)
+        key = self.__get_key__(self.get_resource_path(filename))
+        try:
+            with upload_slot():
+                self.s3client.upload_file(file_to_store, self.bucket, key, Config=self.transfer_config)
+        except Exception as e:
+            logger.error("Error saving object in S3")
+            raise e
+
+    def create_upload_sink(self, filename):
+        """
+        Creates a sink that uploads the results of a query as CSV while they are fetched, for use
+        with QueryRunner.run_query_and_save_results, if streaming results is enabled
+        :param filename: the file name for the CSV, without any .gz extension
+        :return: an S3MultipartSink, or None if results aren't streamed
+        """
+        if not self.config['stream_results']:
+            return None
+        if self.config['gzip_results']:
+            filename = filename + '.gz'
+        return S3MultipartSink(self.s3client, self.bucket, self.__get_key__(self.get_resource_path(filename)),
+                               filename, part_size=self.config['multipart_chunksize'],
+                               compress=self.config['gzip_results'],
+                               concurrency=self.config['max_concurrency'])
+
+    def __put_object__(self, resource_name, body):
+        try:
+            with upload_slot():
+                self.s3client.put_object(Bucket=self.bucket, Key=self.__get_key__(resource_name), Body=body)
+        except Exception as e:
+            logger.error("Error saving object in S3")
+            raise e
+
+    def __get_key__(self, resource_name):
+        return self.subfolder + self.client + '/' + resource_name
 
     def get_resource_path(self, filename=None):
         if filename is None:
@@ -133,6 +166,111 @@ class S3StorageController(object):
             return self.output_path + os.sep + self.resource_path + os.sep + filename
 
 
+class S3MultipartSink(object):
+    """
+    Writes the results of a query as CSV to an S3 multipart upload, optionally gzipped. Each
+    part is uploaded in the background as soon as it is full, so the upload overlaps with the
+    query and the results never need to fit on local disk. If the query fails, the multipart
+    upload is aborted.
+    """
+
+    def __init__(self, s3client, bucket, key, filename, part_size, compress=False, concurrency=4):
+        """
+        :param s3client: the S3 client
+        :param bucket: the bucket to upload to
+        :param key: the key of the object
+        :param filename: the file name of the object, e.g. data.csv
+        :param part_size: the size of each part; S3 requires at least 5 MB for all but the last
+        :param compress: whether to gzip the CSV
+        :param concurrency: the most parts to upload, or hold in memory, at once
+        """
+        self.s3client = s3client
+        self.bucket = bucket
+        self.key = key
+        self.filename = filename
+        self.part_size = max(part_size, MIN_PART_SIZE)
+        self.compressor = zlib.compressobj(wbits=GZIP_WBITS) if compress else None
+        self.concurrency = max(1, concurrency)
+        self.buffer = bytearray()
+        self.bytes = 0
+        self.parts = []
+        self.closed = False
+        self.executor = ThreadPoolExecutor(max_workers=self.concurrency)
+        content_type = 'application/gzip' if compress else 'text/csv'
+        self.upload_id = self.s3client.create_multipart_upload(Bucket=self.bucket, Key=self.key,
+                                                               ContentType=content_type)['UploadId']
+
+    def write_header(self, headers):
+        self.write_rows([headers])
+
+    def write_rows(self, rows):
+        text = io.StringIO(newline='')
+        csv.writer(text, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+        data = text.getvalue().encode('utf-8')
+        self.bytes += len(data)
+        if self.compressor is not None:
+            data = self.compressor.compress(data)
+        self.buffer += data
+        if len(self.buffer) >= self.part_size:
+            self.__upload_part__()
+
+    def bytes_written(self):
+        return self.bytes
+
+    def close(self):
+        """
+        Uploads the last part and completes the upload, unless it was aborted
+        :return: None
+        """
+        if self.closed:
+            return
+        try:
+            if self.compressor is not None:
+                self.buffer += self.compressor.flush()
+            if len(self.buffer) > 0 or len(self.parts) == 0:
+                self.__upload_part__()
+            parts = [part.result() for part in self.parts]
+            self.s3client.complete_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                    MultipartUpload={'Parts': parts})
+            self.closed = True
+            self.executor.shutdown()
+        except Exception as e:
+            logger.error("Error completing the upload of " + self.key)
+            self.abort()
+            raise e
+
+    def abort(self):
+        """
+        Abandons the upload, removing any parts already uploaded
+        :return: None
+        """
+        if self.closed:
+            return
+        self.closed = True
+        for part in self.parts:
+            part.cancel()
+        self.executor.shutdown(wait=True)
+        try:
+            self.s3client.abort_multipart_upload(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id)
+        except Exception as e:
+            logger.error("Error aborting the upload of " + self.key)
+            logger.debug(e)
+
+    def __upload_part__(self):
+        # Wait for the oldest part if too many are in flight, so memory use stays bounded
+        if len(self.parts) >= self.concurrency:
+            self.parts[len(self.parts) - self.concurrency].result()
+        data = bytes(self.buffer)
+        self.buffer = bytearray()
+        self.parts.append(self.executor.submit(self.__put_part__, len(self.parts) + 1, data))
+
+    def __put_part__(self, part_number, data):
+        with upload_slot():
+            response = self.s3client.upload_part(Bucket=self.bucket, Key=self.key, UploadId=self.upload_id,
+                                                 PartNumber=part_number, Body=data)
+        return {'PartNumber': part_number, 'ETag': response['ETag']}
+
+
 class FileStorageController(object):
 
     def __init__(self, client, order_reference='', customer_reference=''):
@@ -171,6 +309,9 @@ class FileStorageController(object):
     def store_object_as_text(self, filename, object_to_store):
         self.store_object(filename, object_to_store)
 
+    def create_upload_sink(self, filename):
+        return None
+
     def rollback(self):
         """
         Deletes all files and folders created by a failed processing attempt
@@ -180,8 +321,16 @@ class FileStorageController(object):
         if os.path.exists(self.output_path):
             if os.path.exists(self.output_path + os.sep + "query.sql"):
                 os.remove(self.output_path + os.sep + "query.sql")
+            if os.path.exists(self.output_path + os.sep + "query_stats.json"):
+                os.remove(self.output_path + os.sep + "query_stats.json")
             if os.path.exists(self.output_path + os.sep + "data.csv"):
                 os.remove(self.output_path + os.sep + "data.csv")
+            if os.path.exists(self.output_path + os.sep + "pivot.xlsx"):
+                os.remove(self.output_path + os.sep + "pivot.xlsx")
+            if os.path.exists(self.output_path + os.sep + "notes.xlsx"):
+                os.remove(self.output_path + os.sep + "notes.xlsx")
+            if os.path.exists(self.output_path + os.sep + "data.parquet"):
+                os.remove(self.output_path + os.sep + "data.parquet")
             if os.path.exists(self.output_path + os.sep + "manifest.json"):
                 os.remove(self.output_path + os.sep + "manifest.json")
             os.rmdir(self.output_path)
@@ -218,6 +367,15 @@ def store_text_file(filename, object_to_store):
         file.write(output)
 
 
+def format_json(object_to_store):
+    """
+    Serialises an object as JSON in the format used for stored files
+    :param object_to_store: the object
+    :return: the JSON text
+    """
+    return json.dumps(object_to_store, cls=DateTimeEncoder, indent=4, separators=(", ", ": "), sort_keys=True)
+
+
 def store_json_file(filename, object_to_store):
     """
     Generic method to locally store a JSON file
@@ -226,8 +384,21 @@ def store_json_file(filename, object_to_store):
     :return:
     """
     with open(filename, "w", encoding='utf-8') as file:
-        output = json.dumps(object_to_store, cls=DateTimeEncoder, indent=4, separators=(", ", ": "), sort_keys=True)
-        file.write(output)
+        file.write(format_json(object_to_store))
+
+
+def write_csv(file, object_to_store, headers):
+    """
+    Writes data as CSV to a file object opened with newline=''
+    :param file: the file object
+    :param object_to_store: the data as a list
+    :param headers: a list of column headers
+    :return: None
+    """
+    writer = csv.writer(file, quoting=csv.QUOTE_NONNUMERIC)
+    writer.writerow(headers)  # column headers
+    for row in object_to_store:
+        writer.writerow(row)
 
 
 def store_csv_file(filename, object_to_store, headers):
@@ -239,10 +410,19 @@ def store_csv_file(filename, object_to_store, headers):
     :return:
     """
     with open(filename, 'w', newline='') as csvfile:
-        writer = csv.writer(csvfile, quoting=csv.QUOTE_NONNUMERIC)
-        writer.writerow(headers)  # column headers
-        for row in object_to_store:
-            writer.writerow(row)
+        write_csv(csvfile, object_to_store, headers)
+
+
+def create_transfer_config(config=_config):
+    """
+    Creates the TransferConfig for uploading files to S3, from the [s3] section of the config
+    :param config: the Config object to use
+    :return: a TransferConfig
+    """
+    storage_configuration = config.get_storage_configuration()
+    return TransferConfig(multipart_threshold=storage_configuration['multipart_threshold'],
+                          multipart_chunksize=storage_configuration['multipart_chunksize'],
+                          max_concurrency=storage_configuration['max_concurrency'])
 
 
 def create_output_path(client, resource_path):
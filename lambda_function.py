@@ -1,7 +1,8 @@
 import logging
 
-from dataquery_processor import OrderProcessor, QueueController
+from dataquery_processor import QueueController
 from dataquery_processor.queue_controller import Message
+from dataquery_processor.concurrency import process_messages
 
 logger = logging.getLogger()
 
@@ -9,15 +10,19 @@ logger = logging.getLogger()
 
 def lambda_handler(event, context):
     if 'Records' in event:
-        records = event['Records']
-        for record in records:
-            message = Message(record)
-            proc = OrderProcessor(message.order())
-            try:
-                proc.process()
+        messages = [Message(record) for record in event['Records']]
+        errors = []
+        q = None
+        for message, error in process_messages(messages):
+            if error is None:
                 logger.info("Job completed. Deleting message from queue")
-                q = QueueController()
+                # The messages came with the event, so the queue only needs a client to delete them
+                if q is None:
+                    q = QueueController(load_messages=False)
                 q.delete_message(message)
-            except Exception as e:
+            else:
                 logger.error("Job was not completed successfully; leaving message on queue")
-                raise e
+                errors.append(error)
+        # Completed orders have been deleted individually; raising returns the rest to the queue
+        if len(errors) > 0:
+            raise errors[0]
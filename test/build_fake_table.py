@@ -1,12 +1,17 @@
-import pyodbc
-import agate
-import agatesql
+import sys
 from dataquery_processor import _config
 
 # Use this to generate the table script for fake data from the CSV. You may need to amend it
 # manually, then import the data in a second step.
+#
+# Run with --sqlite to instead load build.sql and fake.csv into the SQLite database set in
+# the [sqlite] section of config.ini, for use with the sqlite query runner.
+
 
 def generate_script(f, table_name):
+    import agate
+    import agatesql
+
     fake = agate.Table.from_csv(f)
 
     statement = fake.to_sql_create_statement(
@@ -17,12 +22,32 @@ def generate_script(f, table_name):
     return statement
 
 
+def load_sqlite_table():
+    from dataquery_processor.sqlite_runner import SqliteQueryRunner
+
+    runner = SqliteQueryRunner(config=_config)
+    try:
+        rows = runner.load_table("fake", "fake.csv", setup_script="build.sql")
+    finally:
+        runner.close()
+    print("Loaded " + str(rows) + " rows into " + _config.get_sqlite_configuration()['database'])
+
+
+def create_odbc_table():
+    import pyodbc
+
+    print(_config.conn)
+    query = generate_script("fake.csv", "fake")
+    print(query)
+
+    with pyodbc.connect(_config.conn) as conn:
+        cursor = conn.cursor()
+        cursor.execute("DROP TABLE IF EXISTS dbo.fake")
+        cursor.execute(query)
 
-print(_config.conn)
-query = generate_script("fake.csv", "fake")
-print(query)
 
-with pyodbc.connect(_config.conn) as conn:
-    cursor = conn.cursor()
-    cursor.execute("DROP TABLE IF EXISTS dbo.fake")
-    cursor.execute(query)
+if __name__ == '__main__':
+    if '--sqlite' in sys.argv:
+        load_sqlite_table()
+    else:
+        create_odbc_table()
@@ -1,6 +1,7 @@
 import shutil
 import pytest
 import os
+from dataquery_processor.config import Config, SQLITE_RUNNER
 
 TEST_OUTPUT_FOLDER = "output" + os.sep + "demo"
 
@@ -9,11 +10,22 @@ def get_test_file_path(filename):
     return TEST_OUTPUT_FOLDER + os.sep + filename
 
 
+def get_sqlite_config():
+    # Runs queries against the fake table, loaded from test/fake.csv into the test output folder
+    config = Config()
+    config.config['runner'] = {'type': SQLITE_RUNNER}
+    config.config['sqlite'] = {'database': get_test_file_path('fake.sqlite'),
+                               'table': 'fake',
+                               'setup_script': 'test/build.sql',
+                               'data_file': 'test/fake.csv'}
+    return config
+
+
 @pytest.fixture(autouse=True)
 def run_around_tests():
     if os.path.exists(TEST_OUTPUT_FOLDER):
         shutil.rmtree(TEST_OUTPUT_FOLDER)
-    os.mkdir(TEST_OUTPUT_FOLDER)
+    os.makedirs(TEST_OUTPUT_FOLDER)
     yield
     if os.path.exists(TEST_OUTPUT_FOLDER):
         shutil.rmtree(TEST_OUTPUT_FOLDER)
\ No newline at end of file
@@ -0,0 +1,45 @@
+import boto3
+from dataquery_processor import aws_clients
+from dataquery_processor.config import Config
+from dataquery_processor.aws_clients import get_client, clear_clients
+
+
+class FakeSession(object):
+
+    created = 0
+
+    def __init__(self, profile_name=None):
+        FakeSession.created += 1
+        self.profile_name = profile_name
+
+    def client(self, service_name, region_name=None, config=None):
+        return (service_name, self.profile_name, region_name, config.max_pool_connections)
+
+
+def test_clients_are_reused(monkeypatch):
+    monkeypatch.setattr(boto3, "Session", FakeSession)
+    clear_clients()
+    try:
+        s3_client = get_client('s3', profile='', region='eu-west-2')
+        assert get_client('s3', profile=None, region='eu-west-2') is s3_client
+        assert s3_client == ('s3', None, 'eu-west-2', 50)
+        assert get_client('sqs', profile='', region='eu-west-2')[0] == 'sqs'
+        assert get_client('s3', profile='dev', region='eu-west-2')[1] == 'dev'
+        assert FakeSession.created == 2
+        assert len(aws_clients._clients) == 3
+    finally:
+        clear_clients()
+
+
+def test_clients_are_keyed_by_pool_size(monkeypatch):
+    monkeypatch.setattr(boto3, "Session", FakeSession)
+    clear_clients()
+    try:
+        config = Config()
+        config.get_concurrency_configuration()['aws_pool_connections'] = 10
+        s3_client = get_client('s3', region='eu-west-2')
+        assert get_client('s3', region='eu-west-2', config=config) == ('s3', None, 'eu-west-2', 10)
+        assert get_client('s3', region='eu-west-2') is s3_client
+        assert len(aws_clients._clients) == 2
+    finally:
+        clear_clients()
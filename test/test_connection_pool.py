@@ -0,0 +1,79 @@
+import pytest
+from dataquery_processor.connection_pool import ConnectionPool
+
+try:
+    import pyodbc
+except ImportError as e:
+    # pyodbc may be installed without the ODBC driver manager it loads, e.g. libodbc.so.2
+    pytest.skip("pyodbc can't be imported: " + str(e), allow_module_level=True)
+
+
+class FakeConnection(object):
+
+    def __init__(self):
+        self.closed = False
+
+    def cursor(self):
+        return FakeCursor(self)
+
+    def rollback(self):
+        if self.closed:
+            raise pyodbc.Error("Connection is closed")
+
+    def close(self):
+        self.closed = True
+
+
+class FakeCursor(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    def execute(self, sql):
+        if self.connection.closed:
+            raise pyodbc.OperationalError("Connection is closed")
+        return self
+
+    def fetchall(self):
+        return [(1,)]
+
+    def close(self):
+        pass
+
+
+def test_pool_reuses_connections(monkeypatch):
+    monkeypatch.setattr(pyodbc, "connect", lambda conn: FakeConnection())
+    pool = ConnectionPool("DSN=test", max_idle=1)
+    first = pool.acquire()
+    pool.release(first)
+    assert pool.acquire() is first
+
+
+def test_pool_discards_unhealthy_connections(monkeypatch):
+    monkeypatch.setattr(pyodbc, "connect", lambda conn: FakeConnection())
+    pool = ConnectionPool("DSN=test", max_idle=1)
+    first = pool.acquire()
+    pool.release(first)
+    first.closed = True
+    assert pool.acquire() is not first
+
+
+def test_pool_evicts_idle_connections(monkeypatch):
+    monkeypatch.setattr(pyodbc, "connect", lambda conn: FakeConnection())
+    pool = ConnectionPool("DSN=test", max_idle=1, idle_timeout=-1)
+    first = pool.acquire()
+    pool.release(first)
+    pool.evict_idle()
+    assert first.closed
+    assert len(pool.idle) == 0
+
+
+def test_pool_max_idle_limits_idle_connections(monkeypatch):
+    monkeypatch.setattr(pyodbc, "connect", lambda conn: FakeConnection())
+    pool = ConnectionPool("DSN=test", max_idle=1)
+    first = pool.acquire()
+    second = pool.acquire()
+    pool.release(first)
+    pool.release(second)
+    assert second.closed
+    assert len(pool.idle) == 1
@@ -1,5 +1,9 @@
 from dataquery_processor import ExcelHandler, OdbcQueryRunner, QueryBuilder
+from dataquery_processor import excel
+from dataquery_processor.excel import get_blank_template
+from dataquery_processor.config import Config
 from conftest import TEST_OUTPUT_FOLDER
+from openpyxl import load_workbook
 import os
 
 # TODO for these tests also read and check the output
@@ -98,3 +102,259 @@ def test_write_excel_from_file_no_pivot():
     file = 'test' + os.sep + 'test_data.csv'
     excel_handler = ExcelHandler(manifest=manifest, csv_file=file, output_file=TEST_OUTPUT_FOLDER + os.sep + 'excel_test_from_csv_no_pivot.xlsx')
     excel_handler.create_notes_only()
+
+
+def test_write_excel_with_measures():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_WRITE_EXCEL_WITH_MEASURES",
+        "customerRef": "TEST_WRITE_EXCEL_WITH_MEASURES",
+        "measures": ["FPE", "Headcount"],
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    config = Config()
+    config.config['measure_mappings']['Headcount'] = 'Onward use category 1'
+    file = TEST_OUTPUT_FOLDER + os.sep + 'measures.csv'
+    with open(file, 'w', newline='') as f:
+        f.write('"Sex","Unrounded FPE","Onward use category 1"\n"Female",1.5,2\n"Male",2.0,3\n')
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_measures.xlsx'
+    excel_handler = ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file, config=config)
+    excel_handler.create_workbook()
+    assert excel_handler.totals == [3.5, 5]
+    workbook = load_workbook(output_file)
+    assert [cell.value for cell in workbook['Data'][1]] == ["Unrounded FPE", "Onward use category 1", "Sex"]
+    assert workbook['Notes']['B15'].value == "Unrounded FPE: 3.5; Onward use category 1: 5"
+    pivot = workbook['Pivot']._pivots[0]
+    assert [data_field.name for data_field in pivot.dataFields] == ["Sum of Unrounded FPE", "Sum of Onward use category 1"]
+    assert [cache_field.name for cache_field in pivot.cache.cacheFields] == ["Unrounded FPE", "Onward use category 1", "Sex"]
+
+
+def test_write_excel_with_totals():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_WRITE_EXCEL_WITH_TOTALS",
+        "customerRef": "TEST_WRITE_EXCEL_WITH_TOTALS",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    file = 'test' + os.sep + 'test_data.csv'
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_totals.xlsx'
+    excel_handler = ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file, totals=[1234.5])
+    excel_handler.create_workbook()
+    assert excel_handler.totals == [1234.5]
+    assert load_workbook(output_file)['Notes']['B15'].value == 1234.5
+
+
+def test_write_excel_with_query_totals():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_WRITE_EXCEL_WITH_QUERY_TOTALS",
+        "customerRef": "TEST_WRITE_EXCEL_WITH_QUERY_TOTALS",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    file = 'test' + os.sep + 'test_data.csv'
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_query_totals.xlsx'
+    excel_handler = ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file)
+    excel_handler.use_query_totals()
+    sink = excel_handler.create_data_sheet_sink()
+    sink.write_header(['Ethnicity (basic)', 'Sex', 'Unrounded FPE'])
+    sink.write_rows([['White', 'Female', 1.5], ['White', 'Male', 2.0]])
+    sink.close()
+    # The rows aren't added up, as the totals come from the query
+    assert excel_handler.totals == [0]
+    excel_handler.set_totals([3.5])
+    excel_handler.create_workbook_from_data_sheet()
+    assert load_workbook(output_file)['Notes']['B15'].value == 3.5
+
+
+def test_write_streaming_excel_matches_in_memory():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_WRITE_STREAMING_EXCEL",
+        "customerRef": "TEST_WRITE_STREAMING_EXCEL",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    file = 'test' + os.sep + 'test_data.csv'
+    config = Config()
+    config.config['output']['streaming_excel'] = 'False'
+    in_memory_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_in_memory.xlsx'
+    ExcelHandler(manifest=manifest, csv_file=file, output_file=in_memory_file, config=config).create_workbook()
+    streaming_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_streaming.xlsx'
+    ExcelHandler(manifest=manifest, csv_file=file, output_file=streaming_file).create_workbook()
+
+    in_memory = load_workbook(in_memory_file)
+    streaming = load_workbook(streaming_file)
+    assert [list(row) for row in streaming['Data'].values] == [list(row) for row in in_memory['Data'].values]
+    assert streaming['Notes']['B15'].value == in_memory['Notes']['B15'].value
+    assert streaming['Pivot']._pivots[0].cache.cacheSource.worksheetSource.ref == 'A1:C13'
+    assert not os.path.exists(streaming_file + '.data.xml')
+
+
+def test_template_parsed_once():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_TEMPLATE_PARSED_ONCE",
+        "customerRef": "",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items": [{"fieldName": "Sex"}],
+        "years": ["2020/21"]
+    }
+    excel_handler_1 = ExcelHandler(manifest=manifest)
+    excel_handler_2 = ExcelHandler(manifest=manifest)
+    assert get_blank_template(excel_handler_1.template) is get_blank_template(excel_handler_2.template)
+    assert excel_handler_1.workbook is not excel_handler_2.workbook
+    excel_handler_1.workbook['Notes']['B6'] = 'changed'
+    assert excel_handler_2.workbook['Notes']['B6'].value != 'changed'
+    assert excel_handler_1.workbook.sheetnames == ['Notes', 'Data', 'Pivot']
+    assert excel_handler_1.workbook['Data'].max_row == 1
+
+
+def test_write_notes_only():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_WRITE_NOTES_ONLY",
+        "customerRef": "",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)", "description": "Ethnicity <basic> & more"},
+                {"fieldName": "Sex", "allowedValues": ["Female"]},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    notes_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_notes_only.xlsx'
+    excel_handler = ExcelHandler(manifest=manifest, totals=[12.5])
+    excel_handler.create_notes_only(notes_file)
+
+    workbook = load_workbook(notes_file)
+    assert workbook.sheetnames == ['Notes']
+    notes = workbook['Notes']
+    assert notes['B6'].value == 'TEST_WRITE_NOTES_ONLY'
+    assert notes['B7'].value is None
+    assert notes['B15'].value == 12.5
+    assert notes['B17'].value == 'CSV'
+    assert [notes['A32'].value, notes['B32'].value] == ['Ethnicity (basic)', 'Ethnicity <basic> & more']
+    assert [notes['A33'].value, notes['B33'].value] == ['Sex', None]
+    assert notes['A34'].value is None
+    assert notes['B6'].style_id == load_workbook(excel_handler.template)['Notes']['B6'].style_id
+
+
+def test_write_excel_saves_pivot_cache_records():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_PIVOT_CACHE_RECORDS",
+        "customerRef": "",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    file = 'test' + os.sep + 'test_data.csv'
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_pivot_cache_records.xlsx'
+    assert ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file).create_workbook()
+
+    workbook = load_workbook(output_file)
+    pivot = workbook['Pivot']._pivots[0]
+    assert not pivot.cache.refreshOnLoad
+    assert pivot.cache.recordCount == 12
+    assert len(pivot.cache.records.r) == 12
+    assert pivot.cache.cacheFields[0].sharedItems.maxValue == 111
+    assert [item.v for item in pivot.cache.cacheFields[2].sharedItems._fields] == ['Female', 'Male', 'Not known']
+    assert workbook['Pivot'][pivot.location.ref.split(':')[1]].value == 1000
+    assert not os.path.exists(output_file + '.records.xml')
+
+
+def test_write_excel_with_many_columns():
+    headers = ['Field ' + str(index) for index in range(30)] + ['Unrounded FPE']
+    file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_many_columns.csv'
+    with open(file, 'w', encoding='utf-8') as f:
+        f.write(','.join('"' + header + '"' for header in headers) + '\n')
+        f.write(','.join('"' + str(index) + '"' for index in range(30)) + ',1.5\n')
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_MANY_COLUMNS",
+        "customerRef": "",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items": [{"fieldName": header} for header in headers[:-1]],
+        "years": ["2020/21"]
+    }
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_many_columns.xlsx'
+    assert ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file).create_workbook()
+    pivot = load_workbook(output_file)['Pivot']._pivots[0]
+    assert pivot.cache.cacheSource.worksheetSource.ref == 'A1:AE2'
+
+
+def test_write_excel_with_too_many_rows(monkeypatch):
+    monkeypatch.setattr(excel, 'MAX_WORKSHEET_ROWS', 10)
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "orderRef": "TEST_TOO_MANY_ROWS",
+        "customerRef": "",
+        "measure": "Unrounded FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+    file = 'test' + os.sep + 'test_data.csv'
+    output_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_too_many_rows.xlsx'
+    excel_handler = ExcelHandler(manifest=manifest, csv_file=file, output_file=output_file)
+    assert not excel_handler.create_workbook()
+    assert not excel_handler.fits_in_worksheet()
+    assert excel_handler.total == 1000
+    assert not os.path.exists(output_file)
+    assert not os.path.exists(output_file + '.data.xml')
+
+    notes_file = TEST_OUTPUT_FOLDER + os.sep + 'excel_test_too_many_rows_notes.xlsx'
+    excel_handler.create_notes_only(notes_file)
+    assert load_workbook(notes_file)['Notes']['B17'].value.startswith('CSV only - the 12 rows')
@@ -1,7 +1,11 @@
+from dataquery_processor import parquet
 from dataquery_processor.order_processor import OrderProcessor
 import pytest
 from dataquery_processor.config import Config
+from conftest import get_sqlite_config, get_test_file_path
+import json
 import os
+import shutil
 
 
 def test_order_no_datasource():
@@ -391,4 +395,126 @@ def test_order_combined():
         ]
     }
     order_processor = OrderProcessor(manifest)
-    order_processor.__validate_order__()
\ No newline at end of file
+    order_processor.__validate_order__()
+
+def test_order_artifacts():
+    manifest = {
+        "client": "demo",
+        "orderRef": "artifacts_test",
+        "customerRef": "",
+        "datasource": "Student full-person equivalent (FPE)",
+        "onwardUseCategory": "1",
+        "measure": "FPE",
+        "items":
+            [
+                {"fieldName": "Sex"},
+                {"fieldName": "Ethnicity (basic)"}
+            ],
+        "years": [
+            "2020/21"
+        ]
+    }
+    order_processor = OrderProcessor(manifest, config=get_sqlite_config())
+    order_processor.process()
+    path = order_processor.storage_controller.get_output_path()
+    for filename in ['pivot.xlsx', 'notes.xlsx', 'data.csv']:
+        assert os.path.exists(path + os.sep + filename)
+    with open(path + os.sep + 'query_stats.json') as f:
+        artifacts = json.load(f)['artifacts']
+    assert set(artifacts.keys()) == {'pivot.xlsx', 'notes.xlsx', 'data.csv'}
+    assert 'buildSeconds' in artifacts['pivot.xlsx'] and 'storeSeconds' in artifacts['pivot.xlsx']
+    shutil.rmtree(path)
+
+
+def test_order_parquet():
+    pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+    manifest = {
+        "client": "demo",
+        "orderRef": "parquet_test",
+        "customerRef": "",
+        "datasource": "Student full-person equivalent (FPE)",
+        "onwardUseCategory": "1",
+        "measure": "FPE",
+        "items":
+            [
+                {"fieldName": "Sex"},
+                {"fieldName": "Ethnicity (basic)"}
+            ],
+        "years": [
+            "2020/21"
+        ]
+    }
+    config = get_sqlite_config()
+    config.parquet_configuration['enabled'] = True
+    order_processor = OrderProcessor(manifest, config=config)
+    order_processor.process()
+    path = order_processor.storage_controller.get_output_path()
+    with open(path + os.sep + 'data.csv') as f:
+        rows = len(f.readlines()) - 1
+    table = pyarrow_parquet.read_table(path + os.sep + 'data.parquet')
+    assert table.num_rows == rows
+    assert str(table.schema.field(table.num_columns - 1).type) == 'double'
+    with open(path + os.sep + 'manifest.json') as f:
+        assert json.load(f)['parquetFile'].endswith('data.parquet')
+    shutil.rmtree(path)
+
+
+def test_order_parquet_without_pyarrow(monkeypatch):
+    monkeypatch.setattr(parquet, 'pyarrow', None)
+    manifest = {
+        "client": "demo",
+        "orderRef": "parquet_missing_test",
+        "customerRef": "",
+        "datasource": "Student full-person equivalent (FPE)",
+        "onwardUseCategory": "1",
+        "measure": "FPE",
+        "items":
+            [
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+            "2020/21"
+        ]
+    }
+    config = get_sqlite_config()
+    config.parquet_configuration['enabled'] = True
+    order_processor = OrderProcessor(manifest, config=config)
+    with pytest.raises(ValueError, match="pyarrow can't be imported"):
+        order_processor.process()
+
+
+def test_order_from_batch_query():
+    manifest = {
+        "client": "demo",
+        "orderRef": "batch_test",
+        "customerRef": "",
+        "datasource": "Student full-person equivalent (FPE)",
+        "onwardUseCategory": "1",
+        "measure": "FPE",
+        "items":
+            [
+                {"fieldName": "Sex"}
+            ],
+        "years": [
+            "2020/21"
+        ]
+    }
+    results_file = get_test_file_path('batch.csv')
+    with open(results_file, 'w', newline='') as f:
+        f.write('"Sex","Unrounded FPE"\n"Female",1.5\n"Male",2.0\n')
+    prefetched_results = {"file": results_file, "batch": 2, "sql": 'SELECT "Sex" FROM "dbo"."fake"',
+                          "orders": ["batch_test", "other_order"]}
+    order_processor = OrderProcessor(manifest, config=get_sqlite_config(), prefetched_results=prefetched_results)
+    order_processor.process()
+    path = order_processor.storage_controller.get_output_path()
+    with open(path + os.sep + 'query.sql') as f:
+        sql = f.read()
+    assert sql.startswith('-- The results for this order came from batch query 2')
+    assert 'batch_test, other_order' in sql
+    assert sql.endswith('SELECT "Sex" FROM "dbo"."fake"')
+    with open(path + os.sep + 'query_stats.json') as f:
+        query_stats = json.load(f)
+    assert query_stats['source'] == 'batch'
+    assert query_stats['batchQuery'] == 2
+    assert query_stats['batchOrders'] == ["batch_test", "other_order"]
+    shutil.rmtree(path)
@@ -0,0 +1,42 @@
+import csv
+import pytest
+from decimal import Decimal
+from dataquery_processor.config import Config
+from dataquery_processor.parquet import ParquetSink, write_parquet_from_csv
+
+pyarrow_parquet = pytest.importorskip('pyarrow.parquet')
+
+
+def get_parquet_config(row_group_size):
+    config = Config()
+    config.parquet_configuration['enabled'] = True
+    config.parquet_configuration['row_group_size'] = row_group_size
+    return config
+
+
+def test_parquet_sink_writes_row_groups(tmp_path):
+    file_name = str(tmp_path / 'data.parquet')
+    sink = ParquetSink(file_name, 1, config=get_parquet_config(2))
+    sink.write_header(['Sex', 'Academic year start', 'Unrounded FPE'])
+    sink.write_rows([('Female', 2020, Decimal('1.5')), ('Male', 2020, Decimal('2.25'))])
+    sink.write_rows([('Other', 2020, None)])
+    sink.close()
+    parquet_file = pyarrow_parquet.ParquetFile(file_name)
+    assert parquet_file.metadata.num_row_groups == 2
+    table = parquet_file.read()
+    assert table.column('Sex').to_pylist() == ['Female', 'Male', 'Other']
+    assert table.column('Academic year start').to_pylist() == ['2020', '2020', '2020']
+    assert table.column('Unrounded FPE').to_pylist() == [1.5, 2.25, None]
+
+
+def test_write_parquet_from_csv(tmp_path):
+    csv_file = str(tmp_path / 'data.csv')
+    with open(csv_file, 'w', newline='') as f:
+        writer = csv.writer(f, quoting=csv.QUOTE_NONNUMERIC)
+        writer.writerow(['Sex', 'Academic year start', 'Unrounded FPE'])
+        writer.writerows([['Female', 2020, 1.5], ['Male', 2020, 2.25]])
+    file_name = str(tmp_path / 'data.parquet')
+    write_parquet_from_csv(csv_file, file_name, 1, config=get_parquet_config(100))
+    table = pyarrow_parquet.read_table(file_name)
+    assert table.column('Academic year start').to_pylist() == ['2020', '2020']
+    assert table.column('Unrounded FPE').to_pylist() == [1.5, 2.25]
@@ -1,4 +1,7 @@
 from dataquery_processor import QueryBuilder
+from dataquery_processor.config import Config
+from dataquery_processor.query_builder import create_grouping_sets_query, get_shape_cache, QueryShapeCache, \
+    get_placeholder_count
 
 
 def test_year_starts():
@@ -152,4 +155,238 @@ def test_simple_query_with_text():
     qb = QueryBuilder(manifest)
     q = qb.create_query()
     assert q[0] == 'SELECT SUM("Unrounded FPE") "Unrounded FPE" FROM "dbo"."fake" WHERE "Course title" IN (?) AND "Onward use category 1"=1 AND "Academic year start" IN (2020)'
-    assert q[1] == ['Stuff']
\ No newline at end of file
+    assert q[1] == ['Stuff']
+
+def test_partitioned_queries():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity"},
+                {"fieldName": "Fruit", "allowedValues": ["banana"]}
+            ],
+        "years": [
+                "2019/20", "2020/21"
+            ]
+    }
+    qb = QueryBuilder(manifest)
+    queries = qb.create_partitioned_queries()
+    assert [year_start for year_start, q in queries] == [2019, 2020]
+    assert queries[0][1][0] == 'SELECT "Ethnicity",SUM("Unrounded FPE") "Unrounded FPE" FROM "dbo"."fake" WHERE "Fruit" IN (?) AND "Onward use category 1"=1 AND "Academic year start" IN (2019) GROUP BY "Ethnicity"'
+    assert queries[1][1][1] == ['banana']
+
+
+def test_grouping_sets_query():
+    def create_manifest(fields):
+        return {
+            "datasource": "Student full-person equivalent (fpe)",
+            "measure": "FPE",
+            "onwardUseCategory": "1",
+            "items": [{"fieldName": field} for field in fields] + [{"fieldName": "Fruit", "allowedValues": ["banana"]}],
+            "years": [
+                    "2020/21"
+                ]
+        }
+    qb_1 = QueryBuilder(create_manifest(["Sex", "Ethnicity"]))
+    qb_2 = QueryBuilder(create_manifest(["Ethnicity"]))
+    assert qb_1.get_compatibility_key() == qb_2.get_compatibility_key()
+    q = create_grouping_sets_query([qb_1, qb_2])
+    assert q[0] == 'SELECT "Sex","Ethnicity",SUM("Unrounded FPE") "Unrounded FPE",GROUPING_ID("Sex","Ethnicity") "__grouping_id" FROM "dbo"."fake" WHERE "Fruit" IN (?) AND "Onward use category 1"=1 AND "Academic year start" IN (2020) GROUP BY GROUPING SETS(("Sex","Ethnicity"),("Ethnicity"))'
+    assert q[1] == ['banana']
+    assert q[2] == {}
+    assert q[3] == ["Sex", "Ethnicity"]
+    assert q[4] == [0, 2]
+
+
+def test_query_shape_cache():
+    def create_manifest(values):
+        return {
+            "datasource": "Student full-person equivalent (fpe)",
+            "measure": "FPE",
+            "onwardUseCategory": "1",
+            "years": ["2019/20", "2020/21"],
+            "items": [{"fieldName": "Sex", "allowedValues": values}, {"fieldName": "Ethnicity (basic)"}]
+        }
+
+    shape_cache = get_shape_cache()
+    shape_cache.clear()
+    query_1 = QueryBuilder(create_manifest(["Female"])).create_query()
+    query_2 = QueryBuilder(create_manifest(["Male"])).create_query()
+    query_3 = QueryBuilder(create_manifest(["Female", "Male"])).create_query()
+    assert query_1[0] == query_2[0]
+    assert query_1[1] == ["Female"]
+    assert query_2[1] == ["Male"]
+    assert query_3[0].count('?') == 2
+    assert query_3[1] == ["Female", "Male"]
+    assert shape_cache.statistics() == {"entries": 2, "hits": 1, "misses": 2, "shapes": 2}
+
+
+def test_query_shape_cache_eviction():
+    shape_cache = QueryShapeCache(2)
+    shape_cache.put("a", "SELECT a")
+    shape_cache.put("b", "SELECT b")
+    assert shape_cache.get("a") == "SELECT a"
+    shape_cache.put("c", "SELECT c")
+    assert shape_cache.get("b") is None
+    assert shape_cache.get("a") == "SELECT a"
+    assert shape_cache.statistics() == {"entries": 2, "hits": 2, "misses": 1, "shapes": 3}
+
+
+def test_placeholder_count():
+    assert get_placeholder_count(3, []) == 3
+    assert get_placeholder_count(3, [1, 2, 4, 8]) == 4
+    assert get_placeholder_count(8, [1, 2, 4, 8]) == 8
+    assert get_placeholder_count(9, [1, 2, 4, 8]) == 16
+    assert get_placeholder_count(17, [1, 2, 4, 8]) == 24
+
+
+def test_placeholder_buckets():
+    def create_manifest(values):
+        return {
+            "datasource": "Student full-person equivalent (fpe)",
+            "measure": "FPE",
+            "onwardUseCategory": "1",
+            "years": ["2020/21"],
+            "items": [{"fieldName": "Sex", "allowedValues": values}]
+        }
+
+    config = Config()
+    config.get_query_configuration()['placeholder_buckets'] = [1, 2, 4, 8]
+    query_1 = QueryBuilder(create_manifest(["Female", "Male", "Other"]), config=config).create_query()
+    query_2 = QueryBuilder(create_manifest(["Female", "Male", "Other", "Not known"]), config=config).create_query()
+    assert query_1[0] == query_2[0]
+    assert query_1[0].count('?') == 4
+    assert query_1[1] == ["Female", "Male", "Other", "Other"]
+    assert query_2[1] == ["Female", "Male", "Other", "Not known"]
+
+
+def test_temp_table_constraint():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex", "allowedValues": ["Female"]},
+                  {"fieldName": "Course title", "allowedValues": ["pear", "apple", "banana", "apple"]}]
+    }
+    config = Config()
+    config.get_query_configuration()['temp_table_threshold'] = 3
+    q = QueryBuilder(manifest, config=config).create_query()
+    assert q[0] == 'SELECT SUM("Unrounded FPE") "Unrounded FPE" FROM "dbo"."fake" WHERE "Sex" IN (?) AND "Course title" IN (SELECT "value" FROM "#dq_values_1") AND "Onward use category 1"=1 AND "Academic year start" IN (2020)'
+    assert q[1] == ["Female"]
+    assert q[2] == {"#dq_values_1": ["apple", "banana", "pear"]}
+
+
+def test_query_with_measures():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measures": ["FPE", "unrounded fpe", "Headcount"],
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex"}]
+    }
+    config = Config()
+    config.config['measure_mappings']['Headcount'] = 'Onward use category 1'
+    qb = QueryBuilder(manifest, config=config)
+    assert qb.measures == ["Unrounded FPE", "Onward use category 1"]
+    assert qb.create_query()[0] == 'SELECT "Sex",SUM("Unrounded FPE") "Unrounded FPE",SUM("Onward use category 1") "Onward use category 1" FROM "dbo"."fake" WHERE "Onward use category 1"=1 AND "Academic year start" IN (2020) GROUP BY "Sex"'
+
+
+def test_query_with_totals():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex"}, {"fieldName": "Ethnicity"}]
+    }
+    config = Config()
+    q = QueryBuilder(manifest, config=config).create_query(totals=True)
+    assert q[0] == 'SELECT "Sex","Ethnicity",SUM("Unrounded FPE") "Unrounded FPE",GROUPING_ID("Sex","Ethnicity") "__grouping_id" FROM "dbo"."fake" WHERE "Onward use category 1"=1 AND "Academic year start" IN (2020) GROUP BY GROUPING SETS(("Sex","Ethnicity"),())'
+    assert q[3] == {"fields": ["Sex", "Ethnicity"], "measures": ["Unrounded FPE"], "subtotals": False}
+    config.get_query_configuration()['subtotals'] = True
+    q = QueryBuilder(manifest, config=config).create_query(totals=True)
+    assert q[0].endswith('GROUP BY GROUPING SETS(("Sex","Ethnicity"),("Sex"),("Ethnicity"),())')
+    assert q[3]["subtotals"]
+
+
+def test_temp_tables_keep_parameters_under_limit():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex", "allowedValues": [str(i) for i in range(900)]},
+                  {"fieldName": "Ethnicity", "allowedValues": [str(i) for i in range(950)]},
+                  {"fieldName": "Course title", "allowedValues": [str(i) for i in range(900)]}]
+    }
+    config = Config()
+    config.get_query_configuration()['temp_table_threshold'] = 1000
+    q = QueryBuilder(manifest, config=config).create_query()
+    assert list(q[2].keys()) == ["#dq_values_1"]
+    assert len(q[1]) == 1800
+    assert q[0].count('?') == 1800
+
+
+def test_placeholder_buckets_not_padded_over_limit():
+    def create_manifest(*sizes):
+        return {
+            "datasource": "Student full-person equivalent (fpe)",
+            "measure": "FPE",
+            "onwardUseCategory": "1",
+            "years": ["2020/21"],
+            "items": [{"fieldName": field, "allowedValues": [str(i) for i in range(size)]}
+                      for field, size in zip(["Sex", "Ethnicity", "Course title"], sizes)]
+        }
+
+    config = Config()
+    config.get_query_configuration()['placeholder_buckets'] = [256, 512, 1024]
+    config.get_query_configuration()['temp_table_threshold'] = 0
+    # Padded to 1024 each, the lists would need 2048 parameters
+    q = QueryBuilder(create_manifest(600, 600), config=config).create_query()
+    assert q[2] == {}
+    assert len(q[1]) == q[0].count('?') == 1200
+    q = QueryBuilder(create_manifest(500, 500), config=config).create_query()
+    assert len(q[1]) == q[0].count('?') == 1024
+    # Even unpadded, three lists would be over the limit, so the largest goes to a temporary table
+    q = QueryBuilder(create_manifest(700, 650, 750), config=config).create_query()
+    assert list(q[2].keys()) == ["#dq_values_2"]
+    assert len(q[1]) == q[0].count('?') == 1350
+
+
+def test_query_shape_cache_per_config():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex", "allowedValues": ["Female"]}]
+    }
+    config = Config()
+    config.get_query_configuration()['shape_cache_size'] = 1
+    shape_cache = get_shape_cache(config)
+    assert shape_cache is not get_shape_cache()
+    assert shape_cache.size == 1
+    QueryBuilder(manifest, config=config).create_query()
+    QueryBuilder(dict(manifest, years=["2019/20"]), config=config).create_query()
+    assert shape_cache.statistics() == {"entries": 1, "hits": 0, "misses": 2, "shapes": 2}
+
+
+def test_query_shape_cache_counts_shapes_with_same_hash():
+    class Shape(object):
+
+        def __init__(self, name):
+            self.name = name
+
+        def __eq__(self, other):
+            return self.name == other.name
+
+        def __hash__(self):
+            return 1
+
+    shape_cache = QueryShapeCache(2)
+    shape_cache.put(Shape("a"), "SELECT a")
+    shape_cache.put(Shape("b"), "SELECT b")
+    assert shape_cache.statistics()["shapes"] == 2
@@ -1,7 +1,56 @@
 from dataquery_processor import QueryBuilder, OdbcQueryRunner, StorageController
+from dataquery_processor.query_runner import fetch_batches, merge_partition_rows, parse_server_statistics, \
+    split_totals_rows, create_totals, get_merged_row_sort_key
+from dataquery_processor import query_runner
+from dataquery_processor.config import Config
+from decimal import Decimal
+import pytest
 from conftest import get_test_file_path
 
 
+class FakeCursor(object):
+
+    def __init__(self, rows):
+        self.rows = rows
+
+    def fetchmany(self, size):
+        batch = self.rows[:size]
+        self.rows = self.rows[size:]
+        return batch
+
+
+def test_fetch_batches():
+    rows = [("Female", 1.0)] * 10
+    batches = list(fetch_batches(FakeCursor(rows), 4))
+    assert [len(batch) for batch in batches] == [4, 4, 2]
+
+
+def test_fetch_batches_with_memory_limit():
+    rows = [("x" * 1000, 1.0)] * 10
+    batches = list(fetch_batches(FakeCursor(rows), 4, memory_limit=2500))
+    assert [len(batch) for batch in batches] == [4, 2, 2, 2]
+
+
+def test_merge_partition_rows():
+    merged = {}
+    merge_partition_rows(merged, [("Female", "2019/20", 10), ("Male", "2019/20", None)])
+    merge_partition_rows(merged, [("Female", "2019/20", 5), ("Male", "2019/20", 2), ("Male", "2020/21", 3)])
+    assert merged == {("Female", "2019/20"): [15], ("Male", "2019/20"): [2], ("Male", "2020/21"): [3]}
+
+
+def test_merged_row_sort_key():
+    keys = [("Male", None), (None, "2019/20"), ("Female", "2020/21"), ("Female", "2019/20")]
+    assert sorted(keys, key=get_merged_row_sort_key) == [("Female", "2019/20"), ("Female", "2020/21"),
+                                                        ("Male", None), (None, "2019/20")]
+
+
+def test_merge_partition_rows_with_measures():
+    merged = {}
+    merge_partition_rows(merged, [("Female", 10, 1), ("Male", None, 2)], measures=2)
+    merge_partition_rows(merged, [("Female", 5, None), ("Male", 2, 3)], measures=2)
+    assert merged == {("Female",): [15, 1], ("Male",): [2, 5]}
+
+
 def test_create_and_run_simple_query():
     manifest = {
         "datasource": "Student full-person equivalent (fpe)",
@@ -81,3 +130,69 @@ def test_create_and_run_query_with_multiple_constraints():
     q = qb.create_query()
     odbc = OdbcQueryRunner()
     odbc.run_query_and_save_results(q, file_name=get_test_file_path("test_query_runner.csv"))
+
+
+def test_parse_server_statistics():
+    messages = ["[01000] SQL Server parse and compile time: \n   CPU time = 3 ms, elapsed time = 4 ms.",
+                "[01000] Table 'fake'. Scan count 1, logical reads 44, physical reads 2, read-ahead reads 0.",
+                "[01000] SQL Server Execution Times:\n   CPU time = 15 ms,  elapsed time = 21 ms."]
+    server = parse_server_statistics(messages)
+    assert server["cpuMilliseconds"] == 15
+    assert server["elapsedMilliseconds"] == 21
+    assert server["logicalReads"] == 44
+    assert server["physicalReads"] == 2
+    assert server["messages"] == messages
+
+
+def test_split_totals_rows():
+    layout = {"fields": ["Sex", "Ethnicity"], "measures": ["Unrounded FPE"], "subtotals": True}
+    totals = create_totals(layout)
+    rows = [("Female", "White", Decimal("1.5"), 0),
+            ("Female", None, Decimal("1.5"), 1),
+            (None, "White", Decimal("1.5"), 2),
+            (None, None, Decimal("1.5"), 3)]
+    assert split_totals_rows(rows, totals, layout) == [("Female", "White", Decimal("1.5"))]
+    assert totals == {"measures": ["Unrounded FPE"], "total": [1.5],
+                      "subtotals": {"Sex": [["Female", 1.5]], "Ethnicity": [["White", 1.5]]}}
+
+
+class FakePool(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.released = []
+
+    def acquire(self):
+        return self.connection
+
+    def release(self, connection, discard=False):
+        self.released.append(discard)
+
+
+class FailingConnection(object):
+
+    def cursor(self):
+        return FailingCursor()
+
+
+class FailingCursor(object):
+
+    def execute(self, sql, parameters=None):
+        raise query_runner.pyodbc.ProgrammingError("Query failed")
+
+    def close(self):
+        pass
+
+
+def test_connection_discarded_when_query_with_server_statistics_fails(monkeypatch):
+    if query_runner.pyodbc is None:
+        pytest.skip("pyodbc can't be imported")
+    pool = FakePool(FailingConnection())
+    monkeypatch.setattr(query_runner, "get_connection_pool", lambda config: pool)
+    config = Config()
+    config.get_fetch_configuration()['server_statistics'] = True
+    runner = OdbcQueryRunner(config=config)
+    with pytest.raises(query_runner.pyodbc.ProgrammingError):
+        runner.run_query_and_return_results(['SELECT 1', []])
+    runner.close()
+    assert pool.released == [True]
@@ -0,0 +1,64 @@
+import os
+import time
+from dataquery_processor import QueryBuilder
+from dataquery_processor.result_cache import ResultCache, LocalCacheBackend
+from conftest import get_test_file_path
+
+
+def create_manifest(allowed_values):
+    return {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "items":
+            [
+                {"fieldName": "Ethnicity (basic)"},
+                {"fieldName": "Sex", "allowedValues": allowed_values}
+            ],
+        "years": [
+                "2020/21"
+            ]
+    }
+
+
+def test_cache_key_ignores_order_of_allowed_values():
+    cache = ResultCache()
+    qb_1 = QueryBuilder(create_manifest(["Female", "Male"]))
+    qb_2 = QueryBuilder(create_manifest(["Male", "Female"]))
+    qb_3 = QueryBuilder(create_manifest(["Male"]))
+    key_1 = cache.make_key(qb_1, qb_1.create_query())
+    key_2 = cache.make_key(qb_2, qb_2.create_query())
+    key_3 = cache.make_key(qb_3, qb_3.create_query())
+    assert key_1 == key_2
+    assert key_1 != key_3
+    assert key_1.startswith("fake/")
+
+
+def test_local_cache_round_trip():
+    backend = LocalCacheBackend(get_test_file_path("cache"))
+    source = get_test_file_path("source.csv")
+    target = get_test_file_path("target.csv")
+    with open(source, "w") as f:
+        f.write('"Sex","Unrounded FPE"\n"Female",10\n')
+    assert not backend.get("fake/abc.csv.gz", target, ttl=60)
+    backend.put("fake/abc.csv.gz", source)
+    assert backend.get("fake/abc.csv.gz", target, ttl=60)
+    with open(target) as f:
+        assert f.read() == '"Sex","Unrounded FPE"\n"Female",10\n'
+    backend.invalidate("fake/")
+    assert not backend.get("fake/abc.csv.gz", target, ttl=60)
+
+
+def test_local_cache_evicts_least_recently_used():
+    backend = LocalCacheBackend(get_test_file_path("cache"))
+    source = get_test_file_path("source.csv")
+    with open(source, "w") as f:
+        f.write(os.urandom(1000).hex())
+    backend.put("fake/old.csv.gz", source)
+    backend.put("fake/new.csv.gz", source)
+    old_path = get_test_file_path("cache") + os.sep + "fake" + os.sep + "old.csv.gz"
+    os.utime(old_path, (time.time() - 100, time.time()))
+    size = os.path.getsize(old_path)
+    backend.evict(ttl=60, max_size=size)
+    assert not os.path.exists(old_path)
+    assert backend.get("fake/new.csv.gz", get_test_file_path("target.csv"), ttl=60)
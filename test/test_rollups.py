@@ -0,0 +1,83 @@
+import csv
+from dataquery_processor import QueryBuilder
+from dataquery_processor.query_runner import create_query_runner
+from dataquery_processor.rollups import create_rollup_query, refresh_rollups
+from conftest import get_sqlite_config
+from conftest import get_test_file_path
+
+ROLLUP_COLUMNS = "Sex\nMode of study\nAcademic year start\nOnward use category 1"
+
+
+def get_rollup_config():
+    config = get_sqlite_config()
+    config.config['rollup.fake_by_sex_and_mode'] = {'base_table': 'fake',
+                                                    'columns': ROLLUP_COLUMNS,
+                                                    'measures': 'Unrounded FPE'}
+    config.config['rollup.fake_by_sex'] = {'base_table': 'fake',
+                                           'columns': "Sex\nAcademic year start\nOnward use category 1",
+                                           'measures': 'Unrounded FPE',
+                                           'rows': '4'}
+    return config
+
+
+def create_manifest(items, onward_use_category="1"):
+    return {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": onward_use_category,
+        "years": ["2020/21"],
+        "items": items
+    }
+
+
+def test_route_to_smallest_rollup():
+    config = get_rollup_config()
+    query_builder = QueryBuilder(create_manifest([{"fieldName": "Sex"}]), config=config)
+    assert query_builder.table.get_table_name() == 'fake_by_sex'
+    assert query_builder.base_table == 'fake'
+
+
+def test_route_with_constraint():
+    config = get_rollup_config()
+    items = [{"fieldName": "Sex"}, {"fieldName": "Mode of study", "allowedValues": ["Full-time (including sandwich)"]}]
+    query_builder = QueryBuilder(create_manifest(items), config=config)
+    assert query_builder.table.get_table_name() == 'fake_by_sex_and_mode'
+
+
+def test_route_to_base_table():
+    config = get_rollup_config()
+    query_builder = QueryBuilder(create_manifest([{"fieldName": "Ethnicity (basic)"}]), config=config)
+    assert query_builder.table.get_table_name() == 'fake'
+    query_builder = QueryBuilder(create_manifest([{"fieldName": "Sex"}], onward_use_category="2"), config=config)
+    assert query_builder.table.get_table_name() == 'fake'
+
+
+def test_create_rollup_query():
+    config = get_rollup_config()
+    rollup = [rollup for rollup in config.get_rollups() if rollup['name'] == 'fake_by_sex'][0]
+    assert create_rollup_query(rollup) == 'SELECT "Sex","Academic year start","Onward use category 1",' \
+                                          'SUM("Unrounded FPE") "Unrounded FPE" INTO "dbo"."fake_by_sex" ' \
+                                          'FROM "dbo"."fake" ' \
+                                          'GROUP BY "Sex","Academic year start","Onward use category 1"'
+
+
+def test_refresh_and_query_rollup():
+    config = get_rollup_config()
+    refresh_rollups(config=config)
+    refresh_rollups(['fake_by_sex'], config=config)
+
+    def run(query_builder, file_name):
+        runner = create_query_runner(config=config)
+        try:
+            runner.run_query_and_save_results(query_builder.create_query(), get_test_file_path(file_name))
+        finally:
+            runner.close()
+        with open(get_test_file_path(file_name), newline='') as f:
+            return sorted(csv.reader(f))
+
+    manifest = create_manifest([{"fieldName": "Sex"}])
+    routed = QueryBuilder(manifest, config=config)
+    assert routed.table.get_table_name() == 'fake_by_sex'
+    base = QueryBuilder(create_manifest([{"fieldName": "Sex"}]), config=get_sqlite_config())
+    assert base.table.get_table_name() == 'fake'
+    assert run(routed, 'routed.csv') == run(base, 'base.csv')
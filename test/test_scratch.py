@@ -0,0 +1,21 @@
+import os
+from dataquery_processor.scratch import ScratchSpace, total_usage
+
+
+def test_scratch_spaces_are_isolated():
+    first = ScratchSpace("same order")
+    second = ScratchSpace("same order")
+    assert first.get_path("data.csv") != second.get_path("data.csv")
+    first.cleanup()
+    second.cleanup()
+
+
+def test_scratch_usage_and_cleanup():
+    scratch = ScratchSpace("usage test")
+    with open(scratch.get_path("data.csv"), "w") as f:
+        f.write("x" * 1000)
+    assert scratch.usage() == 1000
+    assert total_usage() >= 1000
+    assert scratch.report("in test") >= 1000
+    scratch.cleanup()
+    assert not os.path.exists(scratch.path)
@@ -0,0 +1,188 @@
+import csv
+import pytest
+from openpyxl import load_workbook
+from dataquery_processor import QueryBuilder, ExcelHandler
+from dataquery_processor.query_runner import create_query_runner, run_partitioned_query_and_save_results
+from dataquery_processor.sqlite_runner import SqliteQueryRunner
+from conftest import get_test_file_path, get_sqlite_config
+
+
+def test_create_sqlite_runner():
+    runner = create_query_runner(config=get_sqlite_config())
+    try:
+        assert isinstance(runner, SqliteQueryRunner)
+        assert runner.table_exists('fake')
+    finally:
+        runner.close()
+
+
+def test_translate_top():
+    runner = SqliteQueryRunner(config=get_sqlite_config())
+    try:
+        assert runner.translate('SELECT TOP 10 "a" FROM "dbo"."fake"') == 'SELECT "a" FROM "dbo"."fake" LIMIT 10'
+    finally:
+        runner.close()
+
+
+def test_run_query_with_sqlite():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [
+            {"fieldName": "Sex"},
+            {"fieldName": "Mode of study", "allowedValues": ["Full-time (including sandwich)"]}
+        ]
+    }
+    config = get_sqlite_config()
+    query = QueryBuilder(manifest, config=config).create_query()
+    runner = create_query_runner(config=config)
+    try:
+        runner.run_query_and_save_results(query, get_test_file_path('sqlite.csv'))
+    finally:
+        runner.close()
+    with open(get_test_file_path('sqlite.csv'), newline='') as f:
+        rows = list(csv.reader(f))
+    assert rows[0] == ['Sex', 'Unrounded FPE']
+    assert len(rows) > 1
+    assert runner.statistics.rows == len(rows) - 1
+
+
+def test_query_statistics():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex"}]
+    }
+    config = get_sqlite_config()
+    query = QueryBuilder(manifest, config=config).create_query()
+    runner = create_query_runner(config=config)
+    try:
+        runner.run_query_and_save_results(query, get_test_file_path('sqlite.csv'))
+    finally:
+        runner.close()
+    statistics = runner.statistics.as_dict()
+    assert statistics["rows"] > 0
+    assert statistics["bytesWritten"] > 0
+    assert 0 <= statistics["executeSeconds"] <= statistics["firstRowSeconds"] <= statistics["seconds"]
+    assert "fetchSeconds" in statistics
+    assert "server" not in statistics
+
+
+def test_run_query_with_temp_table():
+    def run(config, file_name):
+        manifest = {
+            "datasource": "Student full-person equivalent (fpe)",
+            "measure": "FPE",
+            "onwardUseCategory": "1",
+            "years": ["2020/21"],
+            "items": [{"fieldName": "Sex"}, {"fieldName": "Domicile (country)",
+                                             "allowedValues": ["Brunei", "Ghana", "Solomon Islands", "Azerbaijan"]}]
+        }
+        query = QueryBuilder(manifest, config=config).create_query()
+        runner = create_query_runner(config=config)
+        try:
+            runner.run_query_and_save_results(query, get_test_file_path(file_name))
+            runner.run_query_and_save_results(query, get_test_file_path(file_name))
+            assert len(runner.temp_tables) == len(query[2])
+        finally:
+            runner.close()
+        with open(get_test_file_path(file_name), newline='') as f:
+            return sorted(csv.reader(f))
+
+    config = get_sqlite_config()
+    config.get_query_configuration()['temp_table_threshold'] = 2
+    assert run(config, 'temp_table.csv') == run(get_sqlite_config(), 'in_list.csv')
+
+
+def test_run_query_with_data_sheet_sink():
+    manifest = {
+        "orderRef": "TEST_DATA_SHEET_SINK",
+        "customerRef": "",
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2020/21"],
+        "items": [{"fieldName": "Sex"}, {"fieldName": "Mode of study"}]
+    }
+    config = get_sqlite_config()
+    query = QueryBuilder(manifest, config=config).create_query()
+    excel_handler = ExcelHandler(manifest=manifest, output_file=get_test_file_path('sink.xlsx'), config=config)
+    runner = create_query_runner(config=config)
+    try:
+        runner.run_query_and_save_results(query, get_test_file_path('sink.csv'),
+                                          sinks=[excel_handler.create_data_sheet_sink()])
+    finally:
+        runner.close()
+    excel_handler.create_workbook_from_data_sheet()
+
+    with open(get_test_file_path('sink.csv'), newline='') as f:
+        rows = list(csv.reader(f, quoting=csv.QUOTE_NONNUMERIC))
+    data = [list(row) for row in load_workbook(get_test_file_path('sink.xlsx'))['Data'].values]
+    assert data == [row[-1:] + row[:-1] for row in rows]
+    assert excel_handler.total == sum(row[-1] for row in rows[1:])
+
+
+class RecordingSink(object):
+
+    def __init__(self):
+        self.aborted = False
+        self.closed = False
+
+    def write_header(self, headers):
+        pass
+
+    def write_rows(self, rows):
+        pass
+
+    def bytes_written(self):
+        return 0
+
+    def abort(self):
+        self.aborted = True
+
+    def close(self):
+        self.closed = True
+
+
+def test_sinks_aborted_when_query_fails():
+    sink = RecordingSink()
+    runner = create_query_runner(config=get_sqlite_config())
+    try:
+        with pytest.raises(Exception):
+            runner.run_query_and_save_results(['SELECT * FROM "dbo"."missing"', [], {}], sinks=[sink])
+    finally:
+        runner.close()
+    assert sink.aborted and sink.closed
+
+
+def test_partitioned_query_with_sqlite():
+    manifest = {
+        "datasource": "Student full-person equivalent (fpe)",
+        "measure": "FPE",
+        "onwardUseCategory": "1",
+        "years": ["2019/20", "2020/21"],
+        "items": [{"fieldName": "Sex"}, {"fieldName": "Mode of study"}]
+    }
+    config = get_sqlite_config()
+    config.get_fetch_configuration()['batch_size'] = 2
+    query_builder = QueryBuilder(manifest, config=config)
+    # Run the single query first, so the table is loaded before the partitions run
+    runner = create_query_runner(config=config)
+    try:
+        runner.run_query_and_save_results(query_builder.create_query(), get_test_file_path('sqlite.csv'))
+    finally:
+        runner.close()
+    with open(get_test_file_path('sqlite.csv'), newline='') as f:
+        single = list(csv.reader(f, quoting=csv.QUOTE_NONNUMERIC))
+    statistics = run_partitioned_query_and_save_results(query_builder.create_partitioned_queries(),
+                                                        get_test_file_path('partitioned.csv'), config=config)
+    with open(get_test_file_path('partitioned.csv'), newline='') as f:
+        partitioned = list(csv.reader(f, quoting=csv.QUOTE_NONNUMERIC))
+    assert partitioned[0] == single[0]
+    assert partitioned[1:] == sorted(single[1:])
+    assert [partition['partition'] for partition in statistics.partitions] == [2019, 2020]
+    assert statistics.rows == len(single) - 1
@@ -0,0 +1,91 @@
+import gzip
+import json
+from dataquery_processor import storage_controller
+from dataquery_processor.storage_controller import S3StorageController, S3MultipartSink, MIN_PART_SIZE
+
+
+class FakeS3Client(object):
+
+    def __init__(self):
+        self.objects = {}
+        self.uploads = []
+
+    def put_object(self, Bucket, Key, Body):
+        self.objects[Key] = Body
+
+    def upload_file(self, Filename, Bucket, Key, Config=None):
+        self.uploads.append((Filename, Key, Config))
+
+    def create_multipart_upload(self, Bucket, Key, ContentType=None):
+        self.parts = {}
+        self.aborted = False
+        return {'UploadId': 'upload'}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        self.parts[PartNumber] = Body
+        return {'ETag': str(PartNumber)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self.objects[Key] = b''.join(self.parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.aborted = True
+
+
+def create_controller(monkeypatch):
+    monkeypatch.setattr(storage_controller, "get_client", lambda service_name, profile=None, region=None: FakeS3Client())
+    return S3StorageController(client="demo", order_reference="s3_test")
+
+
+def test_s3_objects_uploaded_from_memory(monkeypatch):
+    controller = create_controller(monkeypatch)
+    controller.store_object_as_json("manifest.json", {"orderRef": "s3_test"})
+    controller.store_object_as_text("query.sql", "SELECT 1")
+    controller.store_object_as_csv("data.csv", [["Female", 1.5]], headers=["Sex", "FPE"])
+    key = controller.subfolder + "demo/" + controller.get_resource_path()
+    assert json.loads(controller.s3client.objects[key + "/manifest.json"]) == {"orderRef": "s3_test"}
+    assert controller.s3client.objects[key + "/query.sql"] == b"SELECT 1"
+    assert controller.s3client.objects[key + "/data.csv"] == b'"Sex","FPE"\r\n"Female",1.5\r\n'
+
+
+def test_s3_files_uploaded_with_transfer_config(monkeypatch):
+    controller = create_controller(monkeypatch)
+    controller.store_file("pivot.xlsx", "pivot.xlsx")
+    filename, key, config = controller.s3client.uploads[0]
+    assert key == controller.subfolder + "demo/" + controller.get_resource_path("pivot.xlsx")
+    assert config.multipart_chunksize == 8 * 1024 * 1024
+
+
+def test_multipart_sink_uploads_parts():
+    client = FakeS3Client()
+    sink = S3MultipartSink(client, "bucket", "data.csv", "data.csv", part_size=0)
+    sink.write_header(["Sex", "FPE"])
+    rows = [["x" * 1024, float(index)] for index in range(6 * 1024)]
+    sink.write_rows(rows)
+    sink.write_rows(rows[:1])
+    sink.close()
+    assert len(client.parts) == 2
+    assert len(client.parts[1]) >= MIN_PART_SIZE
+    lines = client.objects["data.csv"].decode('utf-8').splitlines()
+    assert lines[0] == '"Sex","FPE"'
+    assert len(lines) == len(rows) + 2
+    assert sink.bytes_written() == len(client.objects["data.csv"])
+
+
+def test_multipart_sink_gzip():
+    client = FakeS3Client()
+    sink = S3MultipartSink(client, "bucket", "data.csv.gz", "data.csv.gz", part_size=MIN_PART_SIZE, compress=True)
+    sink.write_header(["Sex", "FPE"])
+    sink.write_rows([["Female", 1.5]])
+    sink.close()
+    assert gzip.decompress(client.objects["data.csv.gz"]) == b'"Sex","FPE"\r\n"Female",1.5\r\n'
+
+
+def test_multipart_sink_aborted():
+    client = FakeS3Client()
+    sink = S3MultipartSink(client, "bucket", "data.csv", "data.csv", part_size=MIN_PART_SIZE)
+    sink.write_header(["Sex", "FPE"])
+    sink.abort()
+    sink.close()
+    assert client.aborted
+    assert "data.csv" not in client.objects